@@ -2,16 +2,24 @@ import torch
 import numpy as np
 import os
 import timeit
+import copy
+import tempfile
+import torch.distributed as dist
 from PIL import Image
 from torchvision.utils import save_image
 
 from utils import *
 from opts import parse_opts
+from vicinal_sampler import VicinalBatchSampler
+from dump_writer import FakeImageDumpWriter
+from gan_steps import CcGAN_D_loss, CcGAN_G_loss, CompiledStep, set_compile_cache_dir
+from checkpoint_utils import CheckpointManager
 
 ''' Settings '''
 args = parse_opts()
 NGPU = torch.cuda.device_count()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+amp_dtype = get_amp_dtype(args.gan_amp, device) #None: fp32
 
 # some parameters in opts
 loss_type = args.loss_type_gan
@@ -21,6 +29,8 @@ dim_gan = args.dim_gan
 lr_g = args.lr_g_gan
 lr_d = args.lr_d_gan
 save_niters_freq = args.save_niters_freq
+ckpt_keep_last = args.ckpt_keep_last
+ckpt_milestone_freq = args.ckpt_milestone_freq
 batch_size_disc = args.batch_size_disc
 batch_size_gene = args.batch_size_gene
 batch_size_max = max(batch_size_disc, batch_size_gene)
@@ -31,32 +41,95 @@ nonzero_soft_weight_threshold = args.nonzero_soft_weight_threshold
 NC = args.num_channels
 IMG_SIZE = args.img_size
 
-def train_CcGAN(kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder = None, clip_label=False):
+compile_steps = args.gan_compile
+compile_cache_dir = args.compile_cache_dir if args.compile_cache_dir != '' else os.path.join(args.root_path, 'torch_cache', 'inductor')
+
+seed = args.seed
+ddp_world_size = args.gan_ddp_world_size
+ddp_num_threads = args.gan_ddp_num_threads
+ddp_master_port = args.gan_ddp_master_port
+
+def train_CcGAN(kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder = None, clip_label=False, sampler=None, batch_size_disc=None, batch_size_gene=None):
 
     '''
     Note that train_images are not normalized to [-1,1]
+    train_images: uint8 numpy array or an IMGs_store
+    sampler: a VicinalBatchSampler; if None, build one from train_labels
+    batch_size_disc, batch_size_gene: batch sizes of this process; if None, args.batch_size_disc and args.batch_size_gene
+    if ddp_world_size>1, train with ddp_world_size processes (see train_CcGAN_ddp)
     '''
+    batch_size_disc = args.batch_size_disc if batch_size_disc is None else batch_size_disc
+    batch_size_gene = args.batch_size_gene if batch_size_gene is None else batch_size_gene
+    batch_size_max = max(batch_size_disc, batch_size_gene)
+    if ddp_world_size>1 and not dist.is_initialized():
+        return train_CcGAN_ddp(kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder = save_models_folder, clip_label = clip_label, sampler = sampler, batch_size_disc = batch_size_disc, batch_size_gene = batch_size_gene)
+    distributed = dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
 
     netG = netG.to(device)
     netD = netD.to(device)
     net_y2h = net_y2h.to(device)
     net_y2h.eval()
+    if distributed:
+        # the BatchNorms of the unconditional branch of the generator blocks get no gradients
+        netG = torch.nn.parallel.DistributedDataParallel(getattr(netG, 'module', netG), find_unused_parameters=True)
+        netD = torch.nn.parallel.DistributedDataParallel(getattr(netD, 'module', netD))
+    # forward passes through the unwrapped nets do not all-reduce gradients or broadcast buffers
+    netG_local = netG.module if distributed else netG
+    netD_local = netD.module if distributed else netD
 
     optimizerG = torch.optim.Adam(netG.parameters(), lr=lr_g, betas=(0.5, 0.999))
     optimizerD = torch.optim.Adam(netD.parameters(), lr=lr_d, betas=(0.5, 0.999))
-
-    if save_models_folder is not None and resume_niters>0:
-        save_file = save_models_folder + "/CcGAN_{}_checkpoint_intrain/CcGAN_checkpoint_niters_{}.pth".format(threshold_type, resume_niters)
-        checkpoint = torch.load(save_file)
-        netG.load_state_dict(checkpoint['netG_state_dict'])
-        netD.load_state_dict(checkpoint['netD_state_dict'])
+    # separate scalers, since the losses of G and D have different scales
+    scalerG = make_grad_scaler(device, amp_dtype)
+    scalerD = make_grad_scaler(device, amp_dtype)
+
+    ## checkpoints are written in the background by rank 0; with ckpt_keep_last>0 only the last ckpt_keep_last ones and the milestones are kept
+    ckpt_manager = None
+    start_niter = resume_niters
+    if save_models_folder is not None:
+        ckpt_manager = CheckpointManager(save_models_folder + "/CcGAN_{}_checkpoint_intrain".format(threshold_type), "CcGAN_checkpoint_niters_{}.pth", keep_last=ckpt_keep_last, milestone_freq=ckpt_milestone_freq, milestones=[niters], read_only=(rank != 0))
+        if start_niter<0: #resume from the latest checkpoint
+            start_niter = ckpt_manager.latest() or 0
+    start_niter = max(start_niter, 0)
+
+    if ckpt_manager is not None and start_niter>0:
+        checkpoint = ckpt_manager.load(start_niter, map_location="cpu") #tensors are copied to the devices of the nets and optimizers
+        load_net_state_dict(netG, checkpoint['netG_state_dict'])
+        load_net_state_dict(netD, checkpoint['netD_state_dict'])
         optimizerG.load_state_dict(checkpoint['optimizerG_state_dict'])
         optimizerD.load_state_dict(checkpoint['optimizerD_state_dict'])
+        load_grad_scaler_state_dict(scalerG, checkpoint, 'scalerG_state_dict')
+        load_grad_scaler_state_dict(scalerD, checkpoint, 'scalerD_state_dict')
         torch.set_rng_state(checkpoint['rng_state'])
     #end if
 
+    sampler_rng = None
+    if distributed:
+        # each rank draws its own noise and vicinal batches; reseeded at resumption, since the rng state of
+        # a checkpoint is the one of rank 0
+        torch.manual_seed(rank_seed(seed, rank, start_niter))
+        sampler_rng = np.random.RandomState(rank_seed(seed, rank, start_niter))
+
+    ## forward passes and losses of the D and G steps; captured as graphs with static shapes if compile_steps
+    if compile_steps:
+        set_compile_cache_dir(compile_cache_dir)
+    D_loss_step = CompiledStep(CcGAN_D_loss, "D step", enabled=compile_steps)
+    G_loss_step = CompiledStep(CcGAN_G_loss, "G step", enabled=compile_steps)
+
     #################
-    unique_train_labels = np.sort(np.array(list(set(train_labels))))
+    ## draws target labels, real images in their vicinities and fake labels for a whole batch
+    if sampler is None:
+        sampler = VicinalBatchSampler(train_labels, kernel_sigma, kappa, threshold_type=threshold_type, nonzero_soft_weight_threshold=nonzero_soft_weight_threshold, clip_label=clip_label, rng=sampler_rng)
+    elif distributed:
+        sampler.rng = sampler_rng
+
+    ## keep all unnormalized training images as one uint8 tensor on the device
+    if not isinstance(train_images, IMGs_store):
+        train_images_store = IMGs_store(train_images, device=device, pin_memory=not distributed)
+    else:
+        train_images_store = train_images
+    assert train_images_store.images.max().item()>1
 
     # printed images with labels between the 5-th quantile and 95-th quantile of training labels
     n_row=10; n_col = n_row
@@ -69,201 +142,227 @@ def train_CcGAN(kernel_sigma, kappa, train_images, train_labels, netG, netD, net
         curr_label = selected_labels[i]
         for j in range(n_col):
             y_fixed[i*n_col+j] = curr_label
-    print(y_fixed)
+    if rank == 0:
+        print(y_fixed)
     y_fixed = torch.from_numpy(y_fixed).type(torch.float).view(-1,1).to(device)
 
 
+    ## per-step tensors, preallocated and reused: the labels of a step go to the device in one non-blocking copy,
+    ## the noise is drawn in place on the device, and the losses are only read back when printed
+    label_buffer = HostToDeviceBuffer([batch_size_max, batch_size_disc, batch_size_disc], device)
+    z_disc = torch.empty(batch_size_disc, dim_gan, dtype=torch.float, device=device)
+    z_gene = torch.empty(batch_size_gene, dim_gan, dtype=torch.float, device=device)
+    ones_disc = torch.ones(batch_size_disc, dtype=torch.float, device=device)
+    loss_meter = LossMeter(['D loss', 'G loss', 'real out', 'fake out'], device)
+    timer = SectionTimer()
+
     start_time = timeit.default_timer()
-    for niter in range(resume_niters, niters):
+    for niter in range(start_niter, niters):
 
         '''  Train Discriminator   '''
-        ## randomly draw batch_size_disc y's from unique_train_labels
-        batch_target_labels_in_dataset = np.random.choice(unique_train_labels, size=batch_size_max, replace=True)
-        ## add Gaussian noise; we estimate image distribution conditional on these labels
-        batch_epsilons = np.random.normal(0, kernel_sigma, batch_size_max)
-        batch_target_labels_with_epsilon = batch_target_labels_in_dataset + batch_epsilons
-        if clip_label:
-            batch_target_labels_with_epsilon = np.clip(batch_target_labels_with_epsilon, 0.0, 1.0)
-
-        batch_target_labels = batch_target_labels_with_epsilon[0:batch_size_disc]
-
-        ## find index of real images with labels in the vicinity of batch_target_labels
-        ## generate labels for fake image generation; these labels are also in the vicinity of batch_target_labels
-        batch_real_indx = np.zeros(batch_size_disc, dtype=int) #index of images in the datata; the labels of these images are in the vicinity
-        batch_fake_labels = np.zeros(batch_size_disc)
-
-        for j in range(batch_size_disc):
-            ## index for real images
-            if threshold_type == "hard":
-                indx_real_in_vicinity = np.where(np.abs(train_labels-batch_target_labels[j])<= kappa)[0]
+        with timer.section('data'):
+            ## randomly draw batch_size_max target labels, find real images in their vicinities
+            ## and generate labels for fake image generation which are also in the vicinities
+            batch_target_labels_with_epsilon, batch_real_indx, batch_fake_labels = sampler.sample(batch_size_disc, batch_size_gene)
+
+            ## draw the real image batch from the training set; normalized to [-1,1] on the device
+            batch_real_images = train_images_store.get_batch(batch_real_indx, device=device)
+
+            ## target, real and fake labels on the device
+            batch_target_labels_with_epsilon, batch_real_labels, batch_fake_labels = label_buffer.copy(batch_target_labels_with_epsilon, train_labels[batch_real_indx], batch_fake_labels)
+            batch_target_labels = batch_target_labels_with_epsilon[0:batch_size_disc]
+
+            ## weight vector
+            if threshold_type == "soft":
+                real_weights = torch.exp(-kappa*(batch_real_labels-batch_target_labels)**2)
+                fake_weights = torch.exp(-kappa*(batch_fake_labels-batch_target_labels)**2)
             else:
-                # reverse the weight function for SVDL
-                indx_real_in_vicinity = np.where((train_labels-batch_target_labels[j])**2 <= -np.log(nonzero_soft_weight_threshold)/kappa)[0]
-
-            ## if the max gap between two consecutive ordered unique labels is large, it is possible that len(indx_real_in_vicinity)<1
-            while len(indx_real_in_vicinity)<1:
-                batch_epsilons_j = np.random.normal(0, kernel_sigma, 1)
-                batch_target_labels[j] = batch_target_labels_in_dataset[j] + batch_epsilons_j
-                if clip_label:
-                    batch_target_labels = np.clip(batch_target_labels, 0.0, 1.0)
-                ## index for real images
-                if threshold_type == "hard":
-                    indx_real_in_vicinity = np.where(np.abs(train_labels-batch_target_labels[j])<= kappa)[0]
-                else:
-                    # reverse the weight function for SVDL
-                    indx_real_in_vicinity = np.where((train_labels-batch_target_labels[j])**2 <= -np.log(nonzero_soft_weight_threshold)/kappa)[0]
-            #end while len(indx_real_in_vicinity)<1
-
-            assert len(indx_real_in_vicinity)>=1
-
-            batch_real_indx[j] = np.random.choice(indx_real_in_vicinity, size=1)[0]
-
-            ## labels for fake images generation
-            if threshold_type == "hard":
-                lb = batch_target_labels[j] - kappa
-                ub = batch_target_labels[j] + kappa
-            else:
-                lb = batch_target_labels[j] - np.sqrt(-np.log(nonzero_soft_weight_threshold)/kappa)
-                ub = batch_target_labels[j] + np.sqrt(-np.log(nonzero_soft_weight_threshold)/kappa)
-            lb = max(0.0, lb); ub = min(ub, 1.0)
-            assert lb<=ub
-            assert lb>=0 and ub>=0
-            assert lb<=1 and ub<=1
-            batch_fake_labels[j] = np.random.uniform(lb, ub, size=1)[0]
-        #end for j
-
-        ## draw the real image batch from the training set
-        batch_real_images = train_images[batch_real_indx]
-        assert batch_real_images.max()>1
-        batch_real_labels = train_labels[batch_real_indx]
-        batch_real_labels = torch.from_numpy(batch_real_labels).type(torch.float).to(device)
-
-
-        ## normalize real images
-        trainset = IMGs_dataset(batch_real_images, labels=None, normalize=True)
-        train_dataloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size_disc, shuffle=False, num_workers=0)
-        train_dataloader = iter(train_dataloader)
-        batch_real_images = train_dataloader.next()
-        assert len(batch_real_images) == batch_size_disc
-        batch_real_images = batch_real_images.type(torch.float).to(device)
-        assert batch_real_images.max().item()<=1
-
-
-        ## generate the fake image batch
-        batch_fake_labels = torch.from_numpy(batch_fake_labels).type(torch.float).to(device)
-        z = torch.randn(batch_size_disc, dim_gan, dtype=torch.float).to(device)
-        batch_fake_images = netG(z, net_y2h(batch_fake_labels))
-
-        ## target labels on gpu
-        batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(device)
-
-        ## weight vector
-        if threshold_type == "soft":
-            real_weights = torch.exp(-kappa*(batch_real_labels-batch_target_labels)**2).to(device)
-            fake_weights = torch.exp(-kappa*(batch_fake_labels-batch_target_labels)**2).to(device)
-        else:
-            real_weights = torch.ones(batch_size_disc, dtype=torch.float).to(device)
-            fake_weights = torch.ones(batch_size_disc, dtype=torch.float).to(device)
-        #end if threshold type
-
-        # forward pass
-        real_dis_out = netD(batch_real_images, net_y2h(batch_target_labels))
-        fake_dis_out = netD(batch_fake_images.detach(), net_y2h(batch_target_labels))
-
-        if loss_type == "vanilla":
-            real_dis_out = torch.nn.Sigmoid()(real_dis_out)
-            fake_dis_out = torch.nn.Sigmoid()(fake_dis_out)
-            d_loss_real = - torch.log(real_dis_out+1e-20)
-            d_loss_fake = - torch.log(1-fake_dis_out+1e-20)
-        elif loss_type == "hinge":
-            d_loss_real = torch.nn.ReLU()(1.0 - real_dis_out)
-            d_loss_fake = torch.nn.ReLU()(1.0 + fake_dis_out)
+                real_weights = fake_weights = ones_disc
+            #end if threshold type
 
-        d_loss = torch.mean(real_weights.view(-1) * d_loss_real.view(-1)) + torch.mean(fake_weights.view(-1) * d_loss_fake.view(-1))
+        with timer.section('D step'):
+            # forward pass: generate the fake image batch and score both batches
+            z_disc.normal_()
+            d_loss, real_dis_out, fake_dis_out = D_loss_step(netG_local, netD, net_y2h, z_disc, batch_fake_labels, batch_real_images, batch_target_labels, real_weights, fake_weights, loss_type=loss_type, amp_dtype=amp_dtype)
 
-        optimizerD.zero_grad()
-        d_loss.backward()
-        optimizerD.step()
+            optimizerD.zero_grad()
+            scalerD.scale(d_loss).backward()
+            scalerD.step(optimizerD)
+            scalerD.update()
 
 
         '''  Train Generator   '''
-        netG.train()
+        with timer.section('G step'):
+            netG.train()
 
-        # generate fake images
-        batch_target_labels = batch_target_labels_with_epsilon[0:batch_size_gene]
-        batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(device)
+            # generate fake images and score them
+            batch_target_labels = batch_target_labels_with_epsilon[0:batch_size_gene]
+            z_gene.normal_()
+            g_loss = G_loss_step(netG, netD_local, net_y2h, z_gene, batch_target_labels, loss_type=loss_type, amp_dtype=amp_dtype)
 
-        z = torch.randn(batch_size_gene, dim_gan, dtype=torch.float).to(device)
-        batch_fake_images = netG(z, net_y2h(batch_target_labels))
+            # backward
+            optimizerG.zero_grad()
+            scalerG.scale(g_loss).backward()
+            scalerG.step(optimizerG)
+            scalerG.update()
 
-        # loss
-        dis_out = netD(batch_fake_images, net_y2h(batch_target_labels))
         if loss_type == "vanilla":
-            dis_out = torch.nn.Sigmoid()(dis_out)
-            g_loss = - torch.mean(torch.log(dis_out+1e-20))
-        elif loss_type == "hinge":
-            g_loss = - dis_out.mean()
-
-        # backward
-        optimizerG.zero_grad()
-        g_loss.backward()
-        optimizerG.step()
-
-        # print loss
-        if (niter+1) % 20 == 0:
-            print ("CcGAN: [Iter %d/%d] [D loss: %.4e] [G loss: %.4e] [real prob: %.3f] [fake prob: %.3f] [Time: %.4f]" % (niter+1, niters, d_loss.item(), g_loss.item(), real_dis_out.mean().item(), fake_dis_out.mean().item(), timeit.default_timer()-start_time))
-
-        if (niter+1) % 100 == 0:
-            netG.eval()
+            real_dis_out, fake_dis_out = torch.sigmoid(real_dis_out), torch.sigmoid(fake_dis_out)
+        loss_meter.update(d_loss, g_loss, real_dis_out.mean(), fake_dis_out.mean())
+
+        # print the mean losses (of rank 0) since the last print
+        if rank == 0 and (niter+1) % 20 == 0:
+            losses = loss_meter.read()
+            print ("CcGAN: [Iter %d/%d] [D loss: %.4e] [G loss: %.4e] [real prob: %.3f] [fake prob: %.3f] [Time: %.4f] %s" % (niter+1, niters, losses['D loss'], losses['G loss'], losses['real out'], losses['fake out'], timeit.default_timer()-start_time, timer.report()))
+
+        if rank == 0 and (niter+1) % 100 == 0:
+            netG_local.eval()
             with torch.no_grad():
-                gen_imgs = netG(z_fixed, net_y2h(y_fixed))
+                gen_imgs = netG_local(z_fixed, net_y2h(y_fixed))
                 gen_imgs = gen_imgs.detach().cpu()
                 save_image(gen_imgs.data, save_images_folder + '/{}.png'.format(niter+1), nrow=n_row, normalize=True)
 
-        if save_models_folder is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
-            save_file = save_models_folder + "/CcGAN_{}_checkpoint_intrain/CcGAN_checkpoint_niters_{}.pth".format(threshold_type, niter+1)
-            os.makedirs(os.path.dirname(save_file), exist_ok=True)
-            torch.save({
-                    'netG_state_dict': netG.state_dict(),
-                    'netD_state_dict': netD.state_dict(),
+        if rank == 0 and ckpt_manager is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
+            ckpt_manager.save(niter+1, {
+                    'netG_state_dict': netG_local.state_dict(),
+                    'netD_state_dict': netD_local.state_dict(),
                     'optimizerG_state_dict': optimizerG.state_dict(),
                     'optimizerD_state_dict': optimizerD.state_dict(),
+                    'scalerG_state_dict': scalerG.state_dict(),
+                    'scalerD_state_dict': scalerD.state_dict(),
                     'rng_state': torch.get_rng_state()
-            }, save_file)
+            })
     #end for niter
+    if ckpt_manager is not None:
+        ckpt_manager.close() #wait for the last checkpoints
+    return netG_local, netD_local
+
+
+################################################################################
+# multi-process training on CPU hosts: one spawned process per rank, gradients all-reduced by DDP over gloo
+def rank_seed(seed, rank, niter=0):
+    '''
+    reproducible seed of a rank; distinct across ranks and across resumptions
+    '''
+    return int(np.random.SeedSequence([seed, rank, niter]).generate_state(1)[0])
+
+
+def _train_CcGAN_rank(rank, world_size, num_threads, result_file, kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder, clip_label, sampler, batch_size_disc, batch_size_gene):
+    torch.set_num_threads(num_threads)
+    # the weights arrive in shared memory; each rank updates its own copy
+    netG, netD = copy.deepcopy(netG), copy.deepcopy(netD)
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(ddp_master_port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        netG, netD = train_CcGAN(kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder = save_models_folder, clip_label = clip_label, sampler = sampler, batch_size_disc = batch_size_disc, batch_size_gene = batch_size_gene)
+        if rank == 0:
+            torch.save({
+                    'netG_state_dict': netG.state_dict(),
+                    'netD_state_dict': netD.state_dict(),
+            }, result_file)
+    finally:
+        dist.destroy_process_group()
+
+
+def train_CcGAN_ddp(kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder = None, clip_label=False, sampler=None, batch_size_disc=None, batch_size_gene=None):
+    '''
+    train_CcGAN with ddp_world_size processes on this host, on CPU
+    the processes are spawned, not forked, since forking after the OpenMP threads of torch have started may
+    deadlock the children; the training images and the nets are passed in shared memory. Each rank trains on
+    1/ddp_world_size of the batches of a step, drawn by its own rank-seeded vicinal sampler, and the gradients
+    are averaged over the ranks by DDP; only rank 0 writes images and checkpoints
+    batch_size_disc, batch_size_gene: batch sizes of a step of all ranks; if None, args.batch_size_disc and args.batch_size_gene
+    return: netG, netD with the trained weights
+    '''
+    batch_size_disc = args.batch_size_disc if batch_size_disc is None else batch_size_disc
+    batch_size_gene = args.batch_size_gene if batch_size_gene is None else batch_size_gene
+    if device.type == "cuda":
+        raise Exception('multi-process training (gan_ddp_world_size>1) is for CPU hosts!!!')
+    if batch_size_disc % ddp_world_size != 0 or batch_size_gene % ddp_world_size != 0:
+        raise Exception('batch_size_disc and batch_size_gene must be divisible by gan_ddp_world_size!!!')
+    # split the cores of the host among the ranks
+    num_threads = ddp_num_threads if ddp_num_threads>0 else max(1, torch.get_num_threads()//ddp_world_size)
+    print("\n Training CcGAN with {} processes of {} threads >>>".format(ddp_world_size, num_threads))
+
+    # a tensor store is shared with the ranks; a numpy array would be copied into each of them
+    if not isinstance(train_images, IMGs_store):
+        train_images = IMGs_store(train_images, device="cpu", pin_memory=False)
+    if sampler is not None:
+        # each rank reseeds its copy of the sampler (see train_CcGAN)
+        sampler = copy.copy(sampler)
+        sampler.rng = None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'CcGAN_ddp_result.pth')
+        torch.multiprocessing.start_processes(_train_CcGAN_rank, args=(ddp_world_size, num_threads, result_file, kernel_sigma, kappa, train_images, train_labels, netG, netD, net_y2h, save_images_folder, save_models_folder, clip_label, sampler, batch_size_disc//ddp_world_size, batch_size_gene//ddp_world_size), nprocs=ddp_world_size, join=True, start_method='spawn')
+        result = torch.load(result_file, map_location="cpu")
+    load_net_state_dict(netG, result['netG_state_dict'])
+    load_net_state_dict(netD, result['netD_state_dict'])
     return netG, netD
 
 
-def SampCcGAN_given_label(netG, net_y2h, label, path=None, NFAKE = 10000, batch_size = 500):
+def SampCcGAN_given_labels_iter(netG, net_y2h, labels, batch_size = 500, folded=True, bf16=False):
     '''
-    label: normalized label in [0,1]
+    generate one fake image for each label in labels batch by batch; a batch may mix labels
+    labels: normalized labels in [0,1]
+    folded: use the conditional BN parameters folded (and cached per label) by netG.fold_labels
+    bf16: use bf16 autocast on CPU
+    yield: batch_fake_images (in [-1,1], float32, on the device), batch_labels
     '''
-    if batch_size>NFAKE:
-        batch_size = NFAKE
-    fake_images = np.zeros((NFAKE+batch_size, NC, IMG_SIZE, IMG_SIZE), dtype=np.float)
-    netG=netG.to(device)
+    labels = np.asarray(labels).reshape(-1)
+    # labels are folded and cached on the caller's net, which outlives the copy prepare_inference_net may return
     netG.eval()
+    netG_fold = getattr(netG, 'module', netG)
+    netG = prepare_inference_net(netG, device)
+    net_y2h.eval()
+
+    for tmp in range(0, len(labels), batch_size):
+        batch_labels = labels[tmp:(tmp+batch_size)]
+        with inference_context(device, bf16=bf16):
+            if folded:
+                y = netG_fold.fold_labels(batch_labels, net_y2h)
+            else:
+                y = torch.from_numpy(batch_labels).type(torch.float).view(-1,1).to(device)
+                y = net_y2h(y)
+            z = torch.randn(len(batch_labels), dim_gan, dtype=torch.float).to(device)
+            batch_fake_images = netG(z, y, folded=folded).type(torch.float)
+        yield batch_fake_images, batch_labels
+
+
+def SampCcGAN_given_labels(netG, net_y2h, labels, batch_size = 500, to_uint8 = False, folded=True, bf16=False):
+    '''
+    generate one fake image for each label in labels; a batch may mix labels
+    labels: normalized labels in [0,1]
+    to_uint8: return images in [0,255] as uint8 instead of float32 images in [-1,1]
+    '''
+    labels = np.asarray(labels).reshape(-1)
+    NFAKE = len(labels)
+    fake_images = np.empty((NFAKE, NC, IMG_SIZE, IMG_SIZE), dtype=np.uint8 if to_uint8 else np.float32)
 
-    with torch.no_grad():
-        tmp = 0
-        while tmp < NFAKE:
-            z = torch.randn(batch_size, dim_gan, dtype=torch.float).to(device)
-            y = np.ones(batch_size) * label
-            y = torch.from_numpy(y).type(torch.float).view(-1,1).to(device)
-            batch_fake_images = netG(z, net_y2h(y))
-            fake_images[tmp:(tmp+batch_size)] = batch_fake_images.cpu().detach().numpy()
-            tmp += batch_size
+    tmp = 0
+    for batch_fake_images, _ in SampCcGAN_given_labels_iter(netG, net_y2h, labels, batch_size = batch_size, folded = folded, bf16 = bf16):
+        if to_uint8:
+            batch_fake_images = (batch_fake_images*127.5+127.5).clamp_(0, 255).type(torch.uint8)
+        fake_images[tmp:(tmp+len(batch_fake_images))] = batch_fake_images.cpu().numpy()
+        tmp += len(batch_fake_images)
 
-    #remove extra entries
-    fake_images = fake_images[0:NFAKE]
-    fake_labels = np.ones(NFAKE) * label #use assigned label
+    return fake_images, labels
+
+
+def SampCcGAN_given_label(netG, net_y2h, label, path=None, NFAKE = 10000, batch_size = 500, folded=True):
+    '''
+    label: normalized label in [0,1]
+    '''
+    fake_images, fake_labels = SampCcGAN_given_labels(netG, net_y2h, np.ones(NFAKE) * label, batch_size = batch_size, folded = folded)
 
     if path is not None:
         raw_fake_images = (fake_images*0.5+0.5)*255.0
         raw_fake_images = raw_fake_images.astype(np.uint8)
-        for i in range(NFAKE):
-            filename = path + '/' + str(i) + '.jpg'
-            im = Image.fromarray(raw_fake_images[i][0], mode='L')
-            im = im.save(filename)
+        # the first channel as grayscale jpgs, encoded by a pool of threads
+        with FakeImageDumpWriter(path, fmt='jpg', filename_fmt='{i}.jpg') as writer:
+            for tmp in range(0, NFAKE, batch_size):
+                writer.write(raw_fake_images[tmp:(tmp+batch_size), 0:1], fake_labels[tmp:(tmp+batch_size)], tmp)
 
     return fake_images, fake_labels
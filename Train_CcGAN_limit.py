@@ -8,11 +8,13 @@ import timeit
 
 from utils import *
 from opts import parse_opts
+from checkpoint_utils import CheckpointManager
 
 ''' Settings '''
 args = parse_opts()
 NGPU = torch.cuda.device_count()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+amp_dtype = get_amp_dtype(args.gan_amp, device) #None: fp32
 
 # some parameters in opts
 niters = args.niters_gan
@@ -21,6 +23,8 @@ dim_gan = args.dim_gan
 lr_g = args.lr_g_gan
 lr_d = args.lr_d_gan
 save_niters_freq = args.save_niters_freq
+ckpt_keep_last = args.ckpt_keep_last
+ckpt_milestone_freq = args.ckpt_milestone_freq
 batch_size = min(args.batch_size_disc, args.batch_size_gene)
 num_classes = args.cGAN_num_classes
 
@@ -33,21 +37,34 @@ def train_CcGAN_limit(images, labels, netG, netD, save_images_folder, save_model
     netG = netG.to(device)
     netD = netD.to(device)
 
-    criterion = nn.BCELoss()
+    criterion = nn.BCEWithLogitsLoss() #the discriminator outputs logits; also stable under autocast
     optimizerG = torch.optim.Adam(netG.parameters(), lr=lr_g, betas=(0.5, 0.999))
     optimizerD = torch.optim.Adam(netD.parameters(), lr=lr_d, betas=(0.5, 0.999))
+    # separate scalers, since the losses of G and D have different scales
+    scalerG = make_grad_scaler(device, amp_dtype)
+    scalerD = make_grad_scaler(device, amp_dtype)
 
-    trainset = IMGs_dataset(images, labels, normalize=True)
-    train_dataloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=8)
+    trainset = IMGs_dataset(images, labels, normalize=True, normalize_on_device=True)
+    train_dataloader = IMGs_batch_loader(trainset, batch_size=batch_size, shuffle=True, num_workers=8, pin_memory=(device.type == "cuda"))
     unique_labels = np.sort(np.array(list(set(labels)))).astype(np.int)
 
-    if save_models_folder is not None and resume_niters>0:
-        save_file = save_models_folder + "/CcGAN_limit_checkpoint_intrain/CcGAN_limit_checkpoint_niters_{}.pth".format(resume_niters)
-        checkpoint = torch.load(save_file)
-        netG.load_state_dict(checkpoint['netG_state_dict'])
-        netD.load_state_dict(checkpoint['netD_state_dict'])
+    ## checkpoints are written in the background; with ckpt_keep_last>0 only the last ckpt_keep_last ones and the milestones are kept
+    ckpt_manager = None
+    start_niter = resume_niters
+    if save_models_folder is not None:
+        ckpt_manager = CheckpointManager(save_models_folder + "/CcGAN_limit_checkpoint_intrain", "CcGAN_limit_checkpoint_niters_{}.pth", keep_last=ckpt_keep_last, milestone_freq=ckpt_milestone_freq, milestones=[niters])
+        if start_niter<0: #resume from the latest checkpoint
+            start_niter = ckpt_manager.latest() or 0
+    start_niter = max(start_niter, 0)
+
+    if ckpt_manager is not None and start_niter>0:
+        checkpoint = ckpt_manager.load(start_niter, map_location="cpu") #tensors are copied to the devices of the nets and optimizers
+        load_net_state_dict(netG, checkpoint['netG_state_dict'])
+        load_net_state_dict(netD, checkpoint['netD_state_dict'])
         optimizerG.load_state_dict(checkpoint['optimizerG_state_dict'])
         optimizerD.load_state_dict(checkpoint['optimizerD_state_dict'])
+        load_grad_scaler_state_dict(scalerG, checkpoint, 'scalerG_state_dict')
+        load_grad_scaler_state_dict(scalerD, checkpoint, 'scalerD_state_dict')
         torch.set_rng_state(checkpoint['rng_state'])
     #end if
 
@@ -69,45 +86,54 @@ def train_CcGAN_limit(images, labels, netG, netD, save_images_folder, save_model
     batch_idx = 0
     dataloader_iter = iter(train_dataloader)
 
-    start_time = timeit.default_timer()
-    for niter in range(resume_niters, niters):
+    ## preallocated per-step tensors; the losses are only read back when printed
+    z = torch.empty(batch_size, dim_gan, dtype=torch.float, device=device)
+    # Adversarial ground truths
+    GAN_real = torch.ones(batch_size,1).to(device)
+    GAN_fake = torch.zeros(batch_size,1).to(device)
+    loss_meter = LossMeter(['D loss', 'G loss', 'real prob', 'fake prob'], device)
+    timer = SectionTimer()
 
-        if batch_idx+1 == len(train_dataloader):
-            dataloader_iter = iter(train_dataloader)
-            batch_idx = 0
+    start_time = timeit.default_timer()
+    for niter in range(start_niter, niters):
 
-        # training images
-        batch_train_images, batch_train_labels = dataloader_iter.next()
-        assert batch_size == batch_train_images.shape[0]
-        batch_train_images = batch_train_images.type(torch.float).to(device)
-        batch_train_labels = batch_train_labels.type(torch.float).to(device)
+        with timer.section('data'):
+            if batch_idx+1 == len(train_dataloader):
+                dataloader_iter = iter(train_dataloader)
+                batch_idx = 0
 
-        # Adversarial ground truths
-        GAN_real = torch.ones(batch_size,1).to(device)
-        GAN_fake = torch.zeros(batch_size,1).to(device)
+            # training images
+            batch_train_images, batch_train_labels = next(dataloader_iter)
+            assert batch_size == batch_train_images.shape[0]
+            batch_train_images = images_to_device(batch_train_images, device, normalize=True)
+            batch_train_labels = batch_train_labels.to(device, non_blocking=True).type(torch.float)
 
         '''
 
         Train Generator: maximize log(D(G(z)))
 
         '''
-        netG.train()
+        with timer.section('G step'):
+            netG.train()
 
-        # Sample noise and labels as generator input
-        z = torch.randn(batch_size, dim_gan, dtype=torch.float).to(device)
+            # Sample noise and labels as generator input
+            z.normal_()
 
-        #generate fake images
-        batch_fake_images = netG(z, batch_train_labels)
+            #generate fake images
+            with amp_context(device, amp_dtype):
+                batch_fake_images = netG(z, batch_train_labels)
 
-        # Loss measures generator's ability to fool the discriminator
-        dis_out = netD(batch_fake_images, batch_train_labels)
+                # Loss measures generator's ability to fool the discriminator
+                dis_out = netD(batch_fake_images, batch_train_labels)
+            dis_out = dis_out.float()
 
-        #generator try to let disc believe gen_imgs are real
-        g_loss = criterion(dis_out, GAN_real)
+            #generator try to let disc believe gen_imgs are real
+            g_loss = criterion(dis_out, GAN_real)
 
-        optimizerG.zero_grad()
-        g_loss.backward()
-        optimizerG.step()
+            optimizerG.zero_grad()
+            scalerG.scale(g_loss).backward()
+            scalerG.step(optimizerG)
+            scalerG.update()
 
         '''
 
@@ -115,21 +141,29 @@ def train_CcGAN_limit(images, labels, netG, netD, save_images_folder, save_model
 
         '''
 
-        # Measure discriminator's ability to classify real from generated samples
-        prob_real = netD(batch_train_images, batch_train_labels)
-        prob_fake = netD(batch_fake_images.detach(), batch_train_labels.detach())
-        real_loss = criterion(prob_real, GAN_real)
-        fake_loss = criterion(prob_fake, GAN_fake)
-        d_loss = (real_loss + fake_loss) / 2
-
-        optimizerD.zero_grad()
-        d_loss.backward()
-        optimizerD.step()
+        with timer.section('D step'):
+            # Measure discriminator's ability to classify real from generated samples
+            with amp_context(device, amp_dtype):
+                logits_real = netD(batch_train_images, batch_train_labels)
+                logits_fake = netD(batch_fake_images.detach(), batch_train_labels.detach())
+            logits_real, logits_fake = logits_real.float(), logits_fake.float()
+            real_loss = criterion(logits_real, GAN_real)
+            fake_loss = criterion(logits_fake, GAN_fake)
+            d_loss = (real_loss + fake_loss) / 2
+
+            optimizerD.zero_grad()
+            scalerD.scale(d_loss).backward()
+            scalerD.step(optimizerD)
+            scalerD.update()
 
         batch_idx+=1
 
+        loss_meter.update(d_loss, g_loss, torch.sigmoid(logits_real).mean(), torch.sigmoid(logits_fake).mean())
+
+        # the mean losses since the last print
         if (niter+1)%20 == 0:
-            print ("CcGAN limit: [Iter %d/%d] [D loss: %.4f] [G loss: %.4f] [D prob real:%.4f] [D prob fake:%.4f] [Time: %.4f]" % (niter+1, niters, d_loss.item(), g_loss.item(), prob_real.mean().item(),prob_fake.mean().item(), timeit.default_timer()-start_time))
+            losses = loss_meter.read()
+            print ("CcGAN limit: [Iter %d/%d] [D loss: %.4f] [G loss: %.4f] [D prob real:%.4f] [D prob fake:%.4f] [Time: %.4f] %s" % (niter+1, niters, losses['D loss'], losses['G loss'], losses['real prob'], losses['fake prob'], timeit.default_timer()-start_time, timer.report()))
 
 
         if (niter+1) % 100 == 0:
@@ -139,17 +173,19 @@ def train_CcGAN_limit(images, labels, netG, netD, save_images_folder, save_model
                 gen_imgs = gen_imgs.detach()
             save_image(gen_imgs.data, save_images_folder +'/{}.png'.format(niter+1), nrow=n_row, normalize=True)
 
-        if save_models_folder is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
-            save_file = save_models_folder + "/CcGAN_limit_checkpoint_intrain/CcGAN_limit_checkpoint_niters_{}.pth".format(niter+1)
-            os.makedirs(os.path.dirname(save_file), exist_ok=True)
-            torch.save({
+        if ckpt_manager is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
+            ckpt_manager.save(niter+1, {
                     'netG_state_dict': netG.state_dict(),
                     'netD_state_dict': netD.state_dict(),
                     'optimizerG_state_dict': optimizerG.state_dict(),
                     'optimizerD_state_dict': optimizerD.state_dict(),
+                    'scalerG_state_dict': scalerG.state_dict(),
+                    'scalerD_state_dict': scalerD.state_dict(),
                     'rng_state': torch.get_rng_state()
-            }, save_file)
+            })
     #end for niter
+    if ckpt_manager is not None:
+        ckpt_manager.close() #wait for the last checkpoints
 
 
     return netG, netD
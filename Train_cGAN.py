@@ -1,6 +1,7 @@
 
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 from torchvision.utils import save_image
 import numpy as np
 import os
@@ -8,11 +9,13 @@ import timeit
 
 from utils import *
 from opts import parse_opts
+from checkpoint_utils import CheckpointManager
 
 ''' Settings '''
 args = parse_opts()
 NGPU = torch.cuda.device_count()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+amp_dtype = get_amp_dtype(args.gan_amp, device) #None: fp32
 
 # some parameters in opts
 loss_type = args.loss_type_gan
@@ -22,6 +25,8 @@ dim_gan = args.dim_gan
 lr_g = args.lr_g_gan
 lr_d = args.lr_d_gan
 save_niters_freq = args.save_niters_freq
+ckpt_keep_last = args.ckpt_keep_last
+ckpt_milestone_freq = args.ckpt_milestone_freq
 batch_size = min(args.batch_size_disc, args.batch_size_gene)
 num_classes = args.cGAN_num_classes
 
@@ -36,18 +41,31 @@ def train_cGAN(images, labels, netG, netD, save_images_folder, save_models_folde
 
     optimizerG = torch.optim.Adam(netG.parameters(), lr=lr_g, betas=(0.5, 0.999))
     optimizerD = torch.optim.Adam(netD.parameters(), lr=lr_d, betas=(0.5, 0.999))
+    # separate scalers, since the losses of G and D have different scales
+    scalerG = make_grad_scaler(device, amp_dtype)
+    scalerD = make_grad_scaler(device, amp_dtype)
 
-    trainset = IMGs_dataset(images, labels, normalize=True)
-    train_dataloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=8)
+    trainset = IMGs_dataset(images, labels, normalize=True, normalize_on_device=True)
+    train_dataloader = IMGs_batch_loader(trainset, batch_size=batch_size, shuffle=True, num_workers=8, pin_memory=(device.type == "cuda"))
     unique_labels = np.sort(np.array(list(set(labels)))).astype(np.int32)
 
-    if save_models_folder is not None and resume_niters>0:
-        save_file = save_models_folder + "/cGAN_checkpoint_intrain/cGAN_checkpoint_niters_{}.pth".format(resume_niters)
-        checkpoint = torch.load(save_file)
-        netG.load_state_dict(checkpoint['netG_state_dict'])
-        netD.load_state_dict(checkpoint['netD_state_dict'])
+    ## checkpoints are written in the background; with ckpt_keep_last>0 only the last ckpt_keep_last ones and the milestones are kept
+    ckpt_manager = None
+    start_niter = resume_niters
+    if save_models_folder is not None:
+        ckpt_manager = CheckpointManager(save_models_folder + "/cGAN_checkpoint_intrain", "cGAN_checkpoint_niters_{}.pth", keep_last=ckpt_keep_last, milestone_freq=ckpt_milestone_freq, milestones=[niters])
+        if start_niter<0: #resume from the latest checkpoint
+            start_niter = ckpt_manager.latest() or 0
+    start_niter = max(start_niter, 0)
+
+    if ckpt_manager is not None and start_niter>0:
+        checkpoint = ckpt_manager.load(start_niter, map_location="cpu") #tensors are copied to the devices of the nets and optimizers
+        load_net_state_dict(netG, checkpoint['netG_state_dict'])
+        load_net_state_dict(netD, checkpoint['netD_state_dict'])
         optimizerG.load_state_dict(checkpoint['optimizerG_state_dict'])
         optimizerD.load_state_dict(checkpoint['optimizerD_state_dict'])
+        load_grad_scaler_state_dict(scalerG, checkpoint, 'scalerG_state_dict')
+        load_grad_scaler_state_dict(scalerD, checkpoint, 'scalerD_state_dict')
         torch.set_rng_state(checkpoint['rng_state'])
     #end if
 
@@ -70,18 +88,24 @@ def train_cGAN(images, labels, netG, netD, save_images_folder, save_models_folde
     batch_idx = 0
     dataloader_iter = iter(train_dataloader)
 
+    ## preallocated noise drawn in place on the device; the losses are only read back when printed
+    z = torch.empty(batch_size, dim_gan, dtype=torch.float, device=device)
+    loss_meter = LossMeter(['D loss', 'G loss', 'real out', 'fake out'], device)
+    timer = SectionTimer()
+
     start_time = timeit.default_timer()
-    for niter in range(resume_niters, niters):
+    for niter in range(start_niter, niters):
 
-        if batch_idx+1 == len(train_dataloader):
-            dataloader_iter = iter(train_dataloader)
-            batch_idx = 0
+        with timer.section('data'):
+            if batch_idx+1 == len(train_dataloader):
+                dataloader_iter = iter(train_dataloader)
+                batch_idx = 0
 
-        # training images
-        batch_train_images, batch_train_labels = dataloader_iter.next()
-        assert batch_size == batch_train_images.shape[0]
-        batch_train_images = batch_train_images.type(torch.float).to(device)
-        batch_train_labels = batch_train_labels.type(torch.long).to(device)
+            # training images
+            batch_train_images, batch_train_labels = next(dataloader_iter)
+            assert batch_size == batch_train_images.shape[0]
+            batch_train_images = images_to_device(batch_train_images, device, normalize=True)
+            batch_train_labels = batch_train_labels.to(device, non_blocking=True).type(torch.long)
 
 
         '''
@@ -89,26 +113,29 @@ def train_cGAN(images, labels, netG, netD, save_images_folder, save_models_folde
         Train Generator: maximize log(D(G(z)))
 
         '''
-        netG.train()
+        with timer.section('G step'):
+            netG.train()
 
-        # Sample noise and labels as generator input
-        z = torch.randn(batch_size, dim_gan, dtype=torch.float).to(device)
+            # Sample noise and labels as generator input
+            z.normal_()
 
-        #generate fake images
-        batch_fake_images = netG(z, batch_train_labels)
+            #generate fake images
+            with amp_context(device, amp_dtype):
+                batch_fake_images = netG(z, batch_train_labels)
 
-        # Loss measures generator's ability to fool the discriminator
-        dis_out = netD(batch_fake_images, batch_train_labels)
+                # Loss measures generator's ability to fool the discriminator
+                dis_out = netD(batch_fake_images, batch_train_labels)
+            dis_out = dis_out.float()
 
-        if loss_type == "vanilla":
-            dis_out = torch.nn.Sigmoid()(dis_out)
-            g_loss = - torch.mean(torch.log(dis_out+1e-20))
-        elif loss_type == "hinge":
-            g_loss = - dis_out.mean()
+            if loss_type == "vanilla":
+                g_loss = torch.mean(F.softplus(-dis_out))
+            elif loss_type == "hinge":
+                g_loss = - dis_out.mean()
 
-        optimizerG.zero_grad()
-        g_loss.backward()
-        optimizerG.step()
+            optimizerG.zero_grad()
+            scalerG.scale(g_loss).backward()
+            scalerG.step(optimizerG)
+            scalerG.update()
 
         '''
 
@@ -116,27 +143,36 @@ def train_cGAN(images, labels, netG, netD, save_images_folder, save_models_folde
 
         '''
 
-        # Measure discriminator's ability to classify real from generated samples
-        real_dis_out = netD(batch_train_images, batch_train_labels)
-        fake_dis_out = netD(batch_fake_images.detach(), batch_train_labels.detach())
-        if loss_type == "vanilla":
-            real_dis_out = torch.nn.Sigmoid()(real_dis_out)
-            fake_dis_out = torch.nn.Sigmoid()(fake_dis_out)
-            d_loss_real = - torch.log(real_dis_out+1e-20)
-            d_loss_fake = - torch.log(1-fake_dis_out+1e-20)
-        elif loss_type == "hinge":
-            d_loss_real = torch.nn.ReLU()(1.0 - real_dis_out)
-            d_loss_fake = torch.nn.ReLU()(1.0 + fake_dis_out)
-        d_loss = (d_loss_real + d_loss_fake).mean()
-
-        optimizerD.zero_grad()
-        d_loss.backward()
-        optimizerD.step()
+        with timer.section('D step'):
+            # Measure discriminator's ability to classify real from generated samples
+            with amp_context(device, amp_dtype):
+                real_dis_out = netD(batch_train_images, batch_train_labels)
+                fake_dis_out = netD(batch_fake_images.detach(), batch_train_labels.detach())
+            real_dis_out, fake_dis_out = real_dis_out.float(), fake_dis_out.float()
+            if loss_type == "vanilla":
+                # -log(sigmoid(x)) = softplus(-x) and -log(1-sigmoid(x)) = softplus(x)
+                d_loss_real = F.softplus(-real_dis_out)
+                d_loss_fake = F.softplus(fake_dis_out)
+            elif loss_type == "hinge":
+                d_loss_real = torch.nn.ReLU()(1.0 - real_dis_out)
+                d_loss_fake = torch.nn.ReLU()(1.0 + fake_dis_out)
+            d_loss = (d_loss_real + d_loss_fake).mean()
+
+            optimizerD.zero_grad()
+            scalerD.scale(d_loss).backward()
+            scalerD.step(optimizerD)
+            scalerD.update()
 
         batch_idx+=1
 
+        if loss_type == "vanilla":
+            real_dis_out, fake_dis_out = torch.sigmoid(real_dis_out), torch.sigmoid(fake_dis_out)
+        loss_meter.update(d_loss, g_loss, real_dis_out.mean(), fake_dis_out.mean())
+
+        # the mean losses since the last print
         if (niter+1)%20 == 0:
-            print ("cGAN: [Iter %d/%d] [D loss: %.4f] [G loss: %.4f] [D out real:%.4f] [D out fake:%.4f] [Time: %.4f]" % (niter+1, niters, d_loss.item(), g_loss.item(), real_dis_out.mean().item(),fake_dis_out.mean().item(), timeit.default_timer()-start_time))
+            losses = loss_meter.read()
+            print ("cGAN: [Iter %d/%d] [D loss: %.4f] [G loss: %.4f] [D out real:%.4f] [D out fake:%.4f] [Time: %.4f] %s" % (niter+1, niters, losses['D loss'], losses['G loss'], losses['real out'], losses['fake out'], timeit.default_timer()-start_time, timer.report()))
 
 
         if (niter+1) % 100 == 0:
@@ -146,57 +182,72 @@ def train_cGAN(images, labels, netG, netD, save_images_folder, save_models_folde
                 gen_imgs = gen_imgs.detach()
             save_image(gen_imgs.data, save_images_folder +'/{}.png'.format(niter+1), nrow=n_row, normalize=True)
 
-        if save_models_folder is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
-            save_file = save_models_folder + "/cGAN_checkpoint_intrain/cGAN_checkpoint_niters_{}.pth".format(niter+1)
-            os.makedirs(os.path.dirname(save_file), exist_ok=True)
-            torch.save({
+        if ckpt_manager is not None and ((niter+1) % save_niters_freq == 0 or (niter+1) == niters):
+            ckpt_manager.save(niter+1, {
                     'netG_state_dict': netG.state_dict(),
                     'netD_state_dict': netD.state_dict(),
                     'optimizerG_state_dict': optimizerG.state_dict(),
                     'optimizerD_state_dict': optimizerD.state_dict(),
+                    'scalerG_state_dict': scalerG.state_dict(),
+                    'scalerD_state_dict': scalerD.state_dict(),
                     'rng_state': torch.get_rng_state()
-            }, save_file)
+            })
     #end for niter
+    if ckpt_manager is not None:
+        ckpt_manager.close() #wait for the last checkpoints
 
 
     return netG, netD
 
 
-def SampcGAN_given_label(netG, given_label, class_cutoff_points, NFAKE = 10000, batch_size = 500):
+def SampcGAN_given_labels_iter(netG, given_labels, class_cutoff_points, batch_size = 500, bf16 = False):
     '''
-    given_label: a scalar; raw label without any normalization; not class label
+    generate one fake image for each label in given_labels batch by batch; a batch may mix labels
+    given_labels: raw labels without any normalization; not class labels
     class_cutoff_points: the cutoff points to determine the membership of a give label
+    bf16: use bf16 autocast on CPU
+    yield: batch_fake_images (in [-1,1], float32, on the device), batch_given_labels
     '''
+    given_labels = np.asarray(given_labels).reshape(-1)
     class_cutoff_points = np.array(class_cutoff_points)
     num_classes = len(class_cutoff_points)-1
+    # the last cutoff point <= given label; the largest label belongs to the last class
+    given_class_labels = np.searchsorted(class_cutoff_points, given_labels, side='right') - 1
+    given_class_labels = np.clip(given_class_labels, 0, num_classes-1)
+    given_class_labels = torch.from_numpy(given_class_labels).type(torch.long).to(device)
+
+    netG = prepare_inference_net(netG, device)
+    for tmp in range(0, len(given_labels), batch_size):
+        labels = given_class_labels[tmp:(tmp+batch_size)]
+        with inference_context(device, bf16=bf16):
+            z = torch.randn(len(labels), dim_gan, dtype=torch.float).to(device)
+            batch_fake_images = netG(z, labels).type(torch.float)
+        yield batch_fake_images, given_labels[tmp:(tmp+batch_size)]
+
+
+def SampcGAN_given_labels(netG, given_labels, class_cutoff_points, batch_size = 500, to_uint8 = False, bf16 = False):
+    '''
+    generate one fake image for each label in given_labels; a batch may mix labels
+    given_labels: raw labels without any normalization; not class labels
+    to_uint8: return images in [0,255] as uint8 instead of float32 images in [-1,1]
+    '''
+    given_labels = np.asarray(given_labels).reshape(-1)
+    NFAKE = len(given_labels)
+    fake_images = np.empty((NFAKE, NC, IMG_SIZE, IMG_SIZE), dtype=np.uint8 if to_uint8 else np.float32)
+
+    tmp = 0
+    for batch_fake_images, _ in SampcGAN_given_labels_iter(netG, given_labels, class_cutoff_points, batch_size = batch_size, bf16 = bf16):
+        if to_uint8:
+            batch_fake_images = (batch_fake_images*127.5+127.5).clamp_(0, 255).type(torch.uint8)
+        fake_images[tmp:(tmp+len(batch_fake_images))] = batch_fake_images.cpu().numpy()
+        tmp += len(batch_fake_images)
+
+    return fake_images, given_labels
+
 
-    diff_tmp = class_cutoff_points - given_label
-    indx_nonneg = np.where(diff_tmp>=0)[0]
-    if len(indx_nonneg)==1: #the last element of diff_tmp is non-negative
-        given_class_label = num_classes-1
-        assert indx_nonneg[0] == num_classes
-    elif len(indx_nonneg)>1:
-        if diff_tmp[indx_nonneg[0]]>0:
-            given_class_label = indx_nonneg[0] - 1
-        else:
-            given_class_label = indx_nonneg[0]
-
-    if batch_size>NFAKE:
-        batch_size = NFAKE
-    fake_images = np.zeros((NFAKE+batch_size, NC, IMG_SIZE, IMG_SIZE))
-    netG=netG.to(device)
-    netG.eval()
-    with torch.no_grad():
-        tmp = 0
-        while tmp < NFAKE:
-            z = torch.randn(batch_size, dim_gan, dtype=torch.float).to(device)
-            labels = torch.from_numpy(given_class_label*np.ones(batch_size)).type(torch.long).to(device)
-            batch_fake_images = netG(z, labels)
-            fake_images[tmp:(tmp+batch_size)] = batch_fake_images.detach().cpu().numpy()
-            tmp += batch_size
-
-    #remove extra entries
-    fake_images = fake_images[0:NFAKE]
-    raw_fake_labels = np.ones(NFAKE) * given_label #use assigned label
-
-    return fake_images, raw_fake_labels
+def SampcGAN_given_label(netG, given_label, class_cutoff_points, NFAKE = 10000, batch_size = 500):
+    '''
+    given_label: a scalar; raw label without any normalization; not class label
+    class_cutoff_points: the cutoff points to determine the membership of a give label
+    '''
+    return SampcGAN_given_labels(netG, np.ones(NFAKE) * given_label, class_cutoff_points, batch_size = batch_size)
@@ -7,6 +7,8 @@ import os
 import timeit
 from PIL import Image
 
+from checkpoint_utils import CheckpointManager
+
 
 
 ###################################################################################
@@ -23,22 +25,34 @@ def adjust_learning_rate(optimizer, epoch, base_lr):
 
 
 #-------------------------------------------------------------
-def train_net_embed(trainloader, testloader, net, optimizer, epochs=200, base_lr=0.1, save_models_folder = None, resumeepoch = 0, device="cuda"):
+def train_net_embed(trainloader, testloader, net, optimizer, epochs=200, base_lr=0.1, save_models_folder = None, resumeepoch = 0, device="cuda", keep_last = 0):
+    '''
+    resumeepoch: epoch to resume from; -1 for the latest checkpoint in save_models_folder
+    keep_last: number of most recent checkpoints to keep, 0 for all; the one of the last epoch is always kept
+    '''
 
     criterion = nn.MSELoss()
     net=net.to(device)
 
+    # checkpoints are written in the background
+    ckpt_manager = None
+    start_epoch = resumeepoch
+    if save_models_folder is not None:
+        ckpt_manager = CheckpointManager(save_models_folder + "/embed_cnn_checkpoint_intrain", "embed_cnn_checkpoint_epoch{}.pth", keep_last=keep_last, milestones=[epochs])
+        if start_epoch<0: #resume from the latest checkpoint
+            start_epoch = ckpt_manager.latest() or 0
+    start_epoch = max(start_epoch, 0)
+
     # resume training; load checkpoint
-    if save_models_folder is not None and resumeepoch>0:
-        save_file = save_models_folder + "/embed_cnn_checkpoint_intrain/embed_cnn_checkpoint_epoch" + str(resumeepoch) + ".pth"
-        checkpoint = torch.load(save_file)
+    if ckpt_manager is not None and start_epoch>0:
+        checkpoint = ckpt_manager.load(start_epoch, map_location="cpu")
         net.load_state_dict(checkpoint['net_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         torch.set_rng_state(checkpoint['rng_state'])
     #end if
 
     start_tmp = timeit.default_timer()
-    for epoch in range(resumeepoch, epochs):
+    for epoch in range(start_epoch, epochs):
         net.train()
         train_loss = 0
         adjust_learning_rate(optimizer, epoch, base_lr)
@@ -75,8 +89,8 @@ def train_net_embed(trainloader, testloader, net, optimizer, epochs=200, base_lr
             with torch.no_grad():
                 test_loss = 0
                 for batch_test_images, batch_test_labels in testloader:
-                    batch_test_images = batch_test_images.type(torch.float).cuda()
-                    batch_test_labels = batch_test_labels.type(torch.float).view(-1,1).cuda()
+                    batch_test_images = batch_test_images.type(torch.float).to(device)
+                    batch_test_labels = batch_test_labels.type(torch.float).view(-1,1).to(device)
                     outputs,_ = net(batch_test_images)
                     loss = criterion(outputs, batch_test_labels)
                     test_loss += loss.cpu().item()
@@ -85,17 +99,16 @@ def train_net_embed(trainloader, testloader, net, optimizer, epochs=200, base_lr
                 print('Train net_x2y for label embedding: [epoch %d/%d] train_loss:%f test_loss:%f Time:%.4f' % (epoch+1, epochs, train_loss, test_loss, timeit.default_timer()-start_tmp))
 
         #save checkpoint
-        if save_models_folder is not None and (((epoch+1) % 50 == 0) or (epoch+1==epochs)):
-            save_file = save_models_folder + "/embed_cnn_checkpoint_intrain"
-            os.makedirs(save_file, exist_ok=True)
-            save_file = save_file + "/embed_cnn_checkpoint_epoch" + str(epoch+1) + ".pth"
-            torch.save({
+        if ckpt_manager is not None and (((epoch+1) % 50 == 0) or (epoch+1==epochs)):
+            ckpt_manager.save(epoch+1, {
                     'epoch': epoch,
                     'net_state_dict': net.state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'rng_state': torch.get_rng_state()
-            }, save_file)
+            })
     #end for epoch
+    if ckpt_manager is not None:
+        ckpt_manager.close() #wait for the last checkpoints
 
     return net
 
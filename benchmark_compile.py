@@ -0,0 +1,78 @@
+"""
+Benchmark eager vs compiled CcGAN training steps on CPU
+
+Run full training iterations (the D step and the G step of train_CcGAN, with
+their backward passes and Adam updates) on random images and labels with constant
+batch sizes, once in eager mode and once with the forward passes and losses
+captured by torch.compile; report iterations/sec after the warm-up iterations
+(which include the compilation).
+
+"""
+import argparse
+import timeit
+import numpy as np
+import torch
+
+from models import *
+from utils import set_num_threads
+from gan_steps import CcGAN_D_loss, CcGAN_G_loss, CompiledStep, set_compile_cache_dir
+
+parser = argparse.ArgumentParser(description='Benchmark eager vs compiled CcGAN steps')
+parser.add_argument('--batch_size_disc', type=int, default=64)
+parser.add_argument('--batch_size_gene', type=int, default=64)
+parser.add_argument('--dim_gan', type=int, default=256)
+parser.add_argument('--loss_type_gan', type=str, default='vanilla', choices=['vanilla', 'hinge'])
+parser.add_argument('--num_iters', type=int, default=10, help='number of timed iterations')
+parser.add_argument('--num_warmup_iters', type=int, default=3, help='untimed iterations; include the compilation')
+parser.add_argument('--num_threads', type=int, default=0, help='number of CPU threads of torch; 0 keeps the default')
+parser.add_argument('--compile_cache_dir', type=str, default='./torch_cache/inductor')
+parser.add_argument('--seed', type=int, default=2020)
+args = parser.parse_args()
+
+device = torch.device("cpu")
+print("\n Number of CPU threads: {}".format(set_num_threads(args.num_threads)))
+set_compile_cache_dir(args.compile_cache_dir)
+
+
+def run(compile_steps):
+    torch.manual_seed(args.seed)
+    netG = cont_cond_cnn_generator(nz=args.dim_gan).to(device)
+    netD = cont_cond_cnn_discriminator().to(device)
+    net_y2h = model_y2h().to(device).eval()
+    optimizerG = torch.optim.Adam(netG.parameters(), lr=1e-4, betas=(0.5, 0.999))
+    optimizerD = torch.optim.Adam(netD.parameters(), lr=1e-4, betas=(0.5, 0.999))
+    D_loss_step = CompiledStep(CcGAN_D_loss, "D step", enabled=compile_steps)
+    G_loss_step = CompiledStep(CcGAN_G_loss, "G step", enabled=compile_steps)
+
+    real_images = torch.rand(args.batch_size_disc, 3, 64, 64)*2-1
+    weights = torch.ones(args.batch_size_disc)
+
+    def iteration():
+        target_labels = torch.rand(max(args.batch_size_disc, args.batch_size_gene))
+        z = torch.randn(args.batch_size_disc, args.dim_gan)
+        d_loss, _, _ = D_loss_step(netG, netD, net_y2h, z, torch.rand(args.batch_size_disc), real_images, target_labels[0:args.batch_size_disc], weights, weights, loss_type=args.loss_type_gan)
+        optimizerD.zero_grad()
+        d_loss.backward()
+        optimizerD.step()
+
+        netG.train()
+        z = torch.randn(args.batch_size_gene, args.dim_gan)
+        g_loss = G_loss_step(netG, netD, net_y2h, z, target_labels[0:args.batch_size_gene], loss_type=args.loss_type_gan)
+        optimizerG.zero_grad()
+        g_loss.backward()
+        optimizerG.step()
+
+    start = timeit.default_timer()
+    for _ in range(args.num_warmup_iters):
+        iteration()
+    warmup_time = timeit.default_timer() - start
+    start = timeit.default_timer()
+    for _ in range(args.num_iters):
+        iteration()
+    elapsed = timeit.default_timer() - start
+    print(" {}: {:.3f} iterations/sec (warm-up: {:.1f}s)".format("compiled" if compile_steps else "eager", args.num_iters/elapsed, warmup_time))
+
+
+print("\n Iterations/sec with batch sizes {} (D) and {} (G) >>>".format(args.batch_size_disc, args.batch_size_gene))
+run(False)
+run(True)
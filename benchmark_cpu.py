@@ -0,0 +1,77 @@
+"""
+Benchmark sampling and evaluation on a CPU-only host
+
+Report the images/sec of the CcGAN generator (with and without the folded
+conditional BN) and of each evaluation network (the AE encoder for the FID, the
+race classifier for the entropy/IS and the age regressor for the LS) with random
+weights, in float32 and with bf16 autocast, for a given number of torch threads.
+
+"""
+import argparse
+import timeit
+import numpy as np
+import torch
+
+from models import *
+from utils import set_num_threads, prepare_inference_net, inference_context
+
+parser = argparse.ArgumentParser(description='Benchmark sampling and evaluation on CPU')
+parser.add_argument('--batch_size', type=int, default=200)
+parser.add_argument('--num_batches', type=int, default=5, help='number of timed batches; after one warm-up batch')
+parser.add_argument('--num_threads', type=int, default=0, help='number of CPU threads of torch; 0 keeps the default')
+parser.add_argument('--dim_gan', type=int, default=128)
+parser.add_argument('--img_size', type=int, default=64)
+parser.add_argument('--no_channels_last', action='store_true', default=False)
+parser.add_argument('--no_bf16', action='store_true', default=False, help='skip the bf16 runs, e.g., on CPUs without bf16 support')
+parser.add_argument('--seed', type=int, default=2020)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+np.random.seed(args.seed)
+device = torch.device("cpu")
+print("\n Number of CPU threads: {}".format(set_num_threads(args.num_threads)))
+channels_last = not args.no_channels_last
+
+
+def run(name, fn, bf16):
+    with inference_context(device, bf16=bf16):
+        fn() #warm up
+        start = timeit.default_timer()
+        for _ in range(args.num_batches):
+            fn()
+        elapsed = timeit.default_timer() - start
+    nimgs = args.num_batches*args.batch_size
+    print(" {}{}: {:.1f} images/sec".format(name, " (bf16)" if bf16 else "", nimgs/elapsed))
+
+
+## generation
+netG = prepare_inference_net(cont_cond_cnn_generator(nz=args.dim_gan), device, channels_last=channels_last)
+net_y2h = model_y2h().to(device).eval()
+labels = np.random.randint(1, 61, size=args.batch_size)/60.0
+
+def generate(folded):
+    if folded:
+        y = netG.fold_labels(labels, net_y2h)
+    else:
+        y = net_y2h(torch.from_numpy(labels).type(torch.float).view(-1,1))
+    z = torch.randn(args.batch_size, args.dim_gan, dtype=torch.float)
+    return netG(z, y, folded=folded)
+
+## evaluation networks
+eval_nets = {
+    'AE encoder (FID)': encoder(dim_bottleneck=512),
+    'ResNet34_class (entropy/IS)': ResNet34_class(num_classes=5, ngpu=0),
+    'ResNet34_regre (LS)': ResNet34_regre(ngpu=0),
+}
+images = torch.rand(args.batch_size, 3, args.img_size, args.img_size)*2-1
+if channels_last:
+    images = images.contiguous(memory_format=torch.channels_last)
+
+print("\n Images/sec with batch size {} >>>".format(args.batch_size))
+for bf16 in ([False] if args.no_bf16 else [False, True]):
+    netG.clear_folded_cache()
+    run("generator", lambda: generate(False), bf16)
+    run("generator, folded conditional BN", lambda: generate(True), bf16)
+    for name, net in eval_nets.items():
+        net = prepare_inference_net(net, device, channels_last=channels_last)
+        run(name, lambda: net(images), bf16)
@@ -0,0 +1,98 @@
+"""
+Benchmark multi-process (DDP over gloo) CcGAN training steps on a CPU host
+
+Run full training iterations (the D step and the G step of train_CcGAN, with
+their backward passes, gradient all-reduces and Adam updates) on random images and
+labels with 1, 2, 4, ... local processes; the batch sizes of a step are split
+among the processes and the cores among their threads, as in train_CcGAN_ddp.
+Report iterations/sec of rank 0 after the warm-up iterations, and check that the
+weights of the ranks are still identical at the end.
+
+"""
+import argparse
+import os
+import timeit
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from models import *
+from gan_steps import CcGAN_D_loss, CcGAN_G_loss
+
+parser = argparse.ArgumentParser(description='Benchmark multi-process CcGAN steps on CPU')
+parser.add_argument('--batch_size_disc', type=int, default=64)
+parser.add_argument('--batch_size_gene', type=int, default=64)
+parser.add_argument('--dim_gan', type=int, default=256)
+parser.add_argument('--loss_type_gan', type=str, default='vanilla', choices=['vanilla', 'hinge'])
+parser.add_argument('--world_sizes', type=str, default='1_2_4', help='numbers of processes, separated by _')
+parser.add_argument('--num_iters', type=int, default=10, help='number of timed iterations')
+parser.add_argument('--num_warmup_iters', type=int, default=2)
+parser.add_argument('--master_port', type=int, default=29501)
+parser.add_argument('--seed', type=int, default=2020)
+args = parser.parse_args()
+
+num_threads_total = torch.get_num_threads()
+
+
+def run_rank(rank, world_size):
+    torch.set_num_threads(max(1, num_threads_total//world_size))
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(args.seed) #same initial weights; DDP also broadcasts those of rank 0
+        netG = torch.nn.parallel.DistributedDataParallel(cont_cond_cnn_generator(nz=args.dim_gan), find_unused_parameters=True) #as in train_CcGAN
+        netD = torch.nn.parallel.DistributedDataParallel(cont_cond_cnn_discriminator())
+        net_y2h = model_y2h().eval()
+        optimizerG = torch.optim.Adam(netG.parameters(), lr=1e-4, betas=(0.5, 0.999))
+        optimizerD = torch.optim.Adam(netD.parameters(), lr=1e-4, betas=(0.5, 0.999))
+        torch.manual_seed(args.seed + rank)
+
+        batch_size_disc = args.batch_size_disc//world_size
+        batch_size_gene = args.batch_size_gene//world_size
+        real_images = torch.rand(batch_size_disc, 3, 64, 64)*2-1
+        weights = torch.ones(batch_size_disc)
+
+        def iteration():
+            target_labels = torch.rand(max(batch_size_disc, batch_size_gene))
+            z = torch.randn(batch_size_disc, args.dim_gan)
+            d_loss, _, _ = CcGAN_D_loss(netG.module, netD, net_y2h, z, torch.rand(batch_size_disc), real_images, target_labels[0:batch_size_disc], weights, weights, loss_type=args.loss_type_gan)
+            optimizerD.zero_grad()
+            d_loss.backward()
+            optimizerD.step()
+
+            netG.train()
+            z = torch.randn(batch_size_gene, args.dim_gan)
+            g_loss = CcGAN_G_loss(netG, netD.module, net_y2h, z, target_labels[0:batch_size_gene], loss_type=args.loss_type_gan)
+            optimizerG.zero_grad()
+            g_loss.backward()
+            optimizerG.step()
+
+        for _ in range(args.num_warmup_iters):
+            iteration()
+        dist.barrier()
+        start = timeit.default_timer()
+        for _ in range(args.num_iters):
+            iteration()
+        dist.barrier()
+        elapsed = timeit.default_timer() - start
+
+        ## the all-reduced gradients keep the weights of the ranks identical
+        params = torch.cat([p.detach().view(-1) for p in list(netG.parameters())+list(netD.parameters())])
+        params_max, params_min = params.clone(), params.clone()
+        dist.all_reduce(params_max, op=dist.ReduceOp.MAX)
+        dist.all_reduce(params_min, op=dist.ReduceOp.MIN)
+        if rank == 0:
+            print(" {} processes of {} threads: {:.3f} iterations/sec (max weight difference between ranks: {:.2e})".format(world_size, torch.get_num_threads(), args.num_iters/elapsed, (params_max-params_min).abs().max().item()))
+    finally:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    print("\n Iterations/sec with batch sizes {} (D) and {} (G) per step >>>".format(args.batch_size_disc, args.batch_size_gene))
+    for world_size in [int(x) for x in args.world_sizes.split("_")]:
+        if args.batch_size_disc % world_size != 0 or args.batch_size_gene % world_size != 0:
+            print(" {} processes: skipped; the batch sizes are not divisible".format(world_size))
+            continue
+        # spawned, as in train_CcGAN_ddp; a fork after the OpenMP threads of torch have started may deadlock
+        torch.multiprocessing.start_processes(run_rank, args=(world_size,), nprocs=world_size, join=True, start_method='spawn')
@@ -0,0 +1,89 @@
+"""
+Benchmark the trace-sqrt backends of the FID on synthetic features
+
+Compare scipy.linalg.sqrtm of the covariance product (the original FID) with the
+symmetric eigh form (with and without the cached square roots of the real
+covariances) and the batched torch eigvalsh on CPU threads, over a set of windows
+with realistic sample sizes; report the time and the max abs difference. The eigh
+backend is also run with the windows spread over a thread and a process pool.
+
+Results on one CPU core (numpy 2.4, scipy 1.17, torch 2.14), 512-d features with
+a decaying spectrum; max abs differences of the FIDs against sqrtm:
+
+    60 windows of 1000 real and 1000 fake samples (full-rank covariances)
+      sqrtm                          10.99s  183.2ms/window
+      eigh                            3.88s   64.6ms/window  max abs diff 1.7e-09
+      eigh, cached sqrt(SIGMAr)       1.40s   23.3ms/window  max abs diff 1.7e-09
+      torch                           3.83s   63.9ms/window  max abs diff 1.8e-09
+      torch, cached sqrt(SIGMAr)      1.68s   28.1ms/window  max abs diff 1.6e-09
+      (the cached square roots take 2.51s once per process)
+
+    20 windows of 200 real and 200 fake samples (rank-deficient covariances)
+      sqrtm                           6.23s  311.4ms/window
+      eigh                            1.11s   55.5ms/window  max abs diff 8.1e-07
+      eigh, cached sqrt(SIGMAr)       0.49s   24.7ms/window  max abs diff 8.1e-07
+      torch                           1.18s   59.0ms/window  max abs diff 6.9e-07
+
+eigh matches sqrtm to 1e-6 or better and is 2.8x to 12.7x faster, hence the
+default --fid_backend 'eigh'. With a single core, the pools give no speedup.
+
+"""
+import argparse
+import timeit
+import numpy as np
+import torch
+
+from eval_metrics import FID_from_stats, FID_from_stats_torch, sqrtm_psd
+from eval_engine import map_windows
+
+parser = argparse.ArgumentParser(description='Benchmark the FID backends')
+parser.add_argument('--dim', type=int, default=512, help='dimension of the features')
+parser.add_argument('--num_windows', type=int, default=60, help='number of sliding windows')
+parser.add_argument('--nreal', type=int, default=1000, help='number of real samples per window')
+parser.add_argument('--nfake', type=int, default=1000, help='number of fake samples per window')
+parser.add_argument('--num_threads', type=int, default=None, help='CPU threads of the torch backend')
+parser.add_argument('--num_workers', type=int, default=4, help='number of workers of the window pools')
+parser.add_argument('--seed', type=int, default=2020)
+args = parser.parse_args()
+
+rng = np.random.RandomState(args.seed)
+
+# features with a decaying spectrum, as the AE features; fake features are perturbed
+def sample_features(n, basis, scales, shift):
+    return (rng.randn(n, len(scales)) * scales).dot(basis) + shift
+
+print("\n Generate {} windows of {}-d features >>>".format(args.num_windows, args.dim))
+stats = []
+for i in range(args.num_windows):
+    basis = np.linalg.qr(rng.randn(args.dim, args.dim))[0]
+    scales = np.exp(-np.arange(args.dim)/64.0)
+    Xr = sample_features(args.nreal, basis, scales, 0)
+    Xg = sample_features(args.nfake, basis, scales*(1+0.1*rng.rand(args.dim)), 0.05*rng.randn(args.dim))
+    stats.append((np.mean(Xr, axis=0), np.cov(Xr.transpose()), np.mean(Xg, axis=0), np.cov(Xg.transpose())))
+MUr, SIGMAr, MUg, SIGMAg = [np.stack(x) for x in zip(*stats)]
+
+
+def run(name, fn):
+    start = timeit.default_timer()
+    fids = fn()
+    elapsed = timeit.default_timer() - start
+    print(" {}: {:.3f}s ({:.2f}ms per window)".format(name, elapsed, elapsed/args.num_windows*1000))
+    return np.asarray(fids)
+
+print("\n Time of {} FIDs >>>".format(args.num_windows))
+fids_sqrtm = run("sqrtm", lambda: [FID_from_stats(*s, eps=1e-6, backend='sqrtm') for s in stats])
+fids_eigh = run("eigh", lambda: [FID_from_stats(*s, eps=1e-6, backend='eigh') for s in stats])
+start = timeit.default_timer()
+sqrt_SIGMAr = [sqrtm_psd(SIGMAr[i]) for i in range(args.num_windows)]
+print(" sqrtm_psd of the real covariances (computed once, then cached): {:.3f}s".format(timeit.default_timer() - start))
+fids_eigh_cached = run("eigh with cached sqrt(SIGMAr)", lambda: [FID_from_stats(*s, eps=1e-6, backend='eigh', sqrt_SIGMAr=sqrt_SIGMAr[i]) for i, s in enumerate(stats)])
+def FID_window(stats, i):
+    return FID_from_stats(*stats[i], eps=1e-6, backend='eigh')
+fids_eigh_threads = run("eigh, {} threads".format(args.num_workers), lambda: map_windows(FID_window, range(args.num_windows), shared_args=(stats,), num_workers=args.num_workers, executor='thread'))
+fids_eigh_processes = run("eigh, {} processes".format(args.num_workers), lambda: map_windows(FID_window, range(args.num_windows), shared_args=(stats,), num_workers=args.num_workers, executor='process'))
+fids_torch = run("torch (threads: {})".format(args.num_threads or torch.get_num_threads()), lambda: FID_from_stats_torch(MUr, SIGMAr, MUg, SIGMAg, num_threads=args.num_threads))
+fids_torch_cached = run("torch with cached sqrt(SIGMAr)", lambda: FID_from_stats_torch(MUr, SIGMAr, MUg, SIGMAg, sqrt_SIGMAr=np.stack(sqrt_SIGMAr), num_threads=args.num_threads))
+
+print("\n Max abs difference to sqrtm (FIDs in [{:.4f}, {:.4f}]) >>>".format(fids_sqrtm.min(), fids_sqrtm.max()))
+for name, fids in [("eigh", fids_eigh), ("eigh with cached sqrt(SIGMAr)", fids_eigh_cached), ("eigh, threads", fids_eigh_threads), ("eigh, processes", fids_eigh_processes), ("torch", fids_torch), ("torch with cached sqrt(SIGMAr)", fids_torch_cached)]:
+    print(" {}: {:.3e}".format(name, np.max(np.abs(fids - fids_sqrtm))))
@@ -0,0 +1,144 @@
+"""
+Checkpoints written in the background with a retention policy
+
+CheckpointManager snapshots a checkpoint dict (state dicts, rng states, counters)
+to CPU on the training thread, so that training can go on updating the
+parameters, and writes it from a background thread. Each file is written to a
+temporary name and renamed, so a crash never leaves a partial checkpoint behind.
+By default all checkpoints are kept; with keep_last>0 only the last keep_last
+ones up to the step just written are kept, plus milestones (every
+milestone_freq steps and the given steps), which are never deleted. Files of
+later steps, e.g., left by an earlier run, are never pruned. latest() returns
+the step of the most recent checkpoint to resume from. A read_only manager (on
+the DDP ranks other than 0) only finds and loads checkpoints; save() is a no-op.
+
+"""
+import os
+import re
+import threading
+import queue
+import torch
+
+
+# copy all tensors of a (nested) checkpoint dict to CPU; CPU tensors are cloned, since they may share
+# their storage with parameters which keep changing
+def snapshot_to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager():
+    def __init__(self, folder, filename_fmt, keep_last=0, milestone_freq=0, milestones=None, max_queue_size=2, read_only=False):
+        '''
+        folder: folder of the checkpoints, e.g., save_models_folder + "/cGAN_checkpoint_intrain"
+        filename_fmt: file name with one field for the step (iteration or epoch), e.g., "cGAN_checkpoint_niters_{}.pth"
+        keep_last: number of most recent checkpoints up to the one just written which are kept; <=0 keeps all checkpoints
+        milestone_freq: checkpoints at multiples of milestone_freq steps are never deleted; 0 for none
+        milestones: steps whose checkpoints are never deleted, e.g., the last iteration
+        max_queue_size: max number of snapshots waiting to be written; save() blocks if the writer falls behind
+        read_only: no writer thread and save() does nothing, e.g., on the DDP ranks other than 0
+        '''
+        self.folder = folder
+        self.filename_fmt = filename_fmt
+        self.keep_last = keep_last
+        self.milestone_freq = milestone_freq
+        self.milestones = set() if milestones is None else set(int(step) for step in milestones)
+        prefix, suffix = filename_fmt.split('{}')
+        self.pattern = re.compile('^' + re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+        self.error = None
+        self.read_only = read_only
+        if read_only:
+            self.worker = None
+            return
+        os.makedirs(folder, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.worker = threading.Thread(target=self._worker, daemon=True)
+        self.worker.start()
+
+    def path(self, step):
+        return os.path.join(self.folder, self.filename_fmt.format(step))
+
+    def steps(self):
+        '''
+        steps of the checkpoints on disk, in increasing order
+        '''
+        if not os.path.isdir(self.folder):
+            return []
+        steps = [self.pattern.match(filename) for filename in os.listdir(self.folder)]
+        return sorted(int(m.group(1)) for m in steps if m is not None)
+
+    def latest(self):
+        '''
+        step of the most recent checkpoint on disk; None if there is none
+        '''
+        steps = self.steps()
+        return steps[-1] if len(steps)>0 else None
+
+    def is_milestone(self, step):
+        return step in self.milestones or (self.milestone_freq > 0 and step % self.milestone_freq == 0)
+
+    def load(self, step=None, map_location="cpu"):
+        '''
+        load the checkpoint of step; the latest one if step is None
+        '''
+        step = self.latest() if step is None else step
+        if step is None:
+            raise Exception('no checkpoint in {}!!!'.format(self.folder))
+        return torch.load(self.path(step), map_location=map_location)
+
+    def save(self, step, checkpoint):
+        '''
+        snapshot checkpoint (a dict) to CPU now and write it in the background
+        '''
+        if self.read_only:
+            return
+        if self.error is not None:
+            raise self.error
+        self.queue.put((step, snapshot_to_cpu(checkpoint)))
+
+    def _worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue #drain the queue after a failure
+            step, checkpoint = task
+            try:
+                save_file = self.path(step)
+                tmp_file = save_file + '.tmp.{}'.format(os.getpid())
+                torch.save(checkpoint, tmp_file)
+                os.replace(tmp_file, save_file) #atomic
+                self._prune(step)
+            except Exception as e:
+                self.error = e
+
+    def _prune(self, current_step):
+        if self.keep_last <= 0:
+            return
+        ## only checkpoints up to the one just written; it is always kept
+        steps = [step for step in self.steps() if step <= current_step and not self.is_milestone(step)]
+        for step in steps[:-self.keep_last]:
+            os.remove(self.path(step))
+
+    def close(self):
+        '''
+        wait until all checkpoints are written
+        '''
+        if self.worker is not None and self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
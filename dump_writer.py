@@ -0,0 +1,110 @@
+"""
+Dump fake images to disk in the background
+
+FakeImageDumpWriter takes uint8 batches from the sampler through a bounded queue,
+so sampling blocks only if the writers fall behind by more than max_queue_size
+batches. Individual image files (png/jpg) are encoded by a pool of threads (PIL
+releases the GIL while encoding) into a folder that is created once; the 'h5'
+format writes all images into one chunked uint8 dataset 'images' with their
+'labels', which can be read back with utkface_data.load_UTKFace_h5.
+
+"""
+import os
+import threading
+import queue
+import numpy as np
+import h5py
+from PIL import Image
+
+
+class FakeImageDumpWriter():
+    def __init__(self, path, fmt='png', filename_fmt=None, num_workers=8, max_queue_size=16, nfake=None, img_shape=None, chunk_size=256):
+        '''
+        path: a folder for 'png' and 'jpg'; the h5 file for 'h5'
+        fmt: 'png', 'jpg' (one file per image) or 'h5' (one chunked uint8 dataset)
+        filename_fmt: name of the image files with the fields {i} (index of the image) and {label}; default '{i}_{label}.'+fmt
+        num_workers: number of encoding threads; 'h5' uses one writer thread
+        max_queue_size: max number of batches waiting to be written
+        nfake, img_shape: number of images and the shape (ncximg_sizeximg_size) of an image; required by 'h5'
+        '''
+        if fmt not in ['png', 'jpg', 'h5']:
+            raise Exception('unknown dump format: {}!!!'.format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.filename_fmt = '{i}_{label}.' + fmt if filename_fmt is None else filename_fmt
+        self.error = None
+        self.nimgs_written = 0
+        self.lock = threading.Lock()
+
+        if fmt == 'h5':
+            assert nfake is not None and img_shape is not None
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.hf = h5py.File(path, 'w')
+            self.hf.create_dataset('images', shape=(nfake,)+tuple(img_shape), dtype=np.uint8, chunks=(min(chunk_size, nfake),)+tuple(img_shape))
+            self.hf.create_dataset('labels', shape=(nfake,), dtype=np.float64)
+            num_workers = 1 #h5py does not support concurrent writes
+        else:
+            os.makedirs(path, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue #drain the queue after a failure
+            try:
+                self._write_batch(*task)
+            except Exception as e:
+                self.error = e
+
+    def _write_batch(self, start, images, labels):
+        if self.fmt == 'h5':
+            self.hf['images'][start:(start+len(images))] = images
+            self.hf['labels'][start:(start+len(images))] = labels
+        else:
+            for j in range(len(images)):
+                filename = os.path.join(self.path, self.filename_fmt.format(i=start+j, label=labels[j]))
+                if images.shape[1] == 1:
+                    im = Image.fromarray(images[j][0], mode='L')
+                else:
+                    im = Image.fromarray(images[j].transpose(1,2,0))
+                im.save(filename)
+        with self.lock:
+            self.nimgs_written += len(images)
+
+    def write(self, images, labels, start):
+        '''
+        images: a batch of uint8 images in [0,255]; nxncximg_sizeximg_size numpy array
+        labels: labels of the images used in the file names (e.g., unnormalized ages)
+        start: index of the first image of the batch
+        blocks if max_queue_size batches are waiting
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((start, np.ascontiguousarray(images), np.asarray(labels)))
+
+    def close(self):
+        '''
+        wait until all batches are written
+        '''
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.fmt == 'h5':
+            self.hf.close()
+        if self.error is not None:
+            raise self.error
+        return self.nimgs_written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
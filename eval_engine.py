@@ -0,0 +1,493 @@
+"""
+Feature-based evaluation engine for the sliding-window FID
+
+The AE features of all real and all fake images are extracted exactly once.
+Samples are binned by their integer label, and the eval_metrics.FeatureStats
+(count, mean, sum of squared deviations) of each bin are merged into prefix
+statistics, so the mean and covariance of any window of consecutive labels is
+the difference of two prefixes, at O(d^2) instead of another pass through the
+encoder. The per-bin statistics of the real images are cached on disk, keyed by
+the AE checkpoint, and reused across runs.
+
+MultiHeadEvaluator streams each batch of fake images once through all metric
+networks (AE encoder, race classifier, age regressor); each head accumulates its
+statistics per label bin, from which windowed and overall metrics follow.
+
+"""
+import os
+import hashlib
+import timeit
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from utils import batched_inference, prepare_inference_net, inference_context
+from eval_metrics import FID_from_stats, FID_from_stats_torch, sqrtm_psd, InceptionScoreAccumulator, FeatureStats
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+##############################################################################
+# feature extraction
+##############################################################################
+def extract_features(net, images, batch_size = 500, normalize = False, resize = None, device = "cuda", verbose = True, bf16 = False):
+    '''
+    net: feature extractor, e.g., the encoder of the pre-trained AE
+    images: nxncximg_sizeximg_size; a numpy array or a lazy view such as utkface_data.H5Images
+    normalize: if True, images are unnormalized in [0,255] and are normalized to [-1,1] on the device
+    resize: if None, do not resize; if resize = (H,W), resize images to 3 x H x W
+    bf16: use bf16 autocast on CPU
+    return: n x d features (float64)
+    '''
+    features = batched_inference(net, images, batch_size=batch_size, normalize=normalize, resize=resize, device=device, name="FID encoder", verbose=verbose, bf16=bf16)
+    return features.astype(np.float64)
+
+
+##############################################################################
+# cache of the real-image feature statistics; keyed by the checkpoint of the feature extractor
+##############################################################################
+def get_feature_cache_filename(cache_folder, ckpt_filename, labels, **extra_args):
+    '''
+    ckpt_filename: checkpoint of the feature extractor; its modification time is part of the key
+    labels: labels of the real images; a different set of real images gives a different key
+    '''
+    key = sorted(extra_args.items()) + [('ckpt_file', os.path.abspath(ckpt_filename)), ('ckpt_mtime', os.path.getmtime(ckpt_filename))]
+    key = hashlib.sha1(repr(key).encode('utf-8') + np.ascontiguousarray(labels).tobytes()).hexdigest()[0:16]
+    return os.path.join(cache_folder, 'real_feature_stats_{}.npz'.format(key))
+
+
+def extract_real_features(net, images, labels, bins, num_bins, ckpt_filename, cache_folder, batch_size = 500, resize = None, device = "cuda", bf16 = False):
+    '''
+    per-bin statistics of the features of the unnormalized real images; loaded from the cache if the same
+    feature extractor has been applied to the same real images before
+    bins: integer bin (e.g., the unnormalized age) of each image in {0,...,num_bins-1}
+    return: a BinnedFeatureStats
+    '''
+    bins = np.asarray(bins).reshape(-1).astype(np.int64)
+    num_bins = int(num_bins)
+    cache_filename = get_feature_cache_filename(cache_folder, ckpt_filename, labels, resize=resize, bf16=bf16, bins=hashlib.sha1(bins.tobytes()).hexdigest(), num_bins=num_bins)
+    if os.path.isfile(cache_filename):
+        print("\n Load real feature statistics from {}".format(cache_filename))
+        return BinnedFeatureStats.from_bin_stats(FeatureStats.load_all(cache_filename))
+
+    features = extract_features(net, images, batch_size=batch_size, normalize=True, resize=resize, device=device, bf16=bf16)
+    stats = BinnedFeatureStats(features, bins, num_bins)
+    FeatureStats.save_all(cache_filename, stats.bin_stats)
+    return stats
+
+
+##############################################################################
+# statistics of features over windows of consecutive label bins
+##############################################################################
+# bins {lo,...,hi} in the window [bin_start, bin_stop] (bounds included, as the label comparisons of the
+# per-window evaluation; a fractional radius gives a symmetric window), clipped to {0,...,num_bins-1};
+# hi = lo-1 for an empty window
+def window_bins(bin_start, bin_stop, num_bins):
+    num_bins = int(num_bins)
+    lo = min(max(int(np.ceil(bin_start)), 0), num_bins)
+    hi = max(min(int(np.floor(bin_stop)), num_bins-1), lo-1)
+    return lo, hi
+
+
+class BinnedFeatureStats():
+    def __init__(self, features, bins, num_bins):
+        '''
+        features: n x d features
+        bins: integer bin (e.g., the unnormalized age) of each sample in {0,...,num_bins-1}
+        '''
+        features = np.asarray(features, dtype=np.float64)
+        bins = np.asarray(bins).reshape(-1).astype(np.int64)
+        num_bins = int(num_bins) #e.g., max_label+1 with a float max_label
+        assert len(features) == len(bins)
+        assert bins.min() >= 0 and bins.max() < num_bins
+
+        counts = np.bincount(bins, minlength=num_bins)
+        order = np.argsort(bins, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        bin_stats = [FeatureStats.from_features(features[order[offsets[b]:offsets[b+1]]]) for b in range(num_bins)]
+        self.set_bin_stats(bin_stats)
+
+    @classmethod
+    def from_bin_stats(cls, bin_stats):
+        '''
+        bin_stats: a FeatureStats of each bin, e.g., accumulated by FIDFeatureHead or loaded from a cache
+        '''
+        stats = cls.__new__(cls)
+        stats.set_bin_stats(bin_stats)
+        return stats
+
+    def set_bin_stats(self, bin_stats):
+        self.bin_stats = bin_stats
+        self.num_bins = len(bin_stats)
+
+        # prefix statistics: bins [lo, hi) are prefix_stats[hi] - prefix_stats[lo]
+        self.prefix_stats = [FeatureStats(bin_stats[0].dim)]
+        for b in range(self.num_bins):
+            self.prefix_stats.append(self.prefix_stats[-1] + bin_stats[b])
+
+        # symmetric square roots of window covariances; the real windows are the same for every evaluated GAN
+        self.sqrt_cov_cache = {}
+
+    def count(self, bin_start, bin_stop):
+        '''
+        number of samples in the bins {bin_start,...,bin_stop}
+        '''
+        bin_start, bin_stop = window_bins(bin_start, bin_stop, self.num_bins)
+        return self.prefix_stats[bin_stop+1].n - self.prefix_stats[bin_start].n
+
+    def window_stats(self, bin_start, bin_stop):
+        '''
+        eval_metrics.FeatureStats of the features in the bins {bin_start,...,bin_stop}
+        '''
+        bin_start, bin_stop = window_bins(bin_start, bin_stop, self.num_bins)
+        return self.prefix_stats[bin_stop+1] - self.prefix_stats[bin_start]
+
+    def window(self, bin_start, bin_stop):
+        '''
+        sample mean and covariance (as np.cov) of the features in the bins {bin_start,...,bin_stop};
+        NaN (as np.cov) if the window has less than 2 samples
+        '''
+        stats = self.window_stats(bin_start, bin_stop)
+        if stats.n < 2:
+            return np.full(stats.dim, np.nan), np.full((stats.dim, stats.dim), np.nan)
+        return stats.mean_cov()
+
+    def window_sqrt_cov(self, bin_start, bin_stop):
+        '''
+        sqrtm_psd of the covariance of the bins {bin_start,...,bin_stop}; cached
+        '''
+        key = window_bins(bin_start, bin_stop, self.num_bins)
+        if key not in self.sqrt_cov_cache:
+            self.sqrt_cov_cache[key] = sqrtm_psd(self.window(bin_start, bin_stop)[1])
+        return self.sqrt_cov_cache[key]
+
+
+##############################################################################
+# parallel evaluation of windows: the windows are independent CPU linear algebra
+##############################################################################
+# limit the BLAS/OpenMP threads of this process; no-op without threadpoolctl
+def limit_blas_threads(num_threads):
+    if threadpool_limits is None or num_threads is None:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=num_threads)
+
+_window_worker_args = None
+
+def _init_window_worker(shared_args, blas_threads):
+    global _window_worker_args
+    _window_worker_args = shared_args
+    if threadpool_limits is not None:
+        threadpool_limits(limits=blas_threads)
+
+def _run_window_fn(fn, window):
+    return fn(*_window_worker_args, window)
+
+
+def map_windows(fn, windows, shared_args=(), num_workers=1, executor='thread', blas_threads=None):
+    '''
+    fn(*shared_args, window) for each window; the results are returned in the order of windows
+    num_workers: number of workers; <=1 runs sequentially in this thread
+    executor: 'thread' (numpy/scipy release the GIL in the linear algebra) or 'process' (forked workers; shared_args
+              are inherited once by each worker instead of being pickled for every window, and fn must be defined
+              at the module level)
+    blas_threads: BLAS threads of each worker; if None, number of cores // num_workers
+    '''
+    if num_workers <= 1:
+        return [fn(*shared_args, w) for w in windows]
+    if blas_threads is None:
+        blas_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    if executor == 'thread':
+        # the limit is per process, i.e., shared by all worker threads
+        with limit_blas_threads(blas_threads), concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as pool:
+            return list(pool.map(lambda w: fn(*shared_args, w), windows))
+    elif executor == 'process':
+        # fork: spawned workers would re-run the main script, which has no __main__ guard
+        mp_context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=_init_window_worker, initargs=(shared_args, blas_threads)) as pool:
+            return list(pool.map(_run_window_fn, [fn]*len(windows), windows))
+    else:
+        raise Exception('unknown executor: {}!!!'.format(executor))
+
+
+def _FID_window(real_stats, fake_stats, eps, backend, window):
+    # NaN for a window with less than 2 real or fake samples, as the per-window evaluation
+    if real_stats.count(*window) < 2 or fake_stats.count(*window) < 2:
+        return np.nan
+    MUr, SIGMAr = real_stats.window(*window)
+    MUg, SIGMAg = fake_stats.window(*window)
+    sqrt_SIGMAr = real_stats.window_sqrt_cov(*window) if backend == 'eigh' else None
+    return FID_from_stats(MUr, SIGMAr, MUg, SIGMAg, eps=eps, backend=backend, sqrt_SIGMAr=sqrt_SIGMAr)
+
+
+def FID_over_windows(real_stats, fake_stats, centers, radius, eps=1e-6, backend='eigh', num_threads=None, num_workers=1, executor='thread', blas_threads=None):
+    '''
+    FID between the real and fake features in the window [center-radius, center+radius] of each center;
+    NaN for windows with less than 2 real or fake samples
+    backend: 'sqrtm' or 'eigh' (see eval_metrics.FID_from_stats), or 'torch' for all windows in one batch
+    num_workers, executor, blas_threads: windows evaluated in parallel by map_windows; not used by 'torch'
+    '''
+    windows = [(center-radius, center+radius) for center in centers]
+    if backend == 'torch':
+        fids = np.full(len(windows), np.nan)
+        valid = [i for i, w in enumerate(windows) if real_stats.count(*w) >= 2 and fake_stats.count(*w) >= 2]
+        if len(valid) == 0:
+            return fids
+        windows = [windows[i] for i in valid]
+        MUr, SIGMAr = zip(*[real_stats.window(*w) for w in windows])
+        MUg, SIGMAg = zip(*[fake_stats.window(*w) for w in windows])
+        # reuse the square roots of the real covariances if they are all cached; otherwise computed in the batch
+        cached = all(window_bins(w[0], w[1], real_stats.num_bins) in real_stats.sqrt_cov_cache for w in windows)
+        sqrt_SIGMAr = [real_stats.window_sqrt_cov(*w) for w in windows] if cached else None
+        fids[valid] = FID_from_stats_torch(MUr, SIGMAr, MUg, SIGMAg, sqrt_SIGMAr=sqrt_SIGMAr, num_threads=num_threads)
+        return fids
+
+    fids = map_windows(_FID_window, windows, shared_args=(real_stats, fake_stats, eps, backend), num_workers=num_workers, executor=executor, blas_threads=blas_threads)
+    return np.array(fids)
+
+
+
+##############################################################################
+# single-pass evaluation of fake images: each batch is fanned out to all metric heads,
+# which accumulate their statistics per label bin
+##############################################################################
+class BatchBins():
+    def __init__(self, bins, device):
+        '''
+        bins: integer bin of each image of a batch (a numpy array)
+        the grouping of the batch by bin is computed on the host, so that the heads accumulate per-bin
+        statistics with index_add_ and without reading anything back from the device
+        '''
+        bins = np.asarray(bins).reshape(-1).astype(np.int64)
+        unique_bins, groups, counts = np.unique(bins, return_inverse=True, return_counts=True)
+        # position of each image among the images of its bin
+        order = np.argsort(groups, kind='stable')
+        slots = np.empty(len(bins), dtype=np.int64)
+        slots[order] = np.arange(len(bins)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        self.num_unique = len(unique_bins)
+        self.max_count = int(counts.max())
+        to_device = lambda x: torch.from_numpy(x).to(device, non_blocking=True)
+        self.bins, self.unique_bins, self.groups, self.slots = to_device(bins), to_device(unique_bins), to_device(groups.reshape(-1)), to_device(slots)
+
+
+class FIDFeatureHead():
+    def __init__(self, net, num_bins, shift, resize = None):
+        '''
+        net: feature extractor, e.g., the encoder of the pre-trained AE
+        shift: subtracted from the features before accumulating, e.g., the mean of the real features;
+               avoids cancellation in the sums of outer products
+        accumulates the per-bin sums and sums of outer products of the features (float64, on the device)
+        '''
+        self.net = net
+        self.num_bins = int(num_bins)
+        self.resize = resize
+        self.shift = np.asarray(shift, dtype=np.float64)
+        self.counts = None
+
+    def update(self, images, bins, labels, batch_bins):
+        if self.resize is not None:
+            images = nn.functional.interpolate(images, size = self.resize, scale_factor=None, mode='bilinear', align_corners=False)
+        features = self.net(images).type(torch.float64)
+        if self.counts is None:
+            d = features.shape[1]
+            self.shift_device = torch.from_numpy(self.shift).to(features.device)
+            self.counts = torch.zeros(self.num_bins, dtype=torch.float64, device=features.device)
+            self.sums = torch.zeros(self.num_bins, d, dtype=torch.float64, device=features.device)
+            self.outers = torch.zeros(self.num_bins, d, d, dtype=torch.float64, device=features.device)
+        X = features - self.shift_device
+        self.counts.index_add_(0, bins, torch.ones_like(X[:, 0]))
+        self.sums.index_add_(0, bins, X)
+        # features grouped by bin, zero-padded to the largest bin of the batch; one batched matmul for all bins
+        X_grouped = X.new_zeros(batch_bins.num_unique, batch_bins.max_count, X.shape[1])
+        X_grouped[batch_bins.groups, batch_bins.slots] = X
+        self.outers.index_add_(0, batch_bins.unique_bins, X_grouped.transpose(1, 2) @ X_grouped)
+
+    def stats(self):
+        '''
+        BinnedFeatureStats of the accumulated features; the per-bin sums become per-bin FeatureStats
+        '''
+        counts, sums, outers = self.counts.cpu().numpy().astype(np.int64), self.sums.cpu().numpy(), self.outers.cpu().numpy()
+        bin_stats = []
+        for b in range(self.num_bins):
+            if counts[b] == 0:
+                bin_stats.append(FeatureStats(sums.shape[1]))
+                continue
+            mean_shifted = sums[b] / counts[b]
+            bin_stats.append(FeatureStats.from_moments(counts[b], mean_shifted + self.shift, outers[b] - counts[b] * np.outer(mean_shifted, mean_shifted)))
+        return BinnedFeatureStats.from_bin_stats(bin_stats)
+
+
+# entropy of a histogram of class labels; same as utils.compute_entropy of the labels
+def entropy_from_counts(counts, base=None):
+    counts = np.asarray(counts, dtype=np.float64)
+    norm_counts = counts[counts>0] / counts.sum()
+    base = np.e if base is None else base
+    return -(norm_counts * np.log(norm_counts)/np.log(base)).sum()
+
+
+class ClassHistogramHead():
+    def __init__(self, net, num_classes, num_bins):
+        '''
+        net: classification CNN, e.g., ResNet34_class for the races
+        accumulates the histogram of the predicted classes in each bin
+        '''
+        self.net = net
+        self.num_classes = num_classes
+        self.num_bins = int(num_bins)
+        self.counts = None
+
+    def update(self, images, bins, labels, batch_bins):
+        outputs, _ = self.net(images)
+        class_labels_pred = outputs.argmax(dim=1)
+        counts = torch.bincount(bins*self.num_classes + class_labels_pred, minlength=self.num_bins*self.num_classes)
+        counts = counts.view(self.num_bins, self.num_classes)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def histogram(self, bin_start, bin_stop):
+        bin_start, bin_stop = window_bins(bin_start, bin_stop, self.num_bins)
+        return self.counts[bin_start:(bin_stop+1)].sum(dim=0).cpu().numpy()
+
+    def entropy(self, bin_start, bin_stop):
+        '''
+        entropy of the predicted classes in the bins {bin_start,...,bin_stop}
+        '''
+        return entropy_from_counts(self.histogram(bin_start, bin_stop))
+
+
+class LabelScoreHead():
+    def __init__(self, net, num_bins, min_label_before_shift, max_label_after_shift):
+        '''
+        net: regression CNN, e.g., ResNet34_regre; as cal_labelscore
+        accumulates the count, sum and sum of squares of abs(assigned label - predicted label) in each bin
+        '''
+        self.net = net
+        self.num_bins = int(num_bins)
+        self.min_label_before_shift = min_label_before_shift
+        self.max_label_after_shift = max_label_after_shift
+        self.sums = None
+
+    def update(self, images, bins, labels, batch_bins):
+        labels_pred, _ = self.net(images)
+        # (pred*max_label_after_shift-abs(min_label_before_shift)) - (assi*max_label_after_shift-abs(min_label_before_shift))
+        errors = ((labels_pred.view(-1) - labels) * self.max_label_after_shift).abs().type(torch.float64)
+        if self.sums is None:
+            self.sums = torch.zeros(3, self.num_bins, dtype=torch.float64, device=errors.device)
+        self.sums[0].index_add_(0, bins, torch.ones_like(errors))
+        self.sums[1].index_add_(0, bins, errors)
+        self.sums[2].index_add_(0, bins, errors**2)
+
+    def labelscore(self, bin_start, bin_stop):
+        '''
+        mean and std of abs(assigned label - predicted label) in the bins {bin_start,...,bin_stop};
+        NaN for an empty window
+        '''
+        bin_start, bin_stop = window_bins(bin_start, bin_stop, self.num_bins)
+        n, s1, s2 = self.sums[:, bin_start:(bin_stop+1)].sum(dim=1).tolist()
+        if n == 0:
+            return np.nan, np.nan
+        ls_mean = s1/n
+        ls_std = np.sqrt(max(s2/n - ls_mean**2, 0))
+        return ls_mean, ls_std
+
+
+class InceptionScoreHead():
+    def __init__(self, net, num_classes, split_ids, splits):
+        '''
+        net: classification CNN, e.g., ResNet34_class for the IS
+        split_ids: split of each image in the order of evaluation, e.g., a random permutation // (n//splits);
+                   images with split_ids >= splits are not used
+        only keeps the per-split sums of eval_metrics.InceptionScoreAccumulator, accumulated on the device
+        '''
+        self.net = net
+        self.num_classes = num_classes
+        self.splits = splits
+        self.split_ids = torch.from_numpy(np.asarray(split_ids).reshape(-1)).type(torch.long)
+        self.sums = None
+        self.nimgs_got = 0
+
+    def update(self, images, bins, labels, batch_bins):
+        outputs, _ = self.net(images)
+        batch_preds = F.softmax(outputs, dim=1).type(torch.float64)
+        if self.sums is None:
+            self.split_ids = self.split_ids.to(batch_preds.device)
+            # per split: count, sum_y p(y|x)log(p(y|x)), p(y|x); the last row collects the unused images
+            self.sums = torch.zeros(self.splits+1, 2+self.num_classes, dtype=torch.float64, device=batch_preds.device)
+        split_ids = self.split_ids[self.nimgs_got:(self.nimgs_got+len(batch_preds))].clamp(max=self.splits)
+        self.nimgs_got += len(batch_preds)
+        batch_sums = torch.cat((torch.ones_like(batch_preds[:, 0:1]), torch.xlogy(batch_preds, batch_preds).sum(dim=1, keepdim=True), batch_preds), dim=1)
+        self.sums.index_add_(0, split_ids, batch_sums)
+
+    def score(self):
+        sums = self.sums[0:self.splits].cpu().numpy()
+        accumulator = InceptionScoreAccumulator(self.num_classes, splits=self.splits)
+        accumulator.counts, accumulator.sum_plogp, accumulator.sum_py = sums[:, 0], sums[:, 1], sums[:, 2:]
+        return accumulator.score()
+
+
+class MultiHeadEvaluator():
+    def __init__(self, heads, device = "cuda", bf16 = False, channels_last = None):
+        '''
+        heads: a dict of metric heads (FIDFeatureHead, ClassHistogramHead, LabelScoreHead, ...); each has
+               update(images, bins, labels, batch_bins) with images on the device normalized to [-1,1],
+               bins on the device and batch_bins a BatchBins
+        bf16: run the metric networks with bf16 autocast on CPU
+        channels_last: use the channels_last layout; if None, only on CPU
+        '''
+        self.heads = heads
+        self.device = device
+        self.bf16 = bf16
+        self.channels_last = torch.device(device).type == "cpu" if channels_last is None else channels_last
+        for head in self.heads.values():
+            head.net = prepare_inference_net(head.net, device, channels_last=self.channels_last)
+
+        # time spent in each head; with cuda events, so that timing does not synchronize the device
+        self.use_cuda = torch.device(device).type == "cuda"
+        self.times = {name: 0.0 for name in self.heads}
+        self.events = {name: [] for name in self.heads}
+        self.nimgs_got = 0
+
+    def __getitem__(self, name):
+        return self.heads[name]
+
+    def update(self, images, bins, labels):
+        '''
+        images: a batch of normalized images (a tensor on the device)
+        bins: integer bin of each image, e.g., the unnormalized assigned age
+        labels: normalized assigned labels
+        '''
+        batch_bins = BatchBins(bins, self.device)
+        bins = batch_bins.bins
+        labels = torch.as_tensor(np.asarray(labels), dtype=torch.float).to(self.device, non_blocking=True)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with inference_context(self.device, bf16=self.bf16):
+            for name, head in self.heads.items():
+                if self.use_cuda:
+                    start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                    start.record()
+                    head.update(images, bins, labels, batch_bins)
+                    end.record()
+                    self.events[name].append((start, end))
+                else:
+                    start_time = timeit.default_timer()
+                    head.update(images, bins, labels, batch_bins)
+                    self.times[name] += timeit.default_timer() - start_time
+        self.nimgs_got += len(images)
+
+    def report_throughput(self):
+        '''
+        print images/sec of each metric network
+        '''
+        if self.use_cuda:
+            torch.cuda.synchronize()
+            for name in self.heads:
+                self.times[name] += sum(start.elapsed_time(end) for start, end in self.events[name])/1000
+                self.events[name] = []
+        for name in self.heads:
+            print("\r {}: {} images in {:.2f}s; {:.1f} images/sec.".format(name, self.nimgs_got, self.times[name], self.nimgs_got/max(self.times[name], 1e-12)))
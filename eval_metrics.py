@@ -16,19 +16,17 @@ IMGSg: fake images
 """
 
 import os
-import gc
 import numpy as np
 # from numpy import linalg as LA
 from scipy import linalg
 import torch
 import torch.nn as nn
-from scipy.stats import entropy
+from scipy.special import xlogy
 from torch.nn import functional as F
 from torchvision.utils import save_image
 import torch.utils.data
-from torch.autograd import Variable
 
-from utils import SimpleProgressBar, IMGs_dataset
+from utils import IMGs_dataset, IMGs_batch_loader, batched_inference, prepare_inference_net, inference_context
 
 
 ##############################################################################
@@ -41,13 +39,27 @@ def FID(Xr, Xg, eps=1e-10):
     and X_2 ~ N(mu_2, C_2) is
             d^2 = ||mu_1 - mu_2||^2 + Tr(C_1 + C_2 - 2*sqrt(C_1*C_2)).
     '''
-    #sample mean
-    MUr = np.mean(Xr, axis = 0)
-    MUg = np.mean(Xg, axis = 0)
+    #sample mean and covariance; accumulated chunk by chunk in float64
+    MUr, SIGMAr = FeatureStats.from_features(Xr).mean_cov()
+    MUg, SIGMAg = FeatureStats.from_features(Xg).mean_cov()
+
+    return FID_from_stats(MUr, SIGMAr, MUg, SIGMAg, eps=eps)
+
+# compute FID based on the sample means and covariances of the features
+def FID_from_stats(MUr, SIGMAr, MUg, SIGMAg, eps=1e-10, backend='sqrtm', sqrt_SIGMAr=None):
+    '''
+    backend: 'sqrtm': scipy.linalg.sqrtm of the non-symmetric product SIGMAr*SIGMAg;
+             'eigh': Tr(sqrt(SIGMAr*SIGMAg)) = Tr(sqrt(S*SIGMAg*S)) with the symmetric S = sqrt(SIGMAr)
+    sqrt_SIGMAr: for 'eigh'; precomputed sqrtm_psd(SIGMAr), e.g., of the cached real statistics
+    '''
     mean_diff = MUr - MUg
-    #sample covariance
-    SIGMAr = np.cov(Xr.transpose())
-    SIGMAg = np.cov(Xg.transpose())
+
+    if backend == 'eigh':
+        if sqrt_SIGMAr is None:
+            sqrt_SIGMAr = sqrtm_psd(SIGMAr)
+        return mean_diff.dot(mean_diff) + np.trace(SIGMAr) + np.trace(SIGMAg) - 2*trace_sqrt_product(sqrt_SIGMAr, SIGMAg)
+    elif backend != 'sqrtm':
+        raise Exception('unknown FID backend: {}!!!'.format(backend))
 
     # Product might be almost singular
     covmean, _ = linalg.sqrtm(SIGMAr.dot(SIGMAg), disp=False)#square root of a matrix
@@ -64,73 +76,183 @@ def FID(Xr, Xg, eps=1e-10):
 
     return fid_score
 
+# symmetric square root of a symmetric positive semi-definite matrix via its eigendecomposition
+def sqrtm_psd(SIGMA):
+    w, V = linalg.eigh(SIGMA)
+    w = np.sqrt(np.clip(w, 0, None)) #clip eigenvalues which are negative due to rounding
+    return (V * w).dot(V.transpose())
+
+# Tr(sqrt(C1*C2)) given S = sqrt(C1); S*C2*S is symmetric PSD and has the same eigenvalues as C1*C2
+def trace_sqrt_product(sqrt_SIGMA1, SIGMA2):
+    M = sqrt_SIGMA1.dot(SIGMA2).dot(sqrt_SIGMA1)
+    w = linalg.eigvalsh((M + M.transpose())/2)
+    return np.sqrt(np.clip(w, 0, None)).sum()
+
+# batched FIDs with torch (float64, on CPU threads by default); inputs have a leading batch dimension
+def FID_from_stats_torch(MUr, SIGMAr, MUg, SIGMAg, sqrt_SIGMAr=None, device="cpu", num_threads=None):
+    '''
+    MUr, MUg: B x d; SIGMAr, SIGMAg: B x d x d
+    sqrt_SIGMAr: B x d x d; precomputed sqrtm_psd(SIGMAr[b]) for each b (optional)
+    num_threads: number of CPU threads used by torch; if None, keep the current setting
+    return: B FIDs
+    '''
+    if num_threads is not None:
+        num_threads_old = torch.get_num_threads()
+        torch.set_num_threads(num_threads)
+    to_tensor = lambda x: torch.as_tensor(np.asarray(x), dtype=torch.float64, device=device)
+    MUr, SIGMAr, MUg, SIGMAg = to_tensor(MUr), to_tensor(SIGMAr), to_tensor(MUg), to_tensor(SIGMAg)
+    if sqrt_SIGMAr is None:
+        w, V = torch.linalg.eigh(SIGMAr)
+        sqrt_SIGMAr = (V * w.clamp(min=0).sqrt().unsqueeze(1)) @ V.transpose(1, 2)
+    else:
+        sqrt_SIGMAr = to_tensor(sqrt_SIGMAr)
+    M = sqrt_SIGMAr @ SIGMAg @ sqrt_SIGMAr
+    w = torch.linalg.eigvalsh((M + M.transpose(1, 2))/2)
+    tr_covmean = w.clamp(min=0).sqrt().sum(dim=1)
+    mean_diff = MUr - MUg
+    fids = (mean_diff*mean_diff).sum(dim=1) + SIGMAr.diagonal(dim1=1, dim2=2).sum(dim=1) + SIGMAg.diagonal(dim1=1, dim2=2).sum(dim=1) - 2*tr_covmean
+    if num_threads is not None:
+        torch.set_num_threads(num_threads_old)
+    return fids.cpu().numpy()
+
+
+# count, mean and sum of squared deviations (M2) of features; updated chunk by chunk in float64 and combined
+# with the pairwise formulas of Chan et al., so the n x d features never have to be held or transposed
+class FeatureStats():
+    def __init__(self, dim):
+        self.dim = dim
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.M2 = np.zeros((dim, dim))
+
+    @classmethod
+    def from_moments(cls, n, mean, M2):
+        stats = cls(len(mean))
+        stats.n, stats.mean, stats.M2 = int(n), np.array(mean, dtype=np.float64), np.array(M2, dtype=np.float64)
+        return stats
+
+    @classmethod
+    def from_features(cls, features, chunk_size=10000):
+        stats = cls(features.shape[1])
+        for i in range(0, len(features), chunk_size):
+            stats.update(features[i:(i+chunk_size)])
+        return stats
+
+    def copy(self):
+        return FeatureStats.from_moments(self.n, self.mean, self.M2)
+
+    def update(self, features):
+        '''
+        features: a chunk of features (n x d); e.g., a float32 batch, converted to float64 chunk by chunk
+        '''
+        X = np.asarray(features, dtype=np.float64)
+        if len(X) == 0:
+            return self
+        mean = X.mean(axis=0)
+        X = X - mean
+        return self.merge(FeatureStats.from_moments(len(X), mean, X.transpose().dot(X)))
+
+    def merge(self, other):
+        '''
+        add the samples of other, e.g., of another worker or another label bin
+        '''
+        n = self.n + other.n
+        if other.n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.M2 = self.M2 + other.M2 + np.outer(delta, delta) * (self.n * other.n / n)
+        self.mean = self.mean + delta * (other.n / n)
+        self.n = n
+        return self
+
+    def subtract(self, other):
+        '''
+        remove the samples of other, which must be a subset of the samples of self; e.g., a bin leaving a sliding window
+        '''
+        n = self.n - other.n
+        if n < 0:
+            raise Exception('cannot subtract {} samples from {} samples!!!'.format(other.n, self.n))
+        if n == 0:
+            self.n, self.mean, self.M2 = 0, np.zeros(self.dim), np.zeros((self.dim, self.dim))
+            return self
+        mean = (self.n * self.mean - other.n * other.mean) / n
+        delta = other.mean - mean
+        self.M2 = self.M2 - other.M2 - np.outer(delta, delta) * (n * other.n / self.n)
+        self.mean = mean
+        self.n = n
+        return self
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def __sub__(self, other):
+        return self.copy().subtract(other)
+
+    def cov(self):
+        '''
+        sample covariance; same as np.cov
+        '''
+        if self.n < 2:
+            raise Exception('{} samples; cannot compute the covariance!!!'.format(self.n))
+        return self.M2 / (self.n - 1)
+
+    def mean_cov(self):
+        return self.mean, self.cov()
+
+    def save(self, filename):
+        FeatureStats.save_all(filename, [self])
+
+    @classmethod
+    def load(cls, filename):
+        return cls.load_all(filename)[0]
+
+    @staticmethod
+    def save_all(filename, stats_list):
+        '''
+        save a list of FeatureStats of the same dimension in one file, e.g., the statistics of each label bin
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp_filename = filename + '.tmp.{}.npz'.format(os.getpid())
+        np.savez(tmp_filename, n=np.array([s.n for s in stats_list]), mean=np.stack([s.mean for s in stats_list]), M2=np.stack([s.M2 for s in stats_list]))
+        os.replace(tmp_filename, filename) #atomic; concurrent runs never see a partial file
+
+    @classmethod
+    def load_all(cls, filename):
+        with np.load(filename) as f:
+            n = np.atleast_1d(f['n'])
+            mean = f['mean'].reshape(len(n), -1)
+            M2 = f['M2'].reshape(len(n), mean.shape[1], mean.shape[1])
+        return [cls.from_moments(n[i], mean[i], M2[i]) for i in range(len(n))]
+
 ##test
 #Xr = np.random.rand(10000,1000)
 #Xg = np.random.rand(10000,1000)
 #print(FID(Xr, Xg))
 
 # compute FID from raw images
-def cal_FID(PreNetFID, IMGSr, IMGSg, batch_size = 500, resize = None):
+def cal_FID(PreNetFID, IMGSr, IMGSg, batch_size = 500, resize = None, device = "cuda", bf16 = False, real_stats_filename = None):
     #resize: if None, do not resize; if resize = (H,W), resize images to 3 x H x W
-
-    PreNetFID.eval()
+    #real_stats_filename: if not None, FeatureStats of the real images; loaded if it exists, otherwise computed and saved
 
     nr = IMGSr.shape[0]
     ng = IMGSg.shape[0]
 
-    nc = IMGSr.shape[1] #IMGSr is nrxNCxIMG_SIExIMG_SIZE
-    img_size = IMGSr.shape[2]
-
     if batch_size > min(nr, ng):
         batch_size = min(nr, ng)
         # print("FID: recude batch size to {}".format(batch_size))
 
-    #compute the length of extracted features
-    with torch.no_grad():
-        test_img = torch.from_numpy(IMGSr[0].reshape((1,nc,img_size,img_size))).type(torch.float).cuda()
-        if resize is not None:
-            test_img = nn.functional.interpolate(test_img, size = resize, scale_factor=None, mode='bilinear', align_corners=False)
-        # _, test_features = PreNetFID(test_img)
-        test_features = PreNetFID(test_img)
-        d = test_features.shape[1] #length of extracted features
-
-    Xr = np.zeros((nr, d))
-    Xg = np.zeros((ng, d))
-
-    #batch_size = 500
-    with torch.no_grad():
-        tmp = 0
-        pb1 = SimpleProgressBar()
-        for i in range(nr//batch_size):
-            imgr_tensor = torch.from_numpy(IMGSr[tmp:(tmp+batch_size)]).type(torch.float).cuda()
-            if resize is not None:
-                imgr_tensor = nn.functional.interpolate(imgr_tensor, size = resize, scale_factor=None, mode='bilinear', align_corners=False)
-            # _, Xr_tmp = PreNetFID(imgr_tensor)
-            Xr_tmp = PreNetFID(imgr_tensor)
-            Xr[tmp:(tmp+batch_size)] = Xr_tmp.detach().cpu().numpy()
-            tmp+=batch_size
-            # pb1.update(min(float(i)*100/(nr//batch_size), 100))
-            pb1.update(min(max(tmp/nr*100,100), 100))
-        del Xr_tmp,imgr_tensor; gc.collect()
-        torch.cuda.empty_cache()
-
-        tmp = 0
-        pb2 = SimpleProgressBar()
-        for j in range(ng//batch_size):
-            imgg_tensor = torch.from_numpy(IMGSg[tmp:(tmp+batch_size)]).type(torch.float).cuda()
-            if resize is not None:
-                imgg_tensor = nn.functional.interpolate(imgg_tensor, size = resize, scale_factor=None, mode='bilinear', align_corners=False)
-            # _, Xg_tmp = PreNetFID(imgg_tensor)
-            Xg_tmp = PreNetFID(imgg_tensor)
-            Xg[tmp:(tmp+batch_size)] = Xg_tmp.detach().cpu().numpy()
-            tmp+=batch_size
-            # pb2.update(min(float(j)*100/(ng//batch_size), 100))
-            pb2.update(min(max(tmp/ng*100, 100), 100))
-        del Xg_tmp,imgg_tensor; gc.collect()
-        torch.cuda.empty_cache()
-
-
-    fid_score = FID(Xr, Xg, eps=1e-6)
+    # features of all images (including the last incomplete batch); no per-batch synchronization
+    if real_stats_filename is not None and os.path.isfile(real_stats_filename):
+        real_stats = FeatureStats.load(real_stats_filename)
+    else:
+        Xr = batched_inference(PreNetFID, IMGSr, batch_size=batch_size, resize=resize, device=device, name="FID encoder (real)", bf16=bf16)
+        real_stats = FeatureStats.from_features(Xr)
+        if real_stats_filename is not None:
+            real_stats.save(real_stats_filename)
+    Xg = batched_inference(PreNetFID, IMGSg, batch_size=batch_size, resize=resize, device=device, name="FID encoder (fake)", bf16=bf16)
+    fake_stats = FeatureStats.from_features(Xg)
+
+    fid_score = FID_from_stats(*real_stats.mean_cov(), *fake_stats.mean_cov(), eps=1e-6)
 
     return fid_score
 
@@ -143,7 +265,7 @@ def cal_FID(PreNetFID, IMGSr, IMGSg, batch_size = 500, resize = None):
 # label_score
 # difference between assigned label and predicted label
 ##############################################################################
-def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_label_after_shift, batch_size = 500, resize = None, num_workers=0):
+def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_label_after_shift, batch_size = 500, resize = None, num_workers=0, device = "cuda", bf16 = False):
     '''
     PreNet: pre-trained CNN
     images: fake images
@@ -151,38 +273,10 @@ def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_labe
     resize: if None, do not resize; if resize = (H,W), resize images to 3 x H x W
     '''
 
-    PreNet.eval()
-
-    # assume images are nxncximg_sizeximg_size
-    n = images.shape[0]
-    nc = images.shape[1] #number of channels
-    img_size = images.shape[2]
     labels_assi = labels_assi.reshape(-1)
 
-    eval_trainset = IMGs_dataset(images, labels_assi, normalize=False)
-    eval_dataloader = torch.utils.data.DataLoader(eval_trainset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-
-    labels_pred = np.zeros(n+batch_size)
-
-    nimgs_got = 0
-    pb = SimpleProgressBar()
-    for batch_idx, (batch_images, batch_labels) in enumerate(eval_dataloader):
-        batch_images = batch_images.type(torch.float).cuda()
-        batch_labels = batch_labels.type(torch.float).cuda()
-        batch_size_curr = len(batch_labels)
-
-        batch_labels_pred, _ = PreNet(batch_images)
-        labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_labels_pred.detach().cpu().numpy().reshape(-1)
-
-        nimgs_got += batch_size_curr
-        pb.update((float(nimgs_got)/n)*100)
-
-        del batch_images; gc.collect()
-        torch.cuda.empty_cache()
-    #end for batch_idx
-
-    labels_pred = labels_pred[0:n]
-
+    labels_pred = batched_inference(PreNet, images, batch_size=batch_size, resize=resize, device=device, outputs_fn=lambda out: out[0].view(-1), num_workers=num_workers, name="label score CNN", verbose=True, bf16=bf16)
+    labels_pred = labels_pred.astype(np.float64)
 
     labels_pred = (labels_pred*max_label_after_shift)-np.abs(min_label_before_shift)
     labels_assi = (labels_assi*max_label_after_shift)-np.abs(min_label_before_shift)
@@ -200,64 +294,78 @@ def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_labe
 ##############################################################################
 # Compute Inception Score
 ##############################################################################
-def inception_score(imgs, num_classes, net, cuda=True, batch_size=32, splits=1, normalize_img=False):
+def inception_score(imgs, num_classes, net, cuda=True, batch_size=32, splits=1, normalize_img=False, device=None, bf16=False):
     """Computes the inception score of the generated images imgs
     imgs -- unnormalized (3xHxW) numpy images
     net -- Classification CNN
     cuda -- whether or not to run on GPU
     batch_size -- batch size for feeding into Inception v3
     splits -- number of splits
+    device -- if not None, run on this device instead (overrides cuda)
+    bf16 -- use bf16 autocast on CPU
     """
     N = len(imgs)
 
     assert batch_size > 0
     assert N > batch_size
 
-    # Set up dtype
-    if cuda:
-        dtype = torch.cuda.FloatTensor
-    else:
-        if torch.cuda.is_available():
-            print("WARNING: You have a CUDA device, so you should probably set cuda=True")
-        dtype = torch.FloatTensor
+    if device is None:
+        device = "cuda" if cuda else "cpu"
 
     # Set up dataloader
     dataset = IMGs_dataset(imgs, labels=None, normalize=normalize_img)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    dataloader = IMGs_batch_loader(dataset, batch_size=batch_size)
 
     # Load inception model
-    if cuda:
-        net = net.cuda()
-    else:
-        net = net.cpu()
-    net.eval();
-    def get_pred(x):
-        x,_ = net(x)
-        return F.softmax(x, dim=1).data.cpu().numpy()
-
-    # Get predictions
-    preds = np.zeros((N, num_classes))
-
-    for i, batch in enumerate(dataloader, 0):
-        batch = batch.type(dtype)
-        batchv = Variable(batch)
-        batch_size_i = batch.size()[0]
-
-        preds[i*batch_size:i*batch_size + batch_size_i] = get_pred(batchv)
-
-    # Now compute the mean kl-div
-    split_scores = []
-
-    for k in range(splits):
-        part = preds[k * (N // splits): (k+1) * (N // splits), :]
-        py = np.mean(part, axis=0)
-        scores = []
-        for i in range(part.shape[0]):
-            pyx = part[i, :]
-            scores.append(entropy(pyx, py))
-        split_scores.append(np.exp(np.mean(scores)))
-
-    return np.mean(split_scores), np.std(split_scores)
+    net = prepare_inference_net(net, device)
+    channels_last = torch.device(device).type == "cpu"
+
+    # split k: images [k*(N//splits), (k+1)*(N//splits)); the remaining images are not used
+    split_ids = np.arange(N) // (N // splits)
+    accumulator = InceptionScoreAccumulator(num_classes, splits=splits)
+
+    # Get predictions; only the per-split sums are kept
+    nimgs_got = 0
+    with inference_context(device, bf16=bf16):
+        for batch in dataloader:
+            batch = batch.type(torch.float).to(device)
+            if channels_last:
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            x,_ = net(batch)
+            batch_preds = F.softmax(x, dim=1).cpu().numpy()
+            accumulator.update(batch_preds, split_ids[nimgs_got:(nimgs_got+len(batch_preds))])
+            nimgs_got += len(batch_preds)
+
+    return accumulator.score()
+
+
+# streaming inception score: only keeps the per-split sums of p(y|x) and of sum_y p(y|x)log(p(y|x));
+# the mean KL of a split is E[sum_y p(y|x)log(p(y|x))] - sum_y p(y)log(p(y))
+class InceptionScoreAccumulator():
+    def __init__(self, num_classes, splits=1):
+        self.splits = splits
+        self.counts = np.zeros(splits)
+        self.sum_py = np.zeros((splits, num_classes))
+        self.sum_plogp = np.zeros(splits)
+
+    def update(self, preds, split_ids):
+        '''
+        preds: predicted class probabilities of a batch (n x num_classes)
+        split_ids: split of each image; images with split_ids outside {0,...,splits-1} are not used
+        '''
+        preds = np.asarray(preds, dtype=np.float64)
+        split_ids = np.asarray(split_ids).reshape(-1)
+        mask = (split_ids >= 0) * (split_ids < self.splits)
+        preds, split_ids = preds[mask], split_ids[mask]
+        self.counts += np.bincount(split_ids, minlength=self.splits)
+        np.add.at(self.sum_py, split_ids, preds)
+        self.sum_plogp += np.bincount(split_ids, weights=xlogy(preds, preds).sum(axis=1), minlength=self.splits)
+
+    def score(self):
+        py = self.sum_py / self.counts[:,None]
+        kl_mean = self.sum_plogp / self.counts - xlogy(py, py).sum(axis=1)
+        split_scores = np.exp(kl_mean)
+        return np.mean(split_scores), np.std(split_scores)
 
 
 # from torchvision.models.inception import inception_v3
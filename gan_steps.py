@@ -0,0 +1,106 @@
+"""
+Forward passes and losses of the CcGAN training steps
+
+The D step (generate a fake batch, score the real and fake batches) and the G step
+(generate a batch and score it) are plain functions of the networks and the batch
+tensors, so that train_CcGAN can capture them as compiled graphs with
+torch.compile; batch sizes are constant (batch_size_disc and batch_size_gene), so
+the graphs are compiled with static shapes once. The backward passes and the
+optimizer steps stay outside the compiled functions.
+
+With DDP, CcGAN_D_loss gets netG.module and the DDP-wrapped netD, and
+CcGAN_G_loss the DDP-wrapped netG and netD.module, so that each step only
+all-reduces the gradients of the net it updates.
+
+"""
+import os
+import torch
+from torch.nn import functional as F
+
+from utils import amp_context
+
+
+# D loss of a CcGAN step; real_weights and fake_weights are the vicinity weights (ones for hard vicinity)
+def CcGAN_D_loss(netG, netD, net_y2h, z, batch_fake_labels, batch_real_images, batch_target_labels, real_weights, fake_weights, loss_type='vanilla', amp_dtype=None):
+    with amp_context(z.device, amp_dtype):
+        # the fake batch is not backpropagated through netG
+        with torch.no_grad():
+            batch_fake_images = netG(z, net_y2h(batch_fake_labels))
+        h_target = net_y2h(batch_target_labels)
+        # score the real and fake batches in one forward pass of netD (one gradient all-reduce with DDP)
+        dis_out = netD(torch.cat((batch_real_images, batch_fake_images.type(batch_real_images.dtype))), torch.cat((h_target, h_target)))
+    # the losses are computed from the logits in float32
+    dis_out = dis_out.float()
+    real_dis_out, fake_dis_out = dis_out[0:len(batch_real_images)], dis_out[len(batch_real_images):]
+
+    if loss_type == "vanilla":
+        # -log(sigmoid(x)) = softplus(-x) and -log(1-sigmoid(x)) = softplus(x)
+        d_loss_real = F.softplus(-real_dis_out)
+        d_loss_fake = F.softplus(fake_dis_out)
+    elif loss_type == "hinge":
+        d_loss_real = F.relu(1.0 - real_dis_out)
+        d_loss_fake = F.relu(1.0 + fake_dis_out)
+    else:
+        raise Exception('unknown loss type: {}!!!'.format(loss_type))
+
+    d_loss = torch.mean(real_weights.view(-1) * d_loss_real.view(-1)) + torch.mean(fake_weights.view(-1) * d_loss_fake.view(-1))
+    return d_loss, real_dis_out, fake_dis_out
+
+
+# G loss of a CcGAN step
+def CcGAN_G_loss(netG, netD, net_y2h, z, batch_target_labels, loss_type='vanilla', amp_dtype=None):
+    with amp_context(z.device, amp_dtype):
+        h_target = net_y2h(batch_target_labels)
+        batch_fake_images = netG(z, h_target)
+        dis_out = netD(batch_fake_images, h_target)
+    dis_out = dis_out.float()
+
+    if loss_type == "vanilla":
+        g_loss = torch.mean(F.softplus(-dis_out))
+    elif loss_type == "hinge":
+        g_loss = - dis_out.mean()
+    else:
+        raise Exception('unknown loss type: {}!!!'.format(loss_type))
+    return g_loss
+
+
+################################################################################
+# torch.compile with a fallback to eager mode
+def set_compile_cache_dir(cache_dir):
+    '''
+    keep the compiled kernels and graphs of inductor on disk, so that a resumed run does not recompile
+    from scratch; has to be called before the first compilation
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+
+class CompiledStep():
+    def __init__(self, fn, name, enabled=True, dynamic=False, mode=None):
+        '''
+        fn: the function to compile
+        enabled: if False, or if torch.compile is not available, fn runs eagerly
+        dynamic: False compiles for static shapes
+        if the compiled fn fails at any call (compilation happens at the first call, recompilation
+        whenever a guard fails), fn runs eagerly from then on
+        '''
+        self.fn = fn
+        self.name = name
+        self.compiled = None
+        self.ncalls = 0
+        if enabled:
+            if hasattr(torch, 'compile'):
+                self.compiled = torch.compile(fn, dynamic=dynamic, mode=mode)
+            else:
+                print("\n torch.compile is not available; {} runs eagerly.".format(name))
+
+    def __call__(self, *args, **kwargs):
+        self.ncalls += 1
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                print("\n Compiled {} failed at call {} ({}: {}); it runs eagerly.".format(self.name, self.ncalls, type(e).__name__, e))
+                self.compiled = None
+        return self.fn(*args, **kwargs)
@@ -192,6 +192,42 @@ class model_y2h(nn.Module):
         return self.main(y)
 
 
+#------------------------------------------------------------------------------
+# a frozen net_y2h tabulated on a fine grid of labels; queried by linear interpolation
+class model_y2h_table(nn.Module):
+    def __init__(self, net_y2h, num_points=2**16, y_min=-0.5, y_max=1.5, max_error=1e-3, batch_size=4096):
+        '''
+        net_y2h: a trained model_y2h; labels outside [y_min, y_max] are clamped
+        max_error: bound on the max abs difference to net_y2h, checked at the midpoints of the grid cells
+        '''
+        super(model_y2h_table, self).__init__()
+        self.num_points = num_points
+        self.y_min = y_min
+        self.y_max = y_max
+
+        device = next(net_y2h.parameters()).device
+        was_training = net_y2h.training
+        net_y2h.eval()
+        with torch.no_grad():
+            grid = torch.linspace(y_min, y_max, num_points, dtype=torch.float, device=device)
+            table = torch.cat([net_y2h(grid[i:(i+batch_size)]) for i in range(0, num_points, batch_size)], dim=0)
+            # linear interpolation is worst at the midpoints of the grid cells
+            grid_mid = (grid[0:-1]+grid[1:])/2
+            h_mid = torch.cat([net_y2h(grid_mid[i:(i+batch_size)]) for i in range(0, num_points-1, batch_size)], dim=0)
+            self.error = (h_mid - (table[0:-1]+table[1:])/2).abs().max().item()
+        net_y2h.train(was_training)
+        if self.error > max_error:
+            raise Exception('the label embedding table with {} points has error {} > {}; use more points!!!'.format(num_points, self.error, max_error))
+
+        self.register_buffer('table', table)
+
+    def forward(self, y):
+        y = y.view(-1).clamp(self.y_min, self.y_max)
+        pos = (y - self.y_min) * ((self.num_points-1)/(self.y_max-self.y_min))
+        indx = pos.floor().clamp(0, self.num_points-2).long()
+        weight = (pos - indx).view(-1, 1)
+        return torch.lerp(self.table[indx], self.table[indx+1], weight)
+
 
 if __name__ == "__main__":
     net = ResNet34_embed(ngpu = 1).cuda()
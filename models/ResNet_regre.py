@@ -129,7 +129,7 @@ class ResNet_regre(nn.Module):
             ft3 = self.block3(ft2)
             ft4 = self.block4(ft3)
             out = self.pool1(ft4)
-            out = out.view(out.size(0), -1)
+            out = out.reshape(out.size(0), -1)
             out = self.linear(out)
 
         # ## use f4 feature
@@ -140,7 +140,7 @@ class ResNet_regre(nn.Module):
         ext_features = self.pool2(ft2)
 
 
-        ext_features = ext_features.view(ext_features.size(0), -1)
+        ext_features = ext_features.reshape(ext_features.size(0), -1) #also for the channels_last layout
 
         return out, ext_features
 
@@ -46,7 +46,7 @@ class encoder(nn.Module):
 
     def forward(self, x):
         feature = self.conv(x)
-        feature = feature.view(-1, self.ch*8*4*4)
+        feature = feature.reshape(-1, self.ch*8*4*4) #also for the channels_last layout
         feature = self.linear(feature)
         return feature
 
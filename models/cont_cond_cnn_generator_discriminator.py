@@ -52,6 +52,17 @@ class ConditionalBatchNorm2d(nn.Module):
 
         return out
 
+    def fold(self, y):
+        '''
+        eval mode only: fuse the running BN statistics and the conditional affine of the
+        embedded labels y into bn(x)+bn(x)*gamma+beta = x*scale+shift
+        return: scale, shift; both of shape (len(y), num_features)
+        '''
+        inv_std = torch.rsqrt(self.bn.running_var + self.bn.eps)
+        scale = (1 + self.embed_gamma(y)) * inv_std
+        shift = self.embed_beta(y) - self.bn.running_mean * scale
+        return scale, shift
+
 
 
 class ResBlockGenerator(nn.Module):
@@ -102,6 +113,18 @@ class ResBlockGenerator(nn.Module):
             out = self.model(x) + self.bypass(x)
         return out
 
+    def forward_folded(self, x, scale1, shift1, scale2, shift2):
+        # conditional BNs folded by ConditionalBatchNorm2d.fold
+        out = torch.addcmul(shift1[:,:,None,None], x, scale1[:,:,None,None])
+        out = self.relu(out)
+        out = self.upsample(out)
+        out = self.conv1(out)
+        out = torch.addcmul(shift2[:,:,None,None], out, scale2[:,:,None,None])
+        out = self.relu(out)
+        out = self.conv2(out)
+        out = out + self.bypass(x)
+        return out
+
 
 
 class cont_cond_cnn_generator(nn.Module):
@@ -127,19 +150,69 @@ class cont_cond_cnn_generator(nn.Module):
             nn.Tanh()
         )
 
-    def forward(self, z, y): #y is embedded in the feature space
+        # folded conditional BN parameters of each label for inference; see fold_labels
+        self.folded_cache = {}
+
+    def forward(self, z, y, folded=False):
+        '''
+        y: labels embedded in the feature space;
+           if folded, the folded conditional BN parameters from fold_labels instead
+        '''
         z = z.view(z.size(0), z.size(1))
         out = self.dense(z)
         out = out.view(-1, GEN_SIZE*16, 4, 4)
 
-        out = self.genblock0(out, y)
-        out = self.genblock1(out, y)
-        out = self.genblock2(out, y)
-        out = self.genblock3(out, y)
+        genblocks = [self.genblock0, self.genblock1, self.genblock2, self.genblock3]
+        if folded:
+            params = torch.split(y, self.folded_sizes(), dim=1)
+            for i, genblock in enumerate(genblocks):
+                out = genblock.forward_folded(out, *params[(4*i):(4*i+4)])
+        else:
+            for genblock in genblocks:
+                out = genblock(out, y)
         out = self.final(out)
 
         return out
 
+    def condbns(self):
+        return [bn for block in [self.genblock0, self.genblock1, self.genblock2, self.genblock3] for bn in [block.condbn1, block.condbn2]]
+
+    def folded_sizes(self):
+        return [bn.num_features for bn in self.condbns() for _ in range(2)]
+
+    def train(self, mode=True):
+        # the folded parameters depend on the weights and the running BN statistics, which only change in
+        # training mode; calling eval() on a net in eval mode keeps the cache
+        if mode or self.training:
+            self.folded_cache = {}
+        return super(cont_cond_cnn_generator, self).train(mode)
+
+    def clear_folded_cache(self):
+        self.folded_cache = {}
+
+    def fold_labels(self, labels, net_y2h):
+        '''
+        eval mode only: the scale and shift of every conditional BN for a batch of labels, with
+        the running BN statistics folded in; each unique label is folded once and then cached
+        labels: normalized labels (numpy array or list)
+        return: (len(labels), sum(folded_sizes())) on the device of the generator; input of forward(z, y, folded=True)
+        '''
+        assert not self.training
+        labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+        unique_labels, inverse = np.unique(labels, return_inverse=True)
+        new_labels = [lb for lb in unique_labels if lb not in self.folded_cache]
+        if len(new_labels)>0:
+            device = self.dense.weight.device
+            # always in float32, also under autocast, since the folded parameters are cached
+            with torch.no_grad(), torch.autocast(device_type=device.type, enabled=False):
+                y = torch.from_numpy(np.array(new_labels)).type(torch.float).view(-1,1).to(device)
+                h = net_y2h(y)
+                params = torch.cat([p for bn in self.condbns() for p in bn.fold(h)], dim=1)
+            for i, lb in enumerate(new_labels):
+                self.folded_cache[lb] = params[i]
+        params = torch.stack([self.folded_cache[lb] for lb in unique_labels], dim=0)
+        return params[torch.from_numpy(inverse.reshape(-1)).to(params.device)]
+
 
 
 ######################################################################################################################
@@ -25,15 +25,31 @@ def parse_opts():
     # label embedding setting
     parser.add_argument('--net_embed', type=str, default='ResNet34_embed') #ResNetXX_emebed
     parser.add_argument('--epoch_cnn_embed', type=int, default=200) #epoch of cnn training for label embedding
-    parser.add_argument('--resumeepoch_cnn_embed', type=int, default=0) #epoch of cnn training for label embedding
+    parser.add_argument('--resumeepoch_cnn_embed', type=int, default=0) #epoch of cnn training for label embedding; -1 for the latest checkpoint
     parser.add_argument('--epoch_net_y2h', type=int, default=500)
     parser.add_argument('--dim_embed', type=int, default=128) #dimension of the embedding space
     parser.add_argument('--batch_size_embed', type=int, default=256, metavar='N')
+    parser.add_argument('--y2h_table_points', type=int, default=65536,
+                        help='tabulate the trained net_y2h on this many labels and interpolate; 0 to use net_y2h directly')
+    parser.add_argument('--y2h_table_max_error', type=float, default=1e-3)
 
     parser.add_argument('--loss_type_gan', type=str, default='vanilla')
     parser.add_argument('--niters_gan', type=int, default=10000, help='number of iterations')
-    parser.add_argument('--resume_niters_gan', type=int, default=0)
+    parser.add_argument('--resume_niters_gan', type=int, default=0, help='iteration to resume from; -1 for the latest checkpoint')
+    parser.add_argument('--gan_amp', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help='mixed precision training of the GAN; fp16 falls back to bf16 on CPU')
+    parser.add_argument('--gan_compile', action='store_true', default=False,
+                        help='capture the D and G steps of CcGAN with torch.compile; falls back to eager mode')
+    parser.add_argument('--compile_cache_dir', type=str, default='', help='cache of the compiled steps; default: root_path/torch_cache/inductor')
+    parser.add_argument('--gan_ddp_world_size', type=int, default=1,
+                        help='train CcGAN with this many processes on this CPU host (DDP over gloo); batch sizes are split among them')
+    parser.add_argument('--gan_ddp_num_threads', type=int, default=0, help='torch threads of each CcGAN process; 0: number of threads // processes')
+    parser.add_argument('--gan_ddp_master_port', type=int, default=29500, help='port of the rendezvous of the CcGAN processes')
     parser.add_argument('--save_niters_freq', type=int, default=2000, help='frequency of saving checkpoints')
+    parser.add_argument('--ckpt_keep_last', type=int, default=0,
+                        help='number of most recent in-training checkpoints to keep; 0 keeps all')
+    parser.add_argument('--ckpt_milestone_freq', type=int, default=0,
+                        help='in-training checkpoints at multiples of this step are never deleted; 0 for none')
     parser.add_argument('--lr_g_gan', type=float, default=1e-4, help='learning rate for generator')
     parser.add_argument('--lr_d_gan', type=float, default=1e-4, help='learning rate for discriminator')
     parser.add_argument('--dim_gan', type=int, default=128, help='Latent dimension of GAN')
@@ -55,7 +71,18 @@ def parse_opts():
     parser.add_argument('--comp_FID', action='store_true', default=False)
     parser.add_argument('--epoch_FID_CNN', type=int, default=200)
     parser.add_argument('--FID_radius', type=int, default=5)
+    parser.add_argument('--dump_fake_format', type=str, default='png', choices=['png', 'h5', 'none'],
+                        help='dump the fake images for NIQE as png files, as one chunked h5 file, or not at all')
+    parser.add_argument('--dump_num_workers', type=int, default=8, help='number of threads encoding the dumped png files')
+    parser.add_argument('--fid_backend', type=str, default='eigh', choices=['sqrtm', 'eigh', 'torch'],
+                        help='trace sqrt in FID: scipy sqrtm of the covariance product, symmetric eigh, or batched torch eigvalsh')
     parser.add_argument('--comp_IS_and_FID_only', action='store_true', default=False)
+    parser.add_argument('--window_num_workers', type=int, default=1, help='number of workers evaluating the sliding windows; 1 is sequential')
+    parser.add_argument('--window_executor', type=str, default='thread', choices=['thread', 'process'])
+    parser.add_argument('--window_blas_threads', type=int, default=0, help='BLAS threads of each window worker; 0: number of cores // workers')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of CPU threads of torch; 0 keeps the default')
+    parser.add_argument('--eval_bf16', action='store_true', default=False,
+                        help='sample and evaluate with bf16 autocast on CPU-only hosts')
 
     args = parser.parse_args()
 
@@ -30,7 +30,9 @@ parser.add_argument('--data_path', type=str, default='dataset')
 parser.add_argument('--dim_bottleneck', type=int, default=512)
 parser.add_argument('--epochs', type=int, default=200, metavar='N',
                     help='number of epochs to train CNNs (default: 200)')
-parser.add_argument('--resume_epoch', type=int, default=0)
+parser.add_argument('--resume_epoch', type=int, default=0, help='epoch to resume from; -1 for the latest checkpoint')
+parser.add_argument('--ckpt_keep_last', type=int, default=0,
+                    help='number of most recent in-training checkpoints to keep; 0 keeps all')
 parser.add_argument('--batch_size_train', type=int, default=256, metavar='N',
                     help='input batch size for training')
 parser.add_argument('--batch_size_valid', type=int, default=10, metavar='N',
@@ -55,7 +57,9 @@ args = parser.parse_args()
 wd = args.root_path
 os.chdir(wd)
 from models import *
-from utils import IMGs_dataset, SimpleProgressBar
+from utils import IMGs_dataset, IMGs_batch_loader, images_to_device, SimpleProgressBar, get_device, wrap_data_parallel, load_net_state_dict
+from utkface_data import load_UTKFace_h5
+from checkpoint_utils import CheckpointManager
 
 # some parameters in the opts
 dim_bottleneck = args.dim_bottleneck
@@ -64,9 +68,13 @@ base_lr = args.base_lr
 lr_decay_epochs = args.lr_decay_epochs
 lr_decay_factor = args.lr_decay_factor
 resume_epoch = args.resume_epoch
+ckpt_keep_last = args.ckpt_keep_last
 lambda_sparsity = args.lambda_sparsity
 
 
+# cuda if available, otherwise cpu
+device = get_device()
+
 # random seed
 random.seed(args.seed)
 torch.manual_seed(args.seed)
@@ -88,11 +96,8 @@ os.makedirs(save_AE_images_in_valid_folder, exist_ok=True)
 ###########################################################################################################
 # data loader
 data_filename = args.data_path + '/UTKFace_' + str(args.img_size) + 'x' + str(args.img_size) + '.h5'
-hf = h5py.File(data_filename, 'r')
-labels = hf['labels'][:]
+images, labels, _ = load_UTKFace_h5(data_filename) #images: a lazy view of the h5 file
 labels = labels.astype(np.float64)
-images = hf['images'][:]
-hf.close()
 N_all = len(images)
 assert len(images) == len(labels)
 
@@ -101,7 +106,7 @@ q1 = args.min_age
 q2 = args.max_age
 indx = np.where((labels>q1)*(labels<q2)==True)[0]
 labels = labels[indx]
-images = images[indx]
+images = images.subset(indx)
 assert len(labels)==len(images)
 
 # define training and validation sets
@@ -113,14 +118,14 @@ if args.CVMode:
     indx_valid = indx_all[0:int(valid_prop*len(images))]
     indx_train = indx_all[int(valid_prop*len(images)):]
 
-    trainset = IMGs_dataset(images[indx_train], labels=None, normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True)
-    validset = IMGs_dataset(images[indx_valid], labels=None, normalize=True)
-    validloader = torch.utils.data.DataLoader(validset, batch_size=args.batch_size_valid, shuffle=False)
+    trainset = IMGs_dataset(images.subset(indx_train), labels=None, normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True)
+    validset = IMGs_dataset(images.subset(indx_valid), labels=None, normalize=True, normalize_on_device=True)
+    validloader = IMGs_batch_loader(validset, batch_size=args.batch_size_valid, shuffle=False)
 
 else:
-    trainset = IMGs_dataset(images, labels=None, normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True)
+    trainset = IMGs_dataset(images, labels=None, normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True)
 
 
 ###########################################################################################################
@@ -146,12 +151,17 @@ def train_AE():
     # criterion
     criterion = nn.MSELoss()
 
-    if resume_epoch>0:
+    # checkpoints are written in the background; with ckpt_keep_last>0 only the last ckpt_keep_last ones and the last epoch are kept
+    ckpt_manager = CheckpointManager(save_models_folder + "/AE_checkpoint_intrain", "AE_checkpoint_epoch_{}_lambda_{}.pth".format('{}', lambda_sparsity), keep_last=ckpt_keep_last, milestones=[epochs])
+    start_epoch = resume_epoch
+    if start_epoch<0: #resume from the latest checkpoint
+        start_epoch = ckpt_manager.latest() or 0
+
+    if start_epoch>0:
         print("Loading ckpt to resume training AE >>>")
-        ckpt_fullpath = save_models_folder + "/AE_checkpoint_intrain/AE_checkpoint_epoch_{}_lambda_{}.pth".format(resume_epoch, lambda_sparsity)
-        checkpoint = torch.load(ckpt_fullpath)
-        net_encoder.load_state_dict(checkpoint['net_encoder_state_dict'])
-        net_decoder.load_state_dict(checkpoint['net_decoder_state_dict'])
+        checkpoint = ckpt_manager.load(start_epoch, map_location="cpu")
+        load_net_state_dict(net_encoder, checkpoint['net_encoder_state_dict'])
+        load_net_state_dict(net_decoder, checkpoint['net_decoder_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         torch.set_rng_state(checkpoint['rng_state'])
         gen_iterations = checkpoint['gen_iterations']
@@ -159,7 +169,7 @@ def train_AE():
         gen_iterations = 0
 
     start_time = timeit.default_timer()
-    for epoch in range(resume_epoch, epochs):
+    for epoch in range(start_epoch, epochs):
 
         adjust_learning_rate(epoch, epochs, optimizer, base_lr, lr_decay_epochs, lr_decay_factor)
 
@@ -172,7 +182,7 @@ def train_AE():
 
             batch_size_curr = batch_real_images.shape[0]
 
-            batch_real_images = batch_real_images.type(torch.float).cuda()
+            batch_real_images = images_to_device(batch_real_images, device, normalize=True)
 
 
             batch_features = net_encoder(batch_real_images)
@@ -204,16 +214,15 @@ def train_AE():
         # end for batch_idx
 
         if (epoch+1) % 50 == 0:
-            save_file = save_models_folder + "/AE_checkpoint_intrain/AE_checkpoint_epoch_{}_lambda_{}.pth".format(epoch+1, lambda_sparsity)
-            os.makedirs(os.path.dirname(save_file), exist_ok=True)
-            torch.save({
+            ckpt_manager.save(epoch+1, {
                     'gen_iterations': gen_iterations,
                     'net_encoder_state_dict': net_encoder.state_dict(),
                     'net_decoder_state_dict': net_decoder.state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'rng_state': torch.get_rng_state()
-            }, save_file)
+            })
     #end for epoch
+    ckpt_manager.close() #wait for the last checkpoints
 
     return net_encoder, net_decoder
 
@@ -224,7 +233,7 @@ if args.CVMode:
         net_decoder.eval()
         with torch.no_grad():
             for batch_idx, images in enumerate(validloader):
-                images = images.type(torch.float).cuda()
+                images = images_to_device(images, device, normalize=True)
                 features = net_encoder(images)
                 recons_images = net_decoder(features)
                 save_image(recons_images.data, save_AE_images_in_valid_folder + '/{}_recons.png'.format(batch_idx), nrow=10, normalize=True)
@@ -238,10 +247,10 @@ if args.CVMode:
 ###########################################################################################################
 
 # model initialization
-net_encoder = encoder(dim_bottleneck=args.dim_bottleneck).cuda()
-net_decoder = decoder(dim_bottleneck=args.dim_bottleneck).cuda()
-net_encoder = nn.DataParallel(net_encoder)
-net_decoder = nn.DataParallel(net_decoder)
+net_encoder = encoder(dim_bottleneck=args.dim_bottleneck).to(device)
+net_decoder = decoder(dim_bottleneck=args.dim_bottleneck).to(device)
+net_encoder = wrap_data_parallel(net_encoder, device)
+net_decoder = wrap_data_parallel(net_decoder, device)
 
 filename_ckpt = save_models_folder + '/ckpt_AE_epoch_{}_seed_{}_CVMode_{}.pth'.format(args.epochs, args.seed, args.CVMode)
 
@@ -260,9 +269,9 @@ if not os.path.isfile(filename_ckpt):
 else:
     print("\n Ckpt already exists")
     print("\n Loading...")
-    checkpoint = torch.load(filename_ckpt)
-    net_encoder.load_state_dict(checkpoint['net_encoder_state_dict'])
-    net_decoder.load_state_dict(checkpoint['net_decoder_state_dict'])
+    checkpoint = torch.load(filename_ckpt, map_location=device)
+    load_net_state_dict(net_encoder, checkpoint['net_encoder_state_dict'])
+    load_net_state_dict(net_decoder, checkpoint['net_decoder_state_dict'])
 
 if args.CVMode:
     #validation
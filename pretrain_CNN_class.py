@@ -61,12 +61,13 @@ args = parser.parse_args()
 wd = args.root_path
 os.chdir(wd)
 from models import *
-from utils import IMGs_dataset
+from utils import IMGs_dataset, IMGs_batch_loader, images_to_device, get_device, load_net_state_dict
+from utkface_data import load_UTKFace_h5, select_ages
 
 
 
-# cuda
-device = torch.device("cuda")
+# cuda if available, otherwise cpu
+device = get_device()
 ngpu = torch.cuda.device_count()  # number of gpus
 
 # random seed
@@ -85,32 +86,15 @@ os.makedirs(save_logs_folder, exist_ok=True)
 
 # data loader
 data_filename = args.data_path + '/UTKFace_' + str(args.img_size) + 'x' + str(args.img_size) + '.h5'
-hf = h5py.File(data_filename, 'r')
-ages = hf['labels'][:]
+images, ages, labels = load_UTKFace_h5(data_filename) #images: a lazy view of the h5 file; labels: races
 ages = ages.astype(np.float64)
-labels = hf['races'][:]
-images = hf['images'][:]
-hf.close()
 num_classes = len(set(labels))
 
 # subset of UTKFace
-selected_ages = np.arange(args.min_age, args.max_age+1)
-for i in range(len(selected_ages)):
-    curr_age = selected_ages[i]
-    index_curr_age = np.where(ages==curr_age)[0]
-    if i == 0:
-        images_subset = images[index_curr_age]
-        labels_subset = labels[index_curr_age]
-        ages_subset = ages[index_curr_age]
-    else:
-        images_subset = np.concatenate((images_subset, images[index_curr_age]), axis=0)
-        labels_subset = np.concatenate((labels_subset, labels[index_curr_age]))
-        ages_subset = np.concatenate((ages_subset, ages[index_curr_age]))
-# for i
-images = images_subset
-labels = labels_subset
-ages = ages_subset
-del images_subset, labels_subset, ages_subset; gc.collect()
+index_subset = select_ages(ages, args.min_age, args.max_age)
+images = images.subset(index_subset)
+labels = labels[index_subset]
+ages = ages[index_subset]
 
 
 # define training (and validaiton) set
@@ -127,13 +111,13 @@ if args.CVMode:
             indx_valid = np.concatenate((indx_valid, indx_i[0:num_imgs_valid_i]))
             indx_train = np.concatenate((indx_train, indx_i[num_imgs_valid_i:]))
     #end for i
-    trainset = IMGs_dataset(images[indx_train], labels[indx_train], normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
-    validset = IMGs_dataset(images[indx_valid], labels[indx_valid], normalize=True)
-    validloader = torch.utils.data.DataLoader(validset, batch_size=args.batch_size_valid, shuffle=False, num_workers=8)
+    trainset = IMGs_dataset(images.subset(indx_train), labels[indx_train], normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
+    validset = IMGs_dataset(images.subset(indx_valid), labels[indx_valid], normalize=True, normalize_on_device=True)
+    validloader = IMGs_batch_loader(validset, batch_size=args.batch_size_valid, shuffle=False, num_workers=8)
 else:
-    trainset = IMGs_dataset(images, labels, normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
+    trainset = IMGs_dataset(images, labels, normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
 
 
 ###########################################################################################################
@@ -181,8 +165,8 @@ def train_CNN():
 
             # batch_train_images = nn.functional.interpolate(batch_train_images, size = (299,299), scale_factor=None, mode='bilinear', align_corners=False)
 
-            batch_train_images = batch_train_images.type(torch.float).cuda()
-            batch_train_labels = batch_train_labels.type(torch.long).cuda()
+            batch_train_images = images_to_device(batch_train_images, device, normalize=True)
+            batch_train_labels = batch_train_labels.type(torch.long).to(device)
 
             #Forward pass
             outputs,_ = net(batch_train_images)
@@ -214,8 +198,8 @@ if args.CVMode:
             correct = 0
             total = 0
             for batch_idx, (images, labels) in enumerate(validloader):
-                images = images.type(torch.float).cuda()
-                labels = labels.type(torch.long).cuda()
+                images = images_to_device(images, device, normalize=True)
+                labels = labels.type(torch.long).to(device)
                 outputs,_ = net(images)
                 _, predicted = torch.max(outputs.data, 1)
                 total += labels.size(0)
@@ -251,8 +235,8 @@ if not os.path.isfile(filename_ckpt):
 else:
     print("\n Ckpt already exists")
     print("\n Loading...")
-    checkpoint = torch.load(filename_ckpt)
-    net.load_state_dict(checkpoint['net_state_dict'])
+    checkpoint = torch.load(filename_ckpt, map_location=device)
+    load_net_state_dict(net, checkpoint['net_state_dict'])
 torch.cuda.empty_cache()#release GPU mem which is  not references
 
 if args.CVMode:
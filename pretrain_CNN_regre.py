@@ -60,11 +60,12 @@ args = parser.parse_args()
 wd = args.root_path
 os.chdir(wd)
 from models import *
-from utils import IMGs_dataset
+from utils import IMGs_dataset, IMGs_batch_loader, images_to_device, get_device, load_net_state_dict
+from utkface_data import load_UTKFace_h5, select_ages
 
 
-# cuda
-device = torch.device("cuda")
+# cuda if available, otherwise cpu
+device = get_device()
 ngpu = torch.cuda.device_count()  # number of gpus
 
 # random seed
@@ -86,28 +87,14 @@ os.makedirs(save_logs_folder, exist_ok=True)
 ###########################################################################################################
 # data loader
 data_filename = args.data_path + '/UTKFace_' + str(args.img_size) + 'x' + str(args.img_size) + '.h5'
-hf = h5py.File(data_filename, 'r')
-labels = hf['labels'][:]
+images, labels, _ = load_UTKFace_h5(data_filename) #images: a lazy view of the h5 file
 labels = labels.astype(np.float64)
-images = hf['images'][:]
-hf.close()
 
 
 # subset of UTKFace
-selected_labels = np.arange(args.min_age, args.max_age+1)
-for i in range(len(selected_labels)):
-    curr_label = selected_labels[i]
-    index_curr_label = np.where(labels==curr_label)[0]
-    if i == 0:
-        images_subset = images[index_curr_label]
-        labels_subset = labels[index_curr_label]
-    else:
-        images_subset = np.concatenate((images_subset, images[index_curr_label]), axis=0)
-        labels_subset = np.concatenate((labels_subset, labels[index_curr_label]))
-# for i
-images = images_subset
-labels = labels_subset
-del images_subset, labels_subset; gc.collect()
+index_subset = select_ages(labels, args.min_age, args.max_age)
+images = images.subset(index_subset)
+labels = labels[index_subset]
 
 N_all = len(images)
 assert len(images) == len(labels)
@@ -154,14 +141,14 @@ if args.CVMode:
             indx_train = np.concatenate((indx_train, indx_i[n_valid_img_per_class:]))
     #end for i
 
-    trainset = IMGs_dataset(images[indx_train], labels[indx_train], normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
-    validset = IMGs_dataset(images[indx_valid], labels[indx_valid], normalize=True)
-    validloader = torch.utils.data.DataLoader(validset, batch_size=args.batch_size_valid, shuffle=False, num_workers=8)
+    trainset = IMGs_dataset(images.subset(indx_train), labels[indx_train], normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
+    validset = IMGs_dataset(images.subset(indx_valid), labels[indx_valid], normalize=True, normalize_on_device=True)
+    validloader = IMGs_batch_loader(validset, batch_size=args.batch_size_valid, shuffle=False, num_workers=8)
 
 else:
-    trainset = IMGs_dataset(images, labels, normalize=True)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
+    trainset = IMGs_dataset(images, labels, normalize=True, normalize_on_device=True)
+    trainloader = IMGs_batch_loader(trainset, batch_size=args.batch_size_train, shuffle=True, num_workers=8)
 
 
 
@@ -211,8 +198,8 @@ def train_CNN():
 
             # batch_train_images = nn.functional.interpolate(batch_train_images, size = (299,299), scale_factor=None, mode='bilinear', align_corners=False)
 
-            batch_train_images = batch_train_images.type(torch.float).cuda()
-            batch_train_labels = batch_train_labels.type(torch.float).view(-1,1).cuda()
+            batch_train_images = images_to_device(batch_train_images, device, normalize=True)
+            batch_train_labels = batch_train_labels.type(torch.float).view(-1,1).to(device)
 
             #Forward pass
             outputs,_ = net(batch_train_images)
@@ -243,7 +230,7 @@ if args.CVMode:
             abs_diff_avg = 0
             total = 0
             for batch_idx, (images, labels) in enumerate(validloader):
-                images = images.type(torch.float).cuda()
+                images = images_to_device(images, device, normalize=True)
                 labels = labels.type(torch.float).view(-1).cpu().numpy()
                 outputs,_ = net(images)
                 outputs = outputs.view(-1).cpu().numpy()
@@ -288,8 +275,8 @@ if not os.path.isfile(filename_ckpt):
 else:
     print("\n Ckpt already exists")
     print("\n Loading...")
-    checkpoint = torch.load(filename_ckpt)
-    net.load_state_dict(checkpoint['net_state_dict'])
+    checkpoint = torch.load(filename_ckpt, map_location=device)
+    load_net_state_dict(net, checkpoint['net_state_dict'])
 torch.cuda.empty_cache()#release GPU mem which is  not references
 
 
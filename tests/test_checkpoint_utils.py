@@ -0,0 +1,48 @@
+"""
+Retention policy of CheckpointManager and its read-only mode for the DDP ranks other than 0
+"""
+import os
+
+import torch
+
+from checkpoint_utils import CheckpointManager
+
+FMT = "checkpoint_niters_{}.pth"
+
+
+def test_keeps_all_by_default(tmp_path):
+    with CheckpointManager(str(tmp_path), FMT) as ckpt_manager:
+        for step in range(1, 6):
+            ckpt_manager.save(step, {'step': torch.tensor(step)})
+    assert ckpt_manager.steps() == [1, 2, 3, 4, 5]
+
+
+def test_keep_last_and_milestones(tmp_path):
+    with CheckpointManager(str(tmp_path), FMT, keep_last=2, milestone_freq=3, milestones=[7]) as ckpt_manager:
+        for step in range(1, 9):
+            ckpt_manager.save(step, {'step': torch.tensor(step)})
+    assert ckpt_manager.steps() == [3, 5, 6, 7, 8]
+    assert ckpt_manager.load()['step'].item() == 8
+
+
+def test_stale_later_checkpoints_do_not_prune_the_current_one(tmp_path):
+    ## checkpoints of later steps left by an earlier run
+    for step in [50, 60]:
+        torch.save({'step': torch.tensor(step)}, os.path.join(str(tmp_path), FMT.format(step)))
+    with CheckpointManager(str(tmp_path), FMT, keep_last=2) as ckpt_manager:
+        for step in range(1, 5):
+            ckpt_manager.save(step, {'step': torch.tensor(step)})
+    assert ckpt_manager.steps() == [3, 4, 50, 60]
+
+
+def test_read_only(tmp_path):
+    folder = str(tmp_path / "intrain")
+    reader = CheckpointManager(folder, FMT, read_only=True)
+    assert reader.worker is None and reader.latest() is None
+    reader.save(1, {'step': torch.tensor(1)})
+    assert not os.path.exists(folder)
+
+    with CheckpointManager(folder, FMT) as ckpt_manager:
+        ckpt_manager.save(2, {'step': torch.tensor(2)})
+    assert reader.latest() == 2 and reader.load()['step'].item() == 2
+    reader.close()
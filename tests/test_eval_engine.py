@@ -0,0 +1,115 @@
+"""
+Heads of MultiHeadEvaluator against the loop implementations of eval_metrics and utils, on small random nets
+"""
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from utils import compute_entropy, predict_class_labels, normalize_images
+from eval_metrics import cal_FID, cal_labelscore, inception_score, FID_from_stats, FeatureStats
+from eval_engine import MultiHeadEvaluator, FIDFeatureHead, ClassHistogramHead, LabelScoreHead, InceptionScoreHead
+
+
+## small random stand-ins of the AE encoder (features), ResNet34_class ((logits, features)) and ResNet34_regre ((labels, features))
+class TinyNet(nn.Module):
+    def __init__(self, num_outputs, output='features'):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, 3, stride=2, padding=1)
+        self.linear = nn.Linear(4*4*4, num_outputs)
+        self.output = output
+
+    def forward(self, x):
+        features = torch.relu(self.conv(x)).reshape(len(x), -1)
+        out = self.linear(features)
+        if self.output == 'features':
+            return out
+        if self.output == 'regre':
+            return torch.sigmoid(out), features
+        return out, features
+
+
+NUM_CLASSES = 5
+MAX_LABEL = np.float64(6) # a float, as np.max of the float labels in main.py
+
+
+def make_fake_images(seed=0, nfake_per_label=12):
+    rng = np.random.RandomState(seed)
+    bins = np.repeat(np.arange(1, int(MAX_LABEL)+1), nfake_per_label)
+    images = rng.randint(0, 256, size=(len(bins), 3, 8, 8)).astype(np.uint8)
+    # normalized to [-1,1], as the generated images
+    images = normalize_images(torch.from_numpy(images)).numpy()
+    return images, bins, bins / MAX_LABEL
+
+
+def evaluate(heads, images, bins, labels, batch_size=10):
+    evaluator = MultiHeadEvaluator(heads, device="cpu")
+    for i in range(0, len(images), batch_size):
+        evaluator.update(torch.from_numpy(images[i:(i+batch_size)]), bins[i:(i+batch_size)], labels[i:(i+batch_size)])
+    return evaluator
+
+
+@pytest.fixture(scope="module")
+def nets():
+    torch.manual_seed(0)
+    return {'fid': TinyNet(4).eval(), 'class': TinyNet(NUM_CLASSES, 'class').eval(), 'regre': TinyNet(1, 'regre').eval()}
+
+
+WINDOWS = [(1, 6), (1, 3), (2.5, 4.5), (5, 6)]
+
+
+def test_fid_head_matches_cal_FID(nets):
+    images, bins, labels = make_fake_images()
+    real_images, _, _ = make_fake_images(seed=1)
+    real_stats = FeatureStats.from_features(nets['fid'](torch.from_numpy(real_images)).detach().numpy())
+    evaluator = evaluate({'fid': FIDFeatureHead(nets['fid'], MAX_LABEL+1, shift=real_stats.mean)}, images, bins, labels)
+    fake_stats = evaluator['fid'].stats()
+    for bin_start, bin_stop in WINDOWS:
+        mask = (bins >= bin_start) & (bins <= bin_stop)
+        fid_loop = cal_FID(nets['fid'], real_images, images[mask], batch_size=16, device="cpu")
+        fid_head = FID_from_stats(*real_stats.mean_cov(), *fake_stats.window(bin_start, bin_stop), eps=1e-6)
+        assert fid_head == pytest.approx(fid_loop, rel=1e-4, abs=1e-6)
+        assert fake_stats.count(bin_start, bin_stop) == mask.sum()
+
+
+def test_class_histogram_head_matches_compute_entropy(nets):
+    images, bins, labels = make_fake_images()
+    evaluator = evaluate({'entropy': ClassHistogramHead(nets['class'], NUM_CLASSES, MAX_LABEL+1)}, images, bins, labels)
+    for bin_start, bin_stop in WINDOWS:
+        mask = (bins >= bin_start) & (bins <= bin_stop)
+        entropy_loop = compute_entropy(predict_class_labels(nets['class'], images[mask], batch_size=16, device="cpu"))
+        assert evaluator['entropy'].entropy(bin_start, bin_stop) == pytest.approx(entropy_loop, rel=1e-10)
+
+
+def test_label_score_head_matches_cal_labelscore(nets):
+    images, bins, labels = make_fake_images()
+    evaluator = evaluate({'labelscore': LabelScoreHead(nets['regre'], MAX_LABEL+1, min_label_before_shift=0, max_label_after_shift=60)}, images, bins, labels)
+    for bin_start, bin_stop in WINDOWS:
+        mask = (bins >= bin_start) & (bins <= bin_stop)
+        ls_mean_loop, ls_std_loop = cal_labelscore(nets['regre'], images[mask], labels[mask], 0, 60, batch_size=16, device="cpu")
+        ls_mean, ls_std = evaluator['labelscore'].labelscore(bin_start, bin_stop)
+        assert ls_mean == pytest.approx(ls_mean_loop, rel=1e-5)
+        assert ls_std == pytest.approx(ls_std_loop, rel=1e-4)
+    assert np.isnan(evaluator['labelscore'].labelscore(7, 9)[0])
+
+
+def test_inception_score_head_matches_inception_score(nets):
+    images, bins, labels = make_fake_images()
+    splits = 4
+    split_ids = np.arange(len(images)) // (len(images) // splits)
+    evaluator = evaluate({'IS': InceptionScoreHead(nets['class'], NUM_CLASSES, split_ids, splits=splits)}, images, bins, labels)
+    IS_loop, IS_std_loop = inception_score(images, NUM_CLASSES, nets['class'], batch_size=16, splits=splits, device="cpu")
+    IS, IS_std = evaluator['IS'].score()
+    assert IS == pytest.approx(IS_loop, rel=1e-5)
+    assert IS_std == pytest.approx(IS_std_loop, rel=1e-4, abs=1e-7)
+
+
+def test_all_heads_in_one_pass(nets):
+    ## the heads of one evaluator see the same batches; same results as separate evaluators
+    images, bins, labels = make_fake_images()
+    heads = {'entropy': ClassHistogramHead(nets['class'], NUM_CLASSES, MAX_LABEL+1),
+             'labelscore': LabelScoreHead(nets['regre'], MAX_LABEL+1, min_label_before_shift=0, max_label_after_shift=60)}
+    evaluator = evaluate(heads, images, bins, labels)
+    entropy_alone = evaluate({'entropy': ClassHistogramHead(nets['class'], NUM_CLASSES, MAX_LABEL+1)}, images, bins, labels)
+    np.testing.assert_array_equal(evaluator['entropy'].histogram(1, 6), entropy_alone['entropy'].histogram(1, 6))
+    assert evaluator['entropy'].histogram(1, 6).sum() == len(images)
@@ -0,0 +1,63 @@
+"""
+FeatureStats against the two-pass mean and covariance (np.cov)
+"""
+import numpy as np
+import pytest
+
+from eval_metrics import FeatureStats
+
+
+def make_features(seed=0, n=300, d=6):
+    rng = np.random.RandomState(seed)
+    # a large offset, as for the AE features; the one-pass formulas would lose precision
+    return rng.normal(size=(n, d)).dot(rng.normal(size=(d, d))) + 1e3
+
+
+def test_from_features_matches_two_pass():
+    X = make_features()
+    stats = FeatureStats.from_features(X, chunk_size=7)
+    mean, cov = stats.mean_cov()
+    assert stats.n == len(X)
+    np.testing.assert_allclose(mean, X.mean(axis=0), rtol=0, atol=1e-9)
+    np.testing.assert_allclose(cov, np.cov(X, rowvar=False), rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("start,stop", [(0, 100), (50, 250), (0, 298), (10, 11)])
+def test_subtract_matches_two_pass(start, stop):
+    X = make_features()
+    stats = FeatureStats.from_features(X) - FeatureStats.from_features(X[start:stop])
+    rest = np.concatenate((X[0:start], X[stop:]))
+    mean, cov = stats.mean_cov()
+    assert stats.n == len(rest)
+    np.testing.assert_allclose(mean, rest.mean(axis=0), rtol=0, atol=1e-9)
+    np.testing.assert_allclose(cov, np.cov(rest, rowvar=False), rtol=1e-8, atol=1e-8)
+
+
+def test_subtract_prefixes_matches_two_pass():
+    ## windows of consecutive chunks as differences of prefix statistics
+    X = make_features()
+    prefixes = [FeatureStats(X.shape[1])]
+    for i in range(0, len(X), 30):
+        prefixes.append(prefixes[-1] + FeatureStats.from_features(X[i:(i+30)]))
+    for lo, hi in [(0, 10), (2, 5), (7, 8)]:
+        mean, cov = (prefixes[hi] - prefixes[lo]).mean_cov()
+        np.testing.assert_allclose(mean, X[lo*30:hi*30].mean(axis=0), rtol=0, atol=1e-9)
+        np.testing.assert_allclose(cov, np.cov(X[lo*30:hi*30], rowvar=False), rtol=1e-8, atol=1e-8)
+
+
+def test_subtract_all_and_too_many():
+    X = make_features()
+    stats = FeatureStats.from_features(X)
+    assert (stats - FeatureStats.from_features(X)).n == 0
+    with pytest.raises(Exception):
+        FeatureStats.from_features(X[0:10]) - stats
+
+
+def test_save_all_load_all(tmp_path):
+    X = make_features()
+    stats_list = [FeatureStats.from_features(X[0:100]), FeatureStats(X.shape[1]), FeatureStats.from_features(X[100:])]
+    FeatureStats.save_all(str(tmp_path / 'stats.npz'), stats_list)
+    for stats, loaded in zip(stats_list, FeatureStats.load_all(str(tmp_path / 'stats.npz'))):
+        assert loaded.n == stats.n
+        np.testing.assert_array_equal(loaded.mean, stats.mean)
+        np.testing.assert_array_equal(loaded.M2, stats.M2)
@@ -0,0 +1,24 @@
+"""
+Fallback of CompiledStep to eager mode
+"""
+import torch
+
+from gan_steps import CompiledStep
+
+
+def test_falls_back_to_eager_after_a_later_failure():
+    step = CompiledStep(lambda x: 2*x, "step", enabled=False)
+    compiled_calls = []
+
+    ## a compiled function which fails at its second call, e.g., at a recompilation
+    def compiled(x):
+        compiled_calls.append(len(x))
+        if len(compiled_calls) == 2:
+            raise RuntimeError("recompilation failed")
+        return 2*x
+    step.compiled = compiled
+
+    x = torch.ones(3)
+    for _ in range(4):
+        torch.testing.assert_close(step(x), 2*x)
+    assert len(compiled_calls) == 2 and step.compiled is None and step.ncalls == 4
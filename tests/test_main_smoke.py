@@ -0,0 +1,78 @@
+"""
+End-to-end smoke test of the evaluation path of main.py (--comp_FID) on a tiny synthetic UTKFace
+
+The label embedding, the generator and the evaluation CNNs are random nets saved under the checkpoint
+names main.py looks for, so nothing is trained; main.py then prepares the data, samples fake images and
+evaluates them with all metric heads.
+"""
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from models import ResNet34_embed, model_y2h, cont_cond_cnn_generator, encoder, ResNet34_class, ResNet34_regre
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_AGE = 20 # the grids of main.py display ages from 0.05*MAX_AGE on
+NUM_PER_AGE = 4
+DIM_GAN = 16
+MAIN_ARGS = ['--GAN', 'CcGAN', '--min_age', '1', '--max_age', str(MAX_AGE), '--seed', '2020', '--dim_gan', str(DIM_GAN),
+             '--kernel_sigma', '0.05', '--kappa', '0.02', '--niters_gan', '10', '--y2h_table_points', '1024',
+             '--comp_FID', '--nfake_per_label', '4', '--samp_batch_size', '10', '--FID_radius', '1', '--dump_fake_format', 'none']
+
+
+@pytest.fixture(scope="module")
+def root_path(tmp_path_factory):
+    root = tmp_path_factory.mktemp("smoke")
+    rng = np.random.RandomState(0)
+
+    ## NUM_PER_AGE images of each age in {1,...,MAX_AGE}, and some images outside of the age range
+    labels = np.concatenate((np.repeat(np.arange(1, MAX_AGE+1), NUM_PER_AGE), [MAX_AGE+3, MAX_AGE+5]))
+    os.makedirs(root / "dataset")
+    with h5py.File(root / "dataset" / "UTKFace_64x64.h5", "w") as hf:
+        hf.create_dataset('images', data=rng.randint(0, 256, size=(len(labels), 3, 64, 64)).astype(np.uint8))
+        hf.create_dataset('labels', data=labels)
+
+    ## random nets under the checkpoint names of main.py
+    torch.manual_seed(0)
+    models_folder = root / "output" / "saved_models"
+    os.makedirs(models_folder)
+    torch.save({'net_state_dict': ResNet34_embed(dim_embed=128).state_dict()}, models_folder / 'ckpt_ResNet34_embed_epoch_100_seed_2020.pth')
+    torch.save({'net_state_dict': model_y2h(dim_embed=128).state_dict()}, models_folder / 'ckpt_net_y2h_epoch_500_seed_2020.pth')
+    torch.save({'netG_state_dict': cont_cond_cnn_generator(nz=DIM_GAN).state_dict()}, models_folder / 'ckpt_CcGAN_niters_10_seed_2020_hard_0.05_0.02.pth')
+    torch.save({'net_encoder_state_dict': encoder(dim_bottleneck=512).state_dict()}, models_folder / 'ckpt_AE_epoch_200_seed_2020_CVMode_False.pth')
+    torch.save({'net_state_dict': ResNet34_class(num_classes=5).state_dict()}, models_folder / 'ckpt_PreCNNForEvalGANs_ResNet34_class_epoch_200_seed_2020_classify_5_races_CVMode_False.pth')
+    torch.save({'net_state_dict': ResNet34_regre().state_dict()}, models_folder / 'ckpt_PreCNNForEvalGANs_ResNet34_regre_epoch_200_seed_2020_CVMode_False.pth')
+    return root
+
+
+def run_main(root, *extra_args):
+    result = subprocess.run([sys.executable, os.path.join(REPO, 'main.py'), '--root_path', str(root)] + MAIN_ARGS + list(extra_args),
+                            cwd=REPO, capture_output=True, text=True, timeout=1800)
+    assert result.returncode == 0, result.stdout[-3000:] + result.stderr[-3000:]
+    return result.stdout
+
+
+def test_main_sliding_window_evaluation(root_path):
+    ## twice: the second run loads the prepared dataset and the real feature statistics from the caches
+    for _ in range(2):
+        stdout = run_main(root_path)
+        results = np.load(root_path / "CcGAN_hard_fid_ls_entropy_over_centers.npz")
+        np.testing.assert_array_equal(results['centers'], np.arange(2, MAX_AGE))
+        np.testing.assert_array_equal(results['nrealimgs'], 3*NUM_PER_AGE)
+        assert np.isfinite(results['fids']).all() and np.isfinite(results['labelscores']).all()
+        assert ((results['entropies'] >= 0) & (results['entropies'] <= np.log(5)+1e-12)).all()
+        assert "We got {} fake images.".format(4*MAX_AGE) in stdout
+    assert "Load real feature statistics" in stdout
+    assert "Load the prepared dataset" in stdout
+
+
+def test_main_IS_and_FID_only(root_path):
+    ## with the grids of fake images, which sample the generator 100 times
+    stdout = run_main(root_path, '--comp_IS_and_FID_only', '--visualize_fake_images')
+    assert "CcGAN: IS of {} fake images".format(4*MAX_AGE) in stdout
+    assert os.path.isfile(root_path / "output" / "saved_images" / "CcGAN_hard_sigma_0.05_kappa_0.02_fake_images_grid_10x10.png")
@@ -0,0 +1,61 @@
+"""
+Sampling from CcGAN generators with labels folded into the conditional BNs
+"""
+import sys
+from unittest import mock
+
+import numpy as np
+import torch
+
+from models import cont_cond_cnn_generator, model_y2h
+
+# Train_CcGAN parses the command line at import time
+with mock.patch.object(sys, 'argv', ['Train_CcGAN.py', '--dim_gan', '16']):
+    from Train_CcGAN import SampCcGAN_given_labels
+
+
+def make_nets():
+    torch.manual_seed(0)
+    netG = cont_cond_cnn_generator(nz=16)
+    net_y2h = model_y2h(dim_embed=128)
+    return netG, net_y2h
+
+
+def count_calls(net):
+    calls = []
+    net.register_forward_hook(lambda module, inputs, outputs: calls.append(len(inputs[0])))
+    return calls
+
+
+def test_second_call_hits_folded_cache():
+    netG, net_y2h = make_nets()
+    y2h_calls = count_calls(net_y2h)
+    labels = np.repeat([0.1, 0.5, 0.9], 3)
+
+    SampCcGAN_given_labels(netG, net_y2h, labels, batch_size=4)
+    assert sorted(netG.folded_cache) == [0.1, 0.5, 0.9]
+    cached = dict(netG.folded_cache)
+    num_folded = sum(y2h_calls)
+
+    ## same labels again: nothing is folded, and the cached parameters are reused as they are
+    SampCcGAN_given_labels(netG, net_y2h, labels[::-1], batch_size=4)
+    assert sum(y2h_calls) == num_folded
+    assert all(netG.folded_cache[lb] is cached[lb] for lb in cached)
+
+    ## a new label is folded on its own
+    SampCcGAN_given_labels(netG, net_y2h, [0.5, 0.3], batch_size=4)
+    assert sum(y2h_calls) == num_folded + 1
+
+    ## training invalidates the cache
+    netG.train()
+    assert len(netG.folded_cache) == 0
+
+
+def test_folded_matches_unfolded():
+    netG, net_y2h = make_nets()
+    labels = np.array([0.2, 0.2, 0.7, 0.4])
+    torch.manual_seed(1)
+    images_folded, _ = SampCcGAN_given_labels(netG, net_y2h, labels, batch_size=3, folded=True)
+    torch.manual_seed(1)
+    images_unfolded, _ = SampCcGAN_given_labels(netG, net_y2h, labels, batch_size=3, folded=False)
+    np.testing.assert_allclose(images_folded, images_unfolded, rtol=0, atol=1e-4) #float32 rounding of the fused BN
@@ -0,0 +1,94 @@
+"""
+select_ages and cap_and_replicate against the per-age loops of the original main.py
+"""
+import numpy as np
+
+from utkface_data import select_ages, cap_and_replicate
+
+
+## the original loops; they work on the labels only, since the images follow the same index
+def baseline_select_ages(labels, min_age, max_age):
+    selected_labels = np.arange(min_age, max_age+1)
+    for i in range(len(selected_labels)):
+        curr_label = selected_labels[i]
+        index_curr_label = np.where(labels==curr_label)[0]
+        if i == 0:
+            indx_subset = index_curr_label
+        else:
+            indx_subset = np.concatenate((indx_subset, index_curr_label))
+    return indx_subset
+
+
+def baseline_cap_and_replicate(labels, max_num_img_per_label, max_num_img_per_label_after_replica):
+    '''
+    return: labels after capping, labels of the replicas
+    '''
+    unique_labels_tmp = np.sort(np.array(list(set(labels))))
+    for i in range(len(unique_labels_tmp)):
+        indx_i = np.where(labels == unique_labels_tmp[i])[0]
+        if len(indx_i)>max_num_img_per_label:
+            np.random.shuffle(indx_i)
+            indx_i = indx_i[0:max_num_img_per_label]
+        if i == 0:
+            sel_indx = indx_i
+        else:
+            sel_indx = np.concatenate((sel_indx, indx_i))
+    labels = labels[sel_indx]
+
+    labels_replica = np.zeros(0)
+    max_num_img_per_label_after_replica = np.min([max_num_img_per_label_after_replica, max_num_img_per_label])
+    if max_num_img_per_label_after_replica>1:
+        unique_labels_replica = np.sort(np.array(list(set(labels))))
+        for i in range(len(unique_labels_replica)):
+            curr_label = unique_labels_replica[i]
+            indx_i = np.where(labels == curr_label)[0]
+            if len(indx_i) < max_num_img_per_label_after_replica:
+                num_img_less = max_num_img_per_label_after_replica - len(indx_i)
+                indx_replica = np.random.choice(indx_i, size = num_img_less, replace=True)
+                labels_replica = np.concatenate((labels_replica, labels[indx_replica]))
+    return sel_indx, labels, labels_replica
+
+
+def make_ages(seed=0, n=500):
+    rng = np.random.RandomState(seed)
+    # skewed counts, and some ages without images
+    ages = np.round(rng.gamma(2.0, 12.0, size=n)).astype(int) + 1
+    return ages[(ages != 7) & (ages != 30)].astype(float)
+
+
+def test_select_ages_matches_loop():
+    ages = make_ages()
+    for min_age, max_age in [(1, 60), (5, 40), (7, 7), (20, 25)]:
+        np.testing.assert_array_equal(select_ages(ages, min_age, max_age), baseline_select_ages(ages, min_age, max_age))
+
+
+def test_cap_and_replicate_without_cap_matches_loop():
+    ages = make_ages()
+    indx, num_before_replica = cap_and_replicate(ages, 99999, 1, rng=np.random.RandomState(0))
+    sel_indx, _, _ = baseline_cap_and_replicate(ages, 99999, 1)
+    assert num_before_replica == len(ages)
+    np.testing.assert_array_equal(indx, sel_indx)
+
+
+def test_cap_and_replicate_matches_loop():
+    ages = make_ages()
+    for max_num_img_per_label, max_num_img_per_label_after_replica in [(10, 6), (15, 200), (99999, 20), (3, 3)]:
+        indx, num_before_replica = cap_and_replicate(ages, max_num_img_per_label, max_num_img_per_label_after_replica, rng=np.random.RandomState(1))
+        np.random.seed(1)
+        _, labels, labels_replica = baseline_cap_and_replicate(ages, max_num_img_per_label, max_num_img_per_label_after_replica)
+
+        ## same labels in the same order; only the random choice of images within an age may differ
+        assert num_before_replica == len(labels)
+        np.testing.assert_array_equal(ages[indx[0:num_before_replica]], labels)
+        np.testing.assert_array_equal(ages[indx[num_before_replica:]], labels_replica)
+
+        ## no image is kept twice before replication, and the replicas are copies of kept images
+        kept = indx[0:num_before_replica]
+        assert len(np.unique(kept)) == len(kept)
+        assert np.isin(indx[num_before_replica:], kept).all()
+
+        ## ages which are not capped keep the file order
+        for age in np.unique(ages):
+            indx_age = np.where(ages == age)[0]
+            if len(indx_age) <= max_num_img_per_label:
+                np.testing.assert_array_equal(kept[ages[kept] == age], indx_age)
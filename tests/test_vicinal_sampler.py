@@ -0,0 +1,68 @@
+"""
+VicinityIndex and VicinalBatchSampler against the per-target vicinity masks of the original train_CcGAN
+"""
+import numpy as np
+import pytest
+
+from vicinal_sampler import VicinityIndex, VicinalBatchSampler
+
+
+## the original vicinity of a target label
+def baseline_vicinity(train_labels, target_label, kappa, threshold_type, nonzero_soft_weight_threshold=1e-3):
+    if threshold_type == "hard":
+        return np.where(np.abs(train_labels-target_label)<= kappa)[0]
+    else:
+        # reverse the weight function for SVDL
+        return np.where((train_labels-target_label)**2 <= -np.log(nonzero_soft_weight_threshold)/kappa)[0]
+
+
+def make_labels(seed=0, n=400):
+    rng = np.random.RandomState(seed)
+    # normalized ages with ties and a gap in (0.5, 0.7)
+    ages = rng.randint(1, 61, size=n)
+    ages = ages[(ages <= 30) | (ages > 42)]
+    return ages / 60.0
+
+
+@pytest.mark.parametrize("threshold_type,kappa", [("hard", 0.02), ("hard", 0.1), ("soft", 2000.0)])
+def test_vicinity_index_matches_masks(threshold_type, kappa):
+    train_labels = make_labels()
+    index = VicinityIndex(train_labels)
+    radius = VicinityIndex.radius(kappa, threshold_type)
+    target_labels = np.random.RandomState(1).uniform(-0.1, 1.1, size=300)
+
+    start, stop = index.query(target_labels, radius)
+    np.testing.assert_array_equal(index.count(target_labels, radius), stop-start)
+    for j in range(len(target_labels)):
+        expected = baseline_vicinity(train_labels, target_labels[j], kappa, threshold_type)
+        np.testing.assert_array_equal(np.sort(index.indices(start[j], stop[j])), expected)
+
+
+@pytest.mark.parametrize("threshold_type,kappa", [("hard", 0.02), ("soft", 2000.0)])
+@pytest.mark.parametrize("clip_label", [False, True])
+def test_vicinal_batch_sampler_in_vicinity(threshold_type, kappa, clip_label):
+    train_labels = make_labels()
+    kernel_sigma = 0.05 # large enough for targets to fall into the gap and be redrawn
+    sampler = VicinalBatchSampler(train_labels, kernel_sigma, kappa, threshold_type=threshold_type, clip_label=clip_label, rng=np.random.RandomState(2))
+    radius = VicinityIndex.radius(kappa, threshold_type)
+
+    for _ in range(5):
+        batch_target_labels_with_epsilon, batch_real_indx, batch_fake_labels = sampler.sample(64, 96)
+        assert len(batch_target_labels_with_epsilon) == 96
+        assert len(batch_real_indx) == 64 and len(batch_fake_labels) == 64
+        if clip_label:
+            assert ((batch_target_labels_with_epsilon >= 0) & (batch_target_labels_with_epsilon <= 1)).all()
+
+        for j in range(64):
+            target_label = batch_target_labels_with_epsilon[j]
+            ## the real image is in the vicinity of the target, which is never empty
+            assert batch_real_indx[j] in baseline_vicinity(train_labels, target_label, kappa, threshold_type)
+            ## the fake label is in the vicinity, clamped to [0,1]
+            assert max(0.0, target_label-radius) <= batch_fake_labels[j] <= min(target_label+radius, 1.0)
+
+
+def test_vicinal_batch_sampler_reproducible():
+    train_labels = make_labels()
+    samplers = [VicinalBatchSampler(train_labels, 0.05, 0.02, rng=np.random.RandomState(3)) for _ in range(2)]
+    for batch_a, batch_b in zip(samplers[0].sample(32, 32), samplers[1].sample(32, 32)):
+        np.testing.assert_array_equal(batch_a, batch_b)
@@ -10,6 +10,9 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 from torch.nn import functional as F
 import sys
+import timeit
+import contextlib
+import copy
 import PIL
 from PIL import Image
 
@@ -34,10 +37,105 @@ class SimpleProgressBar():
 
 
 
+################################################################################
+# devices
+def get_device(device=None):
+    '''
+    device: e.g., "cuda", "cuda:1", "cpu"; if None, cuda if available, otherwise cpu
+    '''
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+# nn.DataParallel only if there is more than one GPU
+def wrap_data_parallel(net, device):
+    if torch.device(device).type == "cuda" and torch.cuda.device_count() > 1:
+        return nn.DataParallel(net)
+    return net
+
+# load a state dict saved with or without nn.DataParallel into a net with or without nn.DataParallel
+def load_net_state_dict(net, state_dict):
+    if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        net = net.module
+    if len(state_dict)>0 and all(k.startswith('module.') for k in state_dict.keys()):
+        state_dict = {k[len('module.'):]: v for k, v in state_dict.items()}
+    net.load_state_dict(state_dict)
+
+# number of intra-op threads of torch on CPU hosts; 0 or None keeps the default (number of physical cores)
+def set_num_threads(num_threads=None):
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+# inference without autograd bookkeeping; with bf16 autocast on CPU if requested
+def inference_context(device, bf16=False):
+    context = contextlib.ExitStack()
+    context.enter_context(torch.inference_mode())
+    if bf16 and torch.device(device).type == "cpu":
+        context.enter_context(torch.autocast(device_type="cpu", dtype=torch.bfloat16))
+    return context
+
+# move a network to the device for inference; on CPU, use the channels_last layout which is faster for the convolutions.
+# The layout of the caller's net is never changed: if it has to be converted, a converted copy is returned, so that a
+# net which is still trained (e.g., netG sampled during training) keeps its layout
+def prepare_inference_net(net, device, channels_last=None):
+    if channels_last is None:
+        channels_last = torch.device(device).type == "cpu"
+    conv_weights = [p for p in net.parameters() if p.dim() == 4]
+    if channels_last and not all(p.is_contiguous(memory_format=torch.channels_last) for p in conv_weights):
+        net = copy.deepcopy(net).to(device, memory_format=torch.channels_last)
+    else:
+        net = net.to(device)
+    net.eval()
+    return net
+
+# mixed precision training: amp is 'none', 'fp16' or 'bf16'; fp16 falls back to bf16 on CPU
+def get_amp_dtype(amp, device):
+    if amp is None or amp == 'none':
+        return None
+    if amp not in ['fp16', 'bf16']:
+        raise Exception('unknown amp mode: {}!!!'.format(amp))
+    if amp == 'fp16' and torch.device(device).type == "cuda":
+        return torch.float16
+    return torch.bfloat16
+
+def amp_context(device, amp_dtype):
+    return torch.autocast(device_type=torch.device(device).type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+# a gradient scaler is only needed for fp16; a disabled scaler is a no-op
+def make_grad_scaler(device, amp_dtype):
+    return torch.amp.GradScaler("cuda", enabled=(amp_dtype == torch.float16 and torch.device(device).type == "cuda"))
+
+# a disabled scaler has an empty state dict, which cannot be loaded
+def load_grad_scaler_state_dict(scaler, checkpoint, key):
+    if scaler.is_enabled() and len(checkpoint.get(key, {}))>0:
+        scaler.load_state_dict(checkpoint[key])
+
+
+################################################################################
+# normalize images in [0,255] to [-1,1] in float32; same as (x/255.0-0.5)/0.5
+def normalize_images(images):
+    return images.to(torch.float, copy=True).mul_(1/127.5).sub_(1.0)
+
+# move a batch from a dataloader to the device; apply the normalization deferred by IMGs_dataset(normalize_on_device=True)
+def images_to_device(images, device, normalize=False):
+    images = images.to(device, non_blocking=True)
+    if normalize:
+        return normalize_images(images)
+    return images.type(torch.float)
+
+
 ################################################################################
 # torch dataset from numpy array
 class IMGs_dataset(torch.utils.data.Dataset):
-    def __init__(self, images, labels=None, normalize=False):
+    def __init__(self, images, labels=None, normalize=False, normalize_on_device=False):
+        '''
+        batched fetching goes through __getitem__: given a non-scalar index (the list of indices of a
+        batch, as IMGs_batch_loader passes), it returns the whole batch from get_batch; the dataset
+        does not implement __getitems__
+        normalize_on_device: only for batched fetching; return unnormalized uint8 batches which
+                             are normalized after being moved to the device by images_to_device
+        '''
         super(IMGs_dataset, self).__init__()
 
         self.images = images
@@ -47,10 +145,14 @@ class IMGs_dataset(torch.utils.data.Dataset):
             if len(self.images) != len(self.labels):
                 raise Exception('images (' +  str(len(self.images)) +') and labels ('+str(len(self.labels))+') do not have the same length!!!')
         self.normalize = normalize
+        self.normalize_on_device = normalize_on_device
 
 
     def __getitem__(self, index):
 
+        if not np.isscalar(index):
+            return self.get_batch(index)
+
         image = self.images[index]
 
         if self.normalize:
@@ -63,10 +165,234 @@ class IMGs_dataset(torch.utils.data.Dataset):
         else:
             return image
 
+    def get_batch(self, indices):
+        '''
+        fetch a whole batch as one tensor; float32 batches, or uint8 batches if the normalization is deferred
+        '''
+        indices = np.asarray(indices)
+        images = torch.from_numpy(np.ascontiguousarray(self.images[indices]))
+
+        if self.normalize and not self.normalize_on_device:
+            images = normalize_images(images)
+        elif images.dtype != torch.uint8:
+            images = images.type(torch.float)
+
+        if self.labels is not None:
+            labels = torch.from_numpy(np.asarray(self.labels[indices]))
+            return (images, labels)
+        else:
+            return images
+
+    def __len__(self):
+        return self.n_images
+
+
+# a dataloader over IMGs_dataset which fetches whole batches by index instead of one image at a time
+def IMGs_batch_loader(dataset, batch_size, shuffle=False, num_workers=0, drop_last=False, pin_memory=False):
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    # batch_size=None: each list of indices from batch_sampler goes to dataset[...] and the batch is not collated again
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler, num_workers=num_workers, pin_memory=pin_memory)
+
+
+################################################################################
+# the whole training set as one contiguous uint8 tensor; batches are gathered by index
+class IMGs_store():
+    def __init__(self, images, device="cpu", pin_memory=True):
+        '''
+        images: unnormalized uint8 images in [0,255]; nxncximg_sizeximg_size
+        device: where the images are kept; a cpu store is pinned (if cuda is available) so that batches are copied asynchronously
+        '''
+        images = torch.from_numpy(np.ascontiguousarray(images, dtype=np.uint8))
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == "cpu" and pin_memory and torch.cuda.is_available()
+        if self.pin_memory:
+            images = images.pin_memory()
+        self.images = images.to(self.device)
+        self.n_images = len(self.images)
+
+    def get_batch(self, indx, device=None, normalize=True):
+        '''
+        indx: index of the images in the batch
+        device: device of the returned batch; if None, use the device of the store
+        '''
+        device = self.device if device is None else torch.device(device)
+        indx = torch.as_tensor(indx, dtype=torch.long, device=self.device)
+        if self.pin_memory and device.type != "cpu":
+            # gather into a pinned buffer (cached by torch's host allocator) so that the copy below is async
+            batch_images = torch.empty((len(indx),)+tuple(self.images.shape[1:]), dtype=torch.uint8, pin_memory=True)
+            torch.index_select(self.images, 0, indx, out=batch_images)
+        else:
+            batch_images = self.images.index_select(0, indx)
+        batch_images = batch_images.to(device, non_blocking=True)
+        if normalize:
+            batch_images = normalize_images(batch_images)
+        return batch_images
+
     def __len__(self):
         return self.n_images
 
 
+################################################################################
+# inference of a network over all images batch by batch: the next batch is fetched and copied to the device while
+# the current one is computed, outputs are copied back asynchronously into one pinned float32 buffer, and the
+# device is synchronized only once at the end
+def batched_inference(net, images, batch_size=500, normalize=False, resize=None, device="cuda", outputs_fn=None, num_workers=0, name=None, verbose=False, bf16=False, channels_last=None):
+    '''
+    images: nxncximg_sizeximg_size; a numpy array or a lazy view such as utkface_data.H5Images
+    normalize: if True, images are unnormalized in [0,255] and are normalized to [-1,1] on the device
+    resize: if None, do not resize; if resize = (H,W), resize images to 3 x H x W
+    outputs_fn: maps the outputs of net to the tensor to keep, e.g., lambda out: out[0]; if None, keep the outputs
+    name: if not None, print the throughput of net (images/sec) with this name
+    bf16: use bf16 autocast on CPU
+    channels_last: use the channels_last layout; if None, only on CPU
+    return: the kept outputs of all images as a float32 numpy array; an empty array if there are no images
+    '''
+    n = len(images)
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    device = torch.device(device)
+    use_cuda = device.type == "cuda"
+    if channels_last is None:
+        channels_last = not use_cuda
+    net = prepare_inference_net(net, device, channels_last=channels_last)
+    dataset = IMGs_dataset(images, normalize=normalize, normalize_on_device=normalize)
+    dataloader = IMGs_batch_loader(dataset, batch_size=min(batch_size, n), shuffle=False, num_workers=num_workers, pin_memory=use_cuda)
+
+    def to_device(batch_images):
+        batch_images = images_to_device(batch_images, device, normalize=normalize)
+        if resize is not None:
+            batch_images = nn.functional.interpolate(batch_images, size = resize, scale_factor=None, mode='bilinear', align_corners=False)
+        if channels_last:
+            batch_images = batch_images.contiguous(memory_format=torch.channels_last)
+        return batch_images
+
+    outputs = None
+    nimgs_got = 0
+    if verbose:
+        pb = SimpleProgressBar()
+    start_time = timeit.default_timer()
+    with inference_context(device, bf16=bf16):
+        dataloader_iter = iter(dataloader)
+        next_batch_images = to_device(next(dataloader_iter))
+        while next_batch_images is not None:
+            batch_images = next_batch_images
+            batch_outputs = net(batch_images)
+            if outputs_fn is not None:
+                batch_outputs = outputs_fn(batch_outputs)
+            batch_outputs = batch_outputs.type(torch.float)
+
+            # prefetch the next batch while the device computes the current one
+            batch = next(dataloader_iter, None)
+            next_batch_images = None if batch is None else to_device(batch)
+
+            if outputs is None:
+                outputs = torch.empty((n,)+tuple(batch_outputs.shape[1:]), dtype=torch.float, pin_memory=use_cuda)
+            batch_size_curr = len(batch_outputs)
+            outputs[nimgs_got:(nimgs_got+batch_size_curr)].copy_(batch_outputs, non_blocking=True)
+            nimgs_got += batch_size_curr
+            if verbose:
+                pb.update((float(nimgs_got)/n)*100)
+    if use_cuda:
+        torch.cuda.synchronize(device)
+    elapsed = timeit.default_timer() - start_time
+    if name is not None:
+        print("\r {}: {} images in {:.2f}s; {:.1f} images/sec.".format(name, n, elapsed, n/max(elapsed, 1e-12)))
+    return outputs.numpy()
+
+
+################################################################################
+# per-step state of the training loops which does not synchronize the device
+
+# labels of a training step copied to the device in one non-blocking copy; the host buffers (pinned on cuda)
+# and the device buffer are preallocated and reused; two host buffers alternate, and a buffer is only
+# refilled once its previous copy has finished
+class HostToDeviceBuffer():
+    def __init__(self, sizes, device, dtype=torch.float, num_host_buffers=2):
+        '''
+        sizes: the length of each array copied by copy(), e.g., [batch_size_max, batch_size_disc, batch_size_disc]
+        '''
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+        size = int(self.offsets[-1])
+        if self.use_cuda:
+            self.host = [torch.empty(size, dtype=dtype, pin_memory=True) for _ in range(num_host_buffers)]
+            self.events = [None] * num_host_buffers
+            self.buffer = torch.empty(size, dtype=dtype, device=self.device)
+        else:
+            # on CPU, the host buffer is the device buffer
+            self.host = [torch.empty(size, dtype=dtype)]
+            self.buffer = self.host[0]
+        self.i = 0
+
+    def copy(self, *arrays):
+        '''
+        arrays: numpy arrays with the lengths in sizes
+        return: the arrays on the device; views of the device buffer, valid until the next call
+        '''
+        host = self.host[self.i]
+        if self.use_cuda and self.events[self.i] is not None:
+            self.events[self.i].synchronize()
+        host_np = host.numpy()
+        for j, array in enumerate(arrays):
+            host_np[self.offsets[j]:self.offsets[j+1]] = array
+        if self.use_cuda:
+            self.buffer.copy_(host, non_blocking=True)
+            self.events[self.i] = torch.cuda.Event()
+            self.events[self.i].record()
+            self.i = (self.i + 1) % len(self.host)
+        return [self.buffer[self.offsets[j]:self.offsets[j+1]] for j in range(len(arrays))]
+
+
+# running means of scalar statistics (e.g., losses) accumulated on the device; read back only when reported
+class LossMeter():
+    def __init__(self, names, device):
+        self.names = names
+        self.sums = torch.zeros(len(names), dtype=torch.float, device=device)
+        self.count = 0
+
+    def update(self, *values):
+        self.sums += torch.stack([v.detach().float().reshape(()) for v in values])
+        self.count += 1
+
+    def read(self):
+        '''
+        means since the last read, as a dict; synchronizes the device once
+        '''
+        means = (self.sums / max(self.count, 1)).tolist()
+        self.sums.zero_()
+        self.count = 0
+        return dict(zip(self.names, means))
+
+
+# host time spent in named sections of a loop; does not synchronize the device, so on cuda it is the
+# per-step overhead on the host (sampling, copies, kernel launches) unless the host waits for the device
+class SectionTimer():
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def section(self, name):
+        start_time = timeit.default_timer()
+        yield
+        self.times[name] = self.times.get(name, 0.0) + timeit.default_timer() - start_time
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self):
+        '''
+        ms per call of each section since the last report
+        '''
+        report = " ".join("[{}: {:.2f}ms]".format(name, self.times[name]/self.counts[name]*1000) for name in self.times)
+        self.times = {}
+        self.counts = {}
+        return report
+
+
 def PlotLoss(loss, filename):
     x_axis = np.arange(start = 1, stop = len(loss)+1)
     plt.switch_backend('agg')
@@ -89,32 +415,10 @@ def compute_entropy(labels, base=None):
     base = np.e if base is None else base
     return -(norm_counts * np.log(norm_counts)/np.log(base)).sum()
 
-def predict_class_labels(net, images, batch_size=500, verbose=False):
-    net = net.cuda()
-    net.eval()
-
-    n = len(images)
-    if batch_size>n:
-        batch_size=n
-    dataset_pred = IMGs_dataset(images, normalize=False)
-    dataloader_pred = torch.utils.data.DataLoader(dataset_pred, batch_size=batch_size, shuffle=False, num_workers=0)
-
-    class_labels_pred = np.zeros(n+batch_size)
-    with torch.no_grad():
-        nimgs_got = 0
-        if verbose:
-            pb = SimpleProgressBar()
-        for batch_idx, batch_images in enumerate(dataloader_pred):
-            batch_images = batch_images.type(torch.float).cuda()
-            batch_size_curr = len(batch_images)
-
-            outputs,_ = net(batch_images)
-            _, batch_class_labels_pred = torch.max(outputs.data, 1)
-            class_labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_class_labels_pred.detach().cpu().numpy().reshape(-1)
-
-            nimgs_got += batch_size_curr
-            if verbose:
-                pb.update((float(nimgs_got)/n)*100)
-        #end for batch_idx
-    class_labels_pred = class_labels_pred[0:n]
-    return class_labels_pred
+def predict_class_labels(net, images, batch_size=500, verbose=False, device=None):
+    '''
+    device: if None, cuda if available, otherwise cpu (see get_device)
+    '''
+    device = get_device(device)
+    class_labels_pred = batched_inference(net, images, batch_size=batch_size, device=device, outputs_fn=lambda out: out[0].argmax(dim=1), verbose=verbose)
+    return class_labels_pred.astype(np.float64)
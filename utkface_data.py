@@ -0,0 +1,208 @@
+"""
+Lazy access to the UTKFace h5 files
+
+The images are never loaded as a whole. H5Images is an indexable view of the
+'images' dataset: subsets (age filtering, capping, replication) are index arrays
+over the rows of the file, and pixels are only read when a batch is requested,
+either from a read-only memory map (contiguous, uncompressed datasets) or with
+chunk-aligned reads.
+
+"""
+import os
+import copy
+import hashlib
+import numpy as np
+import h5py
+
+
+class H5Images():
+    def __init__(self, filename, key='images', indx=None, mmap=True):
+        '''
+        filename: the h5 file
+        key: the image dataset in the h5 file; nxncximg_sizeximg_size
+        indx: rows of the dataset in this view; if None, all rows
+        mmap: memory map the dataset (read-only) if it is stored contiguously and uncompressed
+        '''
+        self.filename = filename
+        self.key = key
+        with h5py.File(filename, 'r') as hf:
+            dset = hf[key]
+            self.full_shape = dset.shape
+            self.dtype = dset.dtype
+            self.chunk_rows = dset.chunks[0] if dset.chunks is not None else None
+            offset = dset.id.get_offset() if (dset.chunks is None and dset.compression is None) else None
+        self.offset = offset
+        self.mmap = mmap and offset is not None
+        self.indx = None if indx is None else np.asarray(indx, dtype=np.int64)
+        self._pid = None
+        self._hf = None
+        self._data = None
+
+    def _dataset(self):
+        # open lazily and once per process, so that the view can be handed to dataloader workers
+        if self._pid != os.getpid():
+            self._hf = None
+            if self.mmap:
+                self._data = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.full_shape)
+            else:
+                self._hf = h5py.File(self.filename, 'r')
+                self._data = self._hf[self.key]
+            self._pid = os.getpid()
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None; state['_hf'] = None; state['_data'] = None
+        return state
+
+    def __len__(self):
+        return self.full_shape[0] if self.indx is None else len(self.indx)
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.full_shape[1:])
+
+    def rows(self, index):
+        '''
+        map index of this view to rows of the h5 dataset
+        '''
+        if self.indx is None:
+            return np.arange(self.full_shape[0])[index]
+        return self.indx[index]
+
+    def subset(self, index):
+        '''
+        a new view of the images self[index]; no pixels are read
+        '''
+        view = copy.copy(self)
+        view.indx = np.asarray(self.rows(index), dtype=np.int64)
+        return view
+
+    def _read(self, rows):
+        data = self._dataset()
+        if self.mmap:
+            return np.asarray(data[rows])
+
+        # h5py needs increasing indices
+        uniq_rows, inverse = np.unique(rows, return_inverse=True)
+        out = np.empty((len(uniq_rows),)+tuple(self.full_shape[1:]), dtype=self.dtype)
+        if len(uniq_rows) == 0:
+            return out
+        if self.chunk_rows is None:
+            out[:] = data[uniq_rows]
+            return out[inverse.reshape(-1)]
+
+        # chunked dataset: read each chunk that contains requested rows once
+        chunk_rows = self.chunk_rows
+        blocks = uniq_rows // chunk_rows
+        block_starts = np.flatnonzero(np.diff(blocks, prepend=-1)!=0)
+        block_stops = np.append(block_starts[1:], len(uniq_rows))
+        for start, stop in zip(block_starts, block_stops):
+            row_lo = blocks[start]*chunk_rows
+            row_hi = min(row_lo+chunk_rows, self.full_shape[0])
+            chunk = data[row_lo:row_hi]
+            out[start:stop] = chunk[uniq_rows[start:stop]-row_lo]
+        return out[inverse.reshape(-1)]
+
+    def __getitem__(self, index):
+        if np.isscalar(index):
+            return np.asarray(self._dataset()[self.rows(index)])
+        rows = np.asarray(self.rows(index)).reshape(-1)
+        return self._read(rows)
+
+    def __array__(self, dtype=None):
+        # materialize the whole view
+        if self.indx is None and not self.mmap:
+            images = self._dataset()[:]
+        else:
+            images = self._read(self.rows(slice(None)))
+        if dtype is not None:
+            images = images.astype(dtype, copy=False)
+        return images
+
+
+
+def load_UTKFace_h5(data_filename, mmap=True):
+    '''
+    return a lazy view of the images, and the ages and races (None if not stored) of all images
+    '''
+    images = H5Images(data_filename, key='images', mmap=mmap)
+    with h5py.File(data_filename, 'r') as hf:
+        labels = hf['labels'][:]
+        races = hf['races'][:] if 'races' in hf else None
+    assert len(images) == len(labels)
+    return images, labels, races
+
+
+
+def select_ages(ages, min_age, max_age):
+    '''
+    index of the images with ages in {min_age,...,max_age}, ordered by age (and by file order within an age)
+    '''
+    indx = np.flatnonzero(np.isin(ages, np.arange(min_age, max_age+1)))
+    return indx[np.argsort(ages[indx], kind='stable')]
+
+
+def cap_and_replicate(labels, max_num_img_per_label, max_num_img_per_label_after_replica, rng=None):
+    '''
+    For each label, keep no more than max_num_img_per_label images (a random subset), then replicate
+    images of labels with less than min(max_num_img_per_label_after_replica, max_num_img_per_label)
+    images by sampling with replacement.
+
+    labels: labels of the images
+    return: indx, num_before_replica; indx is the index of the selected images (ordered by label)
+            followed by the replicas; indx[0:num_before_replica] are the images before replication
+    '''
+    rng = np.random if rng is None else rng
+    labels = np.asarray(labels)
+    n = len(labels)
+
+    ## cap: within a label, a random order if the label has too many images, otherwise the original order
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    capped = counts[inverse] > max_num_img_per_label
+    keys = np.where(capped, rng.random_sample(n), np.arange(n)/max(n,1))
+    order = np.lexsort((keys, labels))
+    group_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(n) - np.repeat(group_starts, counts)
+    indx = order[rank < max_num_img_per_label]
+    num_before_replica = len(indx)
+
+    ## replicate minority samples to alleviate the imbalance
+    max_num_img_per_label_after_replica = np.min([max_num_img_per_label_after_replica, max_num_img_per_label])
+    if max_num_img_per_label_after_replica>1:
+        counts_kept = np.minimum(counts, max_num_img_per_label)
+        starts_kept = np.concatenate(([0], np.cumsum(counts_kept)[:-1]))
+        num_img_less = np.maximum(max_num_img_per_label_after_replica - counts_kept, 0)
+        group = np.repeat(np.arange(len(counts)), num_img_less)
+        indx_replica = starts_kept[group] + (rng.random_sample(len(group))*counts_kept[group]).astype(np.int64)
+        indx = np.concatenate((indx, indx[indx_replica]))
+
+    return indx, num_before_replica
+
+
+
+################################################################################
+# cache of the prepared dataset (index arrays, labels, kernel_sigma/kappa), keyed by the data-prep arguments
+def get_data_cache_filename(cache_folder, data_filename, **data_args):
+    '''
+    data_args: arguments which determine the prepared dataset, e.g., min_age, max_age, seed;
+               the modification time of the h5 file is part of the key as well
+    '''
+    key = sorted(data_args.items()) + [('h5_file', os.path.abspath(data_filename)), ('h5_mtime', os.path.getmtime(data_filename))]
+    key = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[0:16]
+    return os.path.join(cache_folder, 'UTKFace_prepared_{}.npz'.format(key))
+
+
+def load_data_cache(cache_filename):
+    if not os.path.isfile(cache_filename):
+        return None
+    with np.load(cache_filename) as cache:
+        return {k: cache[k] for k in cache.files}
+
+
+def save_data_cache(cache_filename, **arrays):
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    tmp_filename = cache_filename + '.tmp.{}.npz'.format(os.getpid())
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, cache_filename) #atomic; concurrent runs never see a partial cache
@@ -0,0 +1,119 @@
+"""
+Vicinity lookup and batch sampling for CcGAN training
+
+The training labels are sorted once; the real images in the vicinity of a batch
+of target labels are then given by contiguous ranges of the sorted order, which
+are found with np.searchsorted instead of scanning all labels per target.
+VicinalBatchSampler draws a whole batch of targets, real indices and fake labels
+with array operations on top of this index.
+
+"""
+import numpy as np
+
+
+class VicinityIndex():
+    def __init__(self, train_labels):
+        '''
+        train_labels: normalized labels of all training images (after replication)
+        '''
+        train_labels = np.asarray(train_labels).reshape(-1)
+        self.n = len(train_labels)
+
+        # sorted order of the training labels
+        self.sorted_indx = np.argsort(train_labels, kind='stable')
+        sorted_labels = train_labels[self.sorted_indx]
+
+        # prefix offsets: images with label unique_labels[k] are sorted_indx[offsets[k]:offsets[k+1]]
+        self.unique_labels, counts = np.unique(sorted_labels, return_counts=True)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @staticmethod
+    def radius(kappa, threshold_type="hard", nonzero_soft_weight_threshold=1e-3):
+        '''
+        half width of the vicinity;
+        hard: |y-y'|<=kappa; soft: (y-y')**2 <= -log(nonzero_soft_weight_threshold)/kappa
+        '''
+        if threshold_type == "hard":
+            return kappa
+        else:
+            # reverse the weight function for SVDL
+            return np.sqrt(-np.log(nonzero_soft_weight_threshold)/kappa)
+
+    def query(self, target_labels, radius):
+        '''
+        For a batch of target labels, return [start, stop) ranges in self.sorted_indx of
+        the images whose labels lie in [target-radius, target+radius]; O(log N) per target.
+        '''
+        target_labels = np.asarray(target_labels, dtype=np.float64)
+        lo = np.searchsorted(self.unique_labels, target_labels-radius, side='left')
+        hi = np.searchsorted(self.unique_labels, target_labels+radius, side='right')
+        return self.offsets[lo], self.offsets[hi]
+
+    def count(self, target_labels, radius):
+        start, stop = self.query(target_labels, radius)
+        return stop - start
+
+    def indices(self, start, stop):
+        '''
+        index of the training images in the range [start, stop) of the sorted order
+        '''
+        return self.sorted_indx[start:stop]
+
+
+
+class VicinalBatchSampler():
+    def __init__(self, train_labels, kernel_sigma, kappa, threshold_type="hard", nonzero_soft_weight_threshold=1e-3, clip_label=False, rng=None):
+        '''
+        Draw the target labels, the real images in their vicinities and the labels
+        for fake image generation for a whole batch at once.
+        rng: a np.random.RandomState; if None, use the global numpy random state
+        '''
+        train_labels = np.asarray(train_labels).reshape(-1)
+        self.kernel_sigma = kernel_sigma
+        self.kappa = kappa
+        self.threshold_type = threshold_type
+        self.clip_label = clip_label
+        self.rng = np.random if rng is None else rng
+
+        self.unique_train_labels = np.sort(np.array(list(set(train_labels))))
+        self.vicinity_index = VicinityIndex(train_labels)
+        self.radius = VicinityIndex.radius(kappa, threshold_type, nonzero_soft_weight_threshold)
+
+    def sample(self, batch_size_disc, batch_size_gene):
+        '''
+        return:
+        batch_target_labels_with_epsilon: max(batch_size_disc, batch_size_gene) target labels
+        batch_real_indx: index of batch_size_disc real images in the vicinity of the first batch_size_disc targets
+        batch_fake_labels: batch_size_disc labels for fake image generation; also in the vicinity of the targets
+        '''
+        batch_size_max = max(batch_size_disc, batch_size_gene)
+
+        ## randomly draw batch_size_max y's from unique_train_labels and add Gaussian noise
+        batch_target_labels_in_dataset = self.rng.choice(self.unique_train_labels, size=batch_size_max, replace=True)
+        batch_epsilons = self.rng.normal(0, self.kernel_sigma, batch_size_max)
+        batch_target_labels_with_epsilon = batch_target_labels_in_dataset + batch_epsilons
+        if self.clip_label:
+            batch_target_labels_with_epsilon = np.clip(batch_target_labels_with_epsilon, 0.0, 1.0)
+        batch_target_labels = batch_target_labels_with_epsilon[0:batch_size_disc] #a view
+
+        ## index ranges of the vicinities; redraw the noise of targets with empty vicinities
+        start, stop = self.vicinity_index.query(batch_target_labels, self.radius)
+        indx_empty = np.where(stop-start<1)[0]
+        while len(indx_empty)>0:
+            batch_target_labels[indx_empty] = batch_target_labels_in_dataset[indx_empty] + self.rng.normal(0, self.kernel_sigma, len(indx_empty))
+            if self.clip_label:
+                batch_target_labels[indx_empty] = np.clip(batch_target_labels[indx_empty], 0.0, 1.0)
+            start[indx_empty], stop[indx_empty] = self.vicinity_index.query(batch_target_labels[indx_empty], self.radius)
+            indx_empty = indx_empty[stop[indx_empty]-start[indx_empty]<1]
+        #end while
+
+        ## real images: uniformly from the vicinity
+        batch_real_indx = self.vicinity_index.sorted_indx[self.rng.randint(start, stop)]
+
+        ## labels for fake image generation: uniformly from the vicinity, clamped to [0,1]
+        lb = np.maximum(batch_target_labels - self.radius, 0.0)
+        ub = np.minimum(batch_target_labels + self.radius, 1.0)
+        assert (lb<=ub).all()
+        batch_fake_labels = self.rng.uniform(lb, ub)
+
+        return batch_target_labels_with_epsilon, batch_real_indx, batch_fake_labels